@@ -3,23 +3,28 @@ import serial
 from serial.serialutil import SerialException
 import time
 import struct
+import threading
+from bisect import bisect_left
+from collections import deque
+from itertools import accumulate
 
 # --------------------------------------------------------------------------- #
 # Protocol Enums                                                              #
 # --------------------------------------------------------------------------- #
 
 class MEECU_ReportingType(Enum):
-    FLOAT_4B = (0x00, 4, 'Float (4 Bytes)')
-    INT_2B   = (0x01, 2, 'Signed Integer (2 Bytes)')
-    UINT_2B  = (0x02, 2, 'Unsigned Integer (2 Bytes)')
-    INT_1B   = (0x03, 1, 'Signed Integer (1 Byte)')
-    UINT_1B  = (0x04, 1, 'Unsigned Integer (1 Byte)')
-    BOOL_1B  = (0x05, 1, 'Boolean (1 Byte)')
-
-    def __new__(cls, value, length, desc):
+    FLOAT_4B = (0x00, 4, 'f', 'Float (4 Bytes)')
+    INT_2B   = (0x01, 2, 'h', 'Signed Integer (2 Bytes)')
+    UINT_2B  = (0x02, 2, 'H', 'Unsigned Integer (2 Bytes)')
+    INT_1B   = (0x03, 1, 'b', 'Signed Integer (1 Byte)')
+    UINT_1B  = (0x04, 1, 'B', 'Unsigned Integer (1 Byte)')
+    BOOL_1B  = (0x05, 1, '?', 'Boolean (1 Byte)')
+
+    def __new__(cls, value, length, fmt, desc):
         obj = object.__new__(cls)
         obj._value_ = value
         obj._length = length
+        obj._format = fmt
         obj.desc = desc
         return obj
 
@@ -87,11 +92,160 @@ class MEECU_ReportingCommands(Enum):
 
 # --------------------------------------------------------------------------- #
 
+class MEECU_TablesCommands(Enum):
+    SET_TABLE           = (0x00, 'Set Table')
+    GET_TABLE           = (0x01, 'Get Table')
+    ENABLE_TABLE        = (0x02, 'Enable Table')
+    DISABLE_TABLE       = (0x03, 'Disable Table')
+    SET_DATA_AT_OFFSETS = (0x04, 'Set Data At Offsets')
+    GET_DATA_AT_OFFSET  = (0x05, 'Get Data At Offset')
+    STORE_NVM           = (0x06, 'Store in NVM')
+    SET_TABLE_REPORTING = (0x07, 'Set Table Reporting')
+
+    def __new__(cls, value, desc):
+        obj = object.__new__(cls)
+        obj._value_ = value
+        obj.desc = desc
+        return obj
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_DriversCommands(Enum):
+    SET_DRIVER = (0x00, 'Set Driver')
+    GET_DRIVER = (0x01, 'Get Driver')
+    STORE_NVM  = (0x02, 'Store in NVM')
+
+    def __new__(cls, value, desc):
+        obj = object.__new__(cls)
+        obj._value_ = value
+        obj.desc = desc
+        return obj
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_FWUpdateCommands(Enum):
+    START           = (0x00, 'Start Firmware Update')
+    REGION_INFO_GET = (0x01, 'Region Info Get')
+    DATA_GET        = (0x02, 'Data Get')
+    STATUS_REPORT   = (0x03, 'Status Report')
+    ENTER_BL_MODE   = (0x04, 'Enter BL Mode')
+
+    def __new__(cls, value, desc):
+        obj = object.__new__(cls)
+        obj._value_ = value
+        obj.desc = desc
+        return obj
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_DatalogCommands(Enum):
+    IS_SUPPORTED   = (0x00, 'Is Supported')
+    GET_CONFIG     = (0x01, 'Get Config')
+    SET_CONFIG     = (0x02, 'Set Config')
+    START          = (0x03, 'Start')
+    STOP           = (0x04, 'Stop')
+    GET_LOGS       = (0x05, 'Get Logs')
+    GET_LOG_DETAIL = (0x06, 'Get Log Detail')
+    GET_LOG_REGION = (0x07, 'Get Log Region')
+    ERASE_LOG      = (0x08, 'Erase Log')
+    FORMAT_MEMORY  = (0x09, 'Format Memory')
+
+    def __new__(cls, value, desc):
+        obj = object.__new__(cls)
+        obj._value_ = value
+        obj.desc = desc
+        return obj
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_TriglogCommands(Enum):
+    IS_SUPPORTED = (0x00, 'Is Supported')
+    SET_STATE    = (0x01, 'Set State')
+    REPORT       = (0x02, 'Report')
+
+    def __new__(cls, value, desc):
+        obj = object.__new__(cls)
+        obj._value_ = value
+        obj.desc = desc
+        return obj
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_DBWCommands(Enum):
+    SET_DBW_DUTY = (0x00, 'Set DBW Duty')
+
+    def __new__(cls, value, desc):
+        obj = object.__new__(cls)
+        obj._value_ = value
+        obj.desc = desc
+        return obj
+
+# --------------------------------------------------------------------------- #
+
+# The Datalinks class has no documented commands yet
 class_to_command_enum = {
     MEECU_MessageClass.REPORTING: MEECU_ReportingCommands,
-    MEECU_MessageClass.SYSTEM: MEECU_SysCommands
+    MEECU_MessageClass.TABLES: MEECU_TablesCommands,
+    MEECU_MessageClass.DRIVERS: MEECU_DriversCommands,
+    MEECU_MessageClass.SYSTEM: MEECU_SysCommands,
+    MEECU_MessageClass.FWUPDATE: MEECU_FWUpdateCommands,
+    MEECU_MessageClass.DATALOG: MEECU_DatalogCommands,
+    MEECU_MessageClass.TRIGLOG: MEECU_TriglogCommands,
+    MEECU_MessageClass.DBW: MEECU_DBWCommands
+}
+
+# --------------------------------------------------------------------------- #
+# Header Lookup Tables                                                        #
+# --------------------------------------------------------------------------- #
+
+# Magic bytes, length, type, class, command
+HEADER_STRUCT = struct.Struct('<2sHBBB')
+
+type_by_value  = {m.value: m for m in MEECU_MessageType}
+class_by_value = {m.value: m for m in MEECU_MessageClass}
+
+# Raw (class, command) values to the command enum member
+command_by_value = {
+    (msg_class.value, command.value): command
+    for msg_class, command_enum in class_to_command_enum.items()
+    for command in command_enum
 }
 
+# --------------------------------------------------------------------------- #
+
+def calc_crc(data):
+    """
+    Fletcher-16 style checksum over the type, class, command and payload.
+    """
+    # Taking the modulo once at the end gives the same result as after every
+    # byte, which lets the sums run in C rather than a per-byte Python loop
+    num = sum(data) % 255
+    num2 = sum(accumulate(data)) % 255
+    return (num2 << 8) | num
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_CRC:
+    """
+    Incremental form of calc_crc(), for checksumming data as it arrives in
+    pieces. update() may be called any number of times before digest().
+    """
+
+    def __init__(self, data=b''):
+        self.num = 0
+        self.num2 = 0
+        self.update(data)
+
+    def update(self, data):
+        # Every byte of the new data adds the running sum so far to num2
+        self.num2 = (self.num2 + len(data) * self.num +
+                     sum(accumulate(data))) % 255
+        self.num = (self.num + sum(data)) % 255
+        return self
+
+    def digest(self):
+        return (self.num2 << 8) | self.num
+
 # --------------------------------------------------------------------------- #
 # ECU Base Message Class                                                      #
 # --------------------------------------------------------------------------- #
@@ -100,13 +254,14 @@ class MEECU_Message:
 
     _subclasses = []
 
-    data    = None
-    length  = None
-    rtype   = None
-    rclass  = None
-    command = None
-    payload = b''
-    crc     = None
+    # Raw (class, command) values to the subclass that handles them
+    _dispatch = {}
+
+    # Encoded requests by (subclass, argument), see encoded()
+    _encoded = {}
+
+    __slots__ = ('data', 'length', 'rtype', 'rclass', 'command', 'payload',
+                 'crc', 'crc_valid')
 
     # ----------------------------------------------------------------------- #
 
@@ -114,66 +269,99 @@ class MEECU_Message:
         super().__init_subclass__(**kwargs)
         MEECU_Message._subclasses.append(cls)
 
+        if hasattr(cls, 'CLASS') and hasattr(cls, 'COMMAND'):
+            MEECU_Message._dispatch[(cls.CLASS.value,
+                                     cls.COMMAND.value)] = cls
+
     # ----------------------------------------------------------------------- #
 
-    def __init__(self, data=None):
+    def __init__(self, data=None, header=None, verified=False):
+        self.data      = None
+        self.length    = None
+        self.rtype     = None
+        self.rclass    = None
+        self.command   = None
+        self.payload   = b''
+        self.crc       = None
+        self.crc_valid = None
+
         # We can accept either bytes or a hex string, which we'll convert
-        if isinstance(data, bytes):
-            self.data = data
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            self.data = bytes(data)
         if isinstance(data, str):
             self.data = self._convert_hex_str(data)
 
         # If we were provided a message to parse, do so now
         if self.data is not None:
-            self._parse()
+            self._parse(header, verified)
 
     # ----------------------------------------------------------------------- #
 
     @classmethod
-    def from_data(cls, data):
-        if isinstance(data, str):
-            data = bytes.fromhex(data)
+    def encoded(cls, arg=None):
+        """
+        Return the encoded bytes of a request that takes no argument, or one
+        from a small fixed set (e.g. a mode or state). Each is only built
+        once, and can be sent as-is with MEECU_Connection.send_raw().
+        """
+        key = (cls, arg)
+        data = MEECU_Message._encoded.get(key)
+        if data is None:
+            data = cls._build_request(arg).to_bytes()
+            MEECU_Message._encoded[key] = data
+        return data
+
+    # ----------------------------------------------------------------------- #
+
+    @classmethod
+    def _build_request(cls, arg):
+        return cls()
+
+    # ----------------------------------------------------------------------- #
 
+    @staticmethod
+    def _unpack_header(data):
         if data[:2] != b'ME':
             print("Message does not start with magic bytes 'ME', malformed!")
 
-        _, length, rtype_int, rclass_int, command_int = \
-            struct.unpack('<2sHBBB', data[:7])
+        return HEADER_STRUCT.unpack_from(data)
 
-        rtype = next((m for m in MEECU_MessageType.__members__.values() if m.value == rtype_int), None)
-        rclass = next((m for m in MEECU_MessageClass.__members__.values() if m.value == rclass_int), None)
+    # ----------------------------------------------------------------------- #
 
-        command_enum = class_to_command_enum.get(rclass, None)
-        if command_enum:
-            command = next((cmd for cmd in command_enum.__members__.values() if cmd.value == command_int), None)
-        else:
-            command = None
-            print(f"Warning: No command enum mapping for message class {self.rclass}")
+    @classmethod
+    def from_data(cls, data, verified=False):
+        """
+        Build the message subclass for a frame. If verified is set, the
+        frame's CRC has already been checked (e.g. by MEECU_Framer) and is
+        not calculated again.
+        """
+        if isinstance(data, str):
+            data = bytes.fromhex(data)
 
-        for subclass in cls._subclasses:
-            if hasattr(subclass, 'CLASS') and hasattr(subclass, 'COMMAND'):
-                if subclass.CLASS.value == rclass_int and \
-                   subclass.COMMAND.value == command_int:
-                       return subclass(data)
+        header = cls._unpack_header(data)
+        _, _, _, rclass_int, command_int = header
 
-        # ----------------------------------------------------------------------- #
+        subclass = MEECU_Message._dispatch.get((rclass_int, command_int))
+        if subclass is None:
+            print(f"Warning: No message class for class {rclass_int:#04x}, "
+                  f"command {command_int:#04x}")
+            return None
 
-    def _parse(self):
+        return subclass(data, header, verified)
 
-        if self.data[:2] != b'ME':
-            print("Message does not start with magic bytes 'ME', malformed!")
+    # ----------------------------------------------------------------------- #
 
-        _, self.length, rtype_int, rclass_int, command_int = \
-            struct.unpack('<2sHBBB', self.data[:7])
+    def _parse(self, header=None, verified=False):
+        # The header may have already been decoded by from_data()
+        if header is None:
+            header = self._unpack_header(self.data)
 
-        self.rtype = next((m for m in MEECU_MessageType.__members__.values() if m.value == rtype_int), None)
-        self.rclass = next((m for m in MEECU_MessageClass.__members__.values() if m.value == rclass_int), None)
+        _, self.length, rtype_int, rclass_int, command_int = header
 
-        command_enum = class_to_command_enum.get(self.rclass, None)
-        if command_enum:
-            self.command = next((cmd for cmd in command_enum.__members__.values() if cmd.value == command_int), None)
-        else:
-            self.command = None
+        self.rtype = type_by_value.get(rtype_int)
+        self.rclass = class_by_value.get(rclass_int)
+        self.command = command_by_value.get((rclass_int, command_int))
+        if self.command is None:
             print(f"Warning: No command enum mapping for message class {self.rclass}")
 
         payload_end = 7 + self.length
@@ -182,7 +370,19 @@ class MEECU_Message:
         if hasattr(self, '_process_payload'):
             self._process_payload()
 
-        self._calc_crc()
+        # Frames from the framer have had their CRC checked already
+        received = self.data[payload_end:payload_end + 2]
+        if verified and len(received) == 2:
+            self.crc = int.from_bytes(received, 'little')
+            self.crc_valid = True
+            return
+
+        # Checked against the received CRC when the frame includes one
+        self.crc = calc_crc(memoryview(self.data)[4:payload_end])
+        if len(received) == 2:
+            self.crc_valid = int.from_bytes(received, 'little') == self.crc
+            if not self.crc_valid:
+                print(f"Warning: CRC mismatch in {self.__class__.__name__}")
 
     # ----------------------------------------------------------------------- #
 
@@ -200,12 +400,7 @@ class MEECU_Message:
                       self.rclass.value,
                       self.command.value]) + self.payload
 
-        num = 0
-        num2 = 0
-        for byte in data:
-            num = (num + byte) % 255
-            num2 = (num2 + num) % 255
-        self.crc = (num2 << 8) | num
+        self.crc = calc_crc(data)
 
     # ----------------------------------------------------------------------- #
 
@@ -218,19 +413,17 @@ class MEECU_Message:
     # ----------------------------------------------------------------------- #
 
     def to_bytes(self):
-        self._calc_crc()
-
         magic_bytes = b'ME'
         if self.payload is None:
             self.payload = b''
 
         length = len(self.payload)
 
-        if self.crc is None:
-            self._calc_crc()
+        # The payload may have changed since the CRC was last calculated
+        self._calc_crc()
 
-        header = struct.pack('<2sHBBB', magic_bytes, length, self.rtype.value,
-                             self.rclass.value, self.command.value)
+        header = HEADER_STRUCT.pack(magic_bytes, length, self.rtype.value,
+                                    self.rclass.value, self.command.value)
         message = header + self.payload + self.crc.to_bytes(2,
                                                             byteorder='little')
 
@@ -250,8 +443,10 @@ class MEECU_Sys_GetECUInfo(MEECU_Message):
     CLASS   = MEECU_MessageClass.SYSTEM
     COMMAND = MEECU_SysCommands.GET_ECU_INFO
 
-    def __init__(self, data=None):
-        super().__init__(data)
+    __slots__ = ()
+
+    def __init__(self, data=None, header=None, verified=False):
+        super().__init__(data, header, verified)
 
         if data is None:
             self.rtype = MEECU_MessageType.REQUEST
@@ -269,8 +464,17 @@ class MEECU_Sys_GetHash(MEECU_Message):
     MODE_OVERALL  = 0x00
     MODE_DETAILED = 0x01
 
-    def __init__(self, data=None):
-        super().__init__(data)
+    # Detailed responses list a hash per table after the mode and a count
+    HASH_STRUCT  = struct.Struct('<I')
+    TABLE_STRUCT = struct.Struct('<HI')
+
+    __slots__ = ('mode', 'hash', 'hashes')
+
+    def __init__(self, data=None, header=None, verified=False):
+        self.mode = None
+        self.hash = None
+        self.hashes = {}
+        super().__init__(data, header, verified)
 
         if data is None:
             self.rtype = MEECU_MessageType.REQUEST
@@ -278,9 +482,36 @@ class MEECU_Sys_GetHash(MEECU_Message):
             self.command = MEECU_SysCommands.GET_HASH
             self._calc_crc()
 
+    @classmethod
+    def _build_request(cls, mode):
+        message = cls()
+        if mode is not None:
+            message.set_mode(mode)
+        return message
+
     def set_mode(self, mode):
         self.payload = mode.to_bytes(1, 'little')
 
+    def _process_payload(self):
+        if self.rtype != MEECU_MessageType.RESPONSE or not self.payload:
+            return
+
+        self.mode = self.payload[0]
+        if self.mode == self.MODE_OVERALL and len(self.payload) >= 5:
+            self.hash, = self.HASH_STRUCT.unpack_from(self.payload, 1)
+            return
+
+        if self.mode != self.MODE_DETAILED or len(self.payload) < 3:
+            return
+
+        count, = struct.unpack_from('<H', self.payload, 1)
+        if len(self.payload) < 3 + count * self.TABLE_STRUCT.size:
+            print("Warning: Detailed hash response is truncated")
+            return
+
+        self.hashes = dict(self.TABLE_STRUCT.iter_unpack(
+            self.payload[3:3 + count * self.TABLE_STRUCT.size]))
+
 # =========================================================================== #
 # Reporting Commands                                                          #
 # =========================================================================== #
@@ -293,12 +524,13 @@ class MEECU_Reporting_SetState(MEECU_Message):
     REPORTING_V1 = 0x01
     REPORTING_V2 = 0x02
 
+    __slots__ = ('entities', 'version', 'link_count')
 
-    def __init__(self, data=None):
+    def __init__(self, data=None, header=None, verified=False):
         self.entities = []
         self.version = 0
         self.link_count = 0
-        super().__init__(data)
+        super().__init__(data, header, verified)
 
         if data is None:
             self.rtype = MEECU_MessageType.REQUEST
@@ -307,6 +539,13 @@ class MEECU_Reporting_SetState(MEECU_Message):
             self._calc_crc()
 
 
+    @classmethod
+    def _build_request(cls, state):
+        message = cls()
+        message.set_state(state)
+        return message
+
+
     def set_state(self, state):
         if state:
             self.payload = b'\x01'
@@ -314,12 +553,18 @@ class MEECU_Reporting_SetState(MEECU_Message):
             self.payload = b'\x00'
 
 
+    def get_decoder(self):
+        return MEECU_ReportDecoder.for_entities(self.entities)
+
+
     def _process_payload(self):
         if self.rtype != MEECU_MessageType.RESPONSE:
             return
 
+        # A single status byte carries no entity map
         if len(self.payload) == 1:
             self.version = self.REPORTING_V1
+            return
         else:
             self.version = self.REPORTING_V2
 
@@ -342,8 +587,10 @@ class MEECU_Reporting_SendAck(MEECU_Message):
     CLASS   = MEECU_MessageClass.REPORTING
     COMMAND = MEECU_ReportingCommands.SEND_ACK
 
-    def __init__(self, data=None):
-        super().__init__(data)
+    __slots__ = ()
+
+    def __init__(self, data=None, header=None, verified=False):
+        super().__init__(data, header, verified)
         self.rtype = MEECU_MessageType.REQUEST
         self.rclass = MEECU_MessageClass.REPORTING
         self.command = MEECU_ReportingCommands.SEND_ACK
@@ -357,9 +604,14 @@ class MEECU_Reporting_SendReport(MEECU_Message):
     CLASS   = MEECU_MessageClass.REPORTING
     COMMAND = MEECU_ReportingCommands.SEND_REPORT
 
-    def __init__(self, data=None):
+    __slots__ = ('entities', 'values', 'received')
+
+    def __init__(self, data=None, header=None, verified=False):
         self.entities = []
-        super().__init__(data)
+        self.values = None
+        # Time the report was received, set by the connection
+        self.received = None
+        super().__init__(data, header, verified)
 
         if data is None:
             self.rtype = MEECU_MessageType.REQUEST
@@ -368,77 +620,1581 @@ class MEECU_Reporting_SendReport(MEECU_Message):
             self.payload = b'\x00'
 
     def parse_report(self, entities):
-        offset = 1
-        for entity in entities:
+        # Accept either a prebuilt decoder or a raw SetState entity map, in
+        # which case the decoder is fetched from (or added to) the cache
+        if isinstance(entities, MEECU_ReportDecoder):
+            decoder = entities
+        else:
+            decoder = MEECU_ReportDecoder.for_entities(entities)
+
+        self.entities = decoder.decode_entities(self.payload)
 
-            etype = next((m for m in MEECU_ReportingType.__members__.values() if m.value == entity['type']), None)
+# =========================================================================== #
+# Tables Commands                                                             #
+# =========================================================================== #
+#
+# Tables are read and written in chunks addressed by table id and byte
+# offset. Requests and responses both start with the table id and offset
+# (ushort each), so responses to pipelined requests can be matched up:
+#
+#   Get Data At Offset    request: length (ushort)    response: data
+#   Set Data At Offsets   request: data               response: status byte
+#
+# --------------------------------------------------------------------------- #
 
-            value_format = {
-                MEECU_ReportingType.FLOAT_4B: ('f', 4),
-                MEECU_ReportingType.INT_2B: ('h', 2),
-                MEECU_ReportingType.UINT_2B: ('H', 2),
-                MEECU_ReportingType.INT_1B: ('b', 1),
-                MEECU_ReportingType.UINT_1B: ('B', 1),
-                MEECU_ReportingType.BOOL_1B: ('?', 1),
-            }[etype]
+class MEECU_Tables_GetDataAtOffset(MEECU_Message):
 
-            format_string, _ = value_format
-            value, = struct.unpack_from(format_string, self.payload, offset)
-            self.entities.append({
-                'id': entity['id'],
-                'type': entity['type'],
-                'value': value
-            })
-            offset += etype._length
+    CLASS   = MEECU_MessageClass.TABLES
+    COMMAND = MEECU_TablesCommands.GET_DATA_AT_OFFSET
+
+    CHUNK_STRUCT  = struct.Struct('<HH')
+    LENGTH_STRUCT = struct.Struct('<H')
+
+    __slots__ = ('table_id', 'offset', 'read_length', 'table_data')
+
+    def __init__(self, data=None, header=None, verified=False):
+        self.table_id = None
+        self.offset = None
+        self.read_length = None
+        self.table_data = b''
+        super().__init__(data, header, verified)
+
+        if data is None:
+            self.rtype = MEECU_MessageType.REQUEST
+            self.rclass = self.CLASS
+            self.command = self.COMMAND
+
+
+    @classmethod
+    def request(cls, table_id, offset, length):
+        message = cls()
+        message.table_id = table_id
+        message.offset = offset
+        message.read_length = length
+        message.payload = cls.CHUNK_STRUCT.pack(table_id, offset) + \
+                          cls.LENGTH_STRUCT.pack(length)
+        return message
+
+
+    def _process_payload(self):
+        if len(self.payload) < self.CHUNK_STRUCT.size:
+            return
+
+        self.table_id, self.offset = self.CHUNK_STRUCT.unpack_from(self.payload)
+        rest = self.payload[self.CHUNK_STRUCT.size:]
+        if self.rtype == MEECU_MessageType.RESPONSE:
+            self.table_data = rest
+        elif len(rest) >= self.LENGTH_STRUCT.size:
+            self.read_length, = self.LENGTH_STRUCT.unpack_from(rest)
 
 # --------------------------------------------------------------------------- #
-# Serial Interface                                                            #
+
+class MEECU_Tables_SetDataAtOffsets(MEECU_Message):
+
+    CLASS   = MEECU_MessageClass.TABLES
+    COMMAND = MEECU_TablesCommands.SET_DATA_AT_OFFSETS
+
+    CHUNK_STRUCT = struct.Struct('<HH')
+
+    STATUS_OK = 0x00
+
+    __slots__ = ('table_id', 'offset', 'table_data', 'status')
+
+    def __init__(self, data=None, header=None, verified=False):
+        self.table_id = None
+        self.offset = None
+        self.table_data = b''
+        self.status = None
+        super().__init__(data, header, verified)
+
+        if data is None:
+            self.rtype = MEECU_MessageType.REQUEST
+            self.rclass = self.CLASS
+            self.command = self.COMMAND
+
+
+    @classmethod
+    def request(cls, table_id, offset, table_data):
+        message = cls()
+        message.table_id = table_id
+        message.offset = offset
+        message.table_data = bytes(table_data)
+        message.payload = cls.CHUNK_STRUCT.pack(table_id, offset) + \
+                          message.table_data
+        return message
+
+
+    def _process_payload(self):
+        if len(self.payload) < self.CHUNK_STRUCT.size:
+            return
+
+        self.table_id, self.offset = self.CHUNK_STRUCT.unpack_from(self.payload)
+        rest = self.payload[self.CHUNK_STRUCT.size:]
+        if self.rtype == MEECU_MessageType.RESPONSE:
+            self.status = rest[0] if rest else None
+        else:
+            self.table_data = rest
+
 # --------------------------------------------------------------------------- #
 
-class MEECU_Connection:
-    device_path = None
-    baud_rate   = None
-    handle      = None
+class MEECU_Tables_StoreNVM(MEECU_Message):
 
+    CLASS   = MEECU_MessageClass.TABLES
+    COMMAND = MEECU_TablesCommands.STORE_NVM
 
-    def __init__(self, device_path, baud_rate):
-        self.device_path = device_path
-        self.baud_rate = baud_rate
+    __slots__ = ()
 
+    def __init__(self, data=None, header=None, verified=False):
+        super().__init__(data, header, verified)
 
-    def connect(self):
-        try:
-            self.handle = serial.Serial(self.device_path, self.baud_rate)
-        except SerialException as err:
-            print(f"Exception when connecting: {err}")
-            return False
+        if data is None:
+            self.rtype = MEECU_MessageType.REQUEST
+            self.rclass = self.CLASS
+            self.command = self.COMMAND
+            self._calc_crc()
 
-        if not self.handle.is_open:
-            print("Failed to open serial port!")
-            return False
+# =========================================================================== #
+# Data Log Commands                                                           #
+# =========================================================================== #
+#
+# Logs recorded onboard are listed, described, then read in regions
+# addressed by log id (ushort) and byte offset (uint). Region requests and
+# responses both start with the log id and offset, so responses to
+# pipelined requests can be matched up:
+#
+#   Get Logs         response: count (ushort), count * (id, size: uint)
+#   Get Log Detail   request:  id
+#                    response: id, size, start time (uint, seconds),
+#                              interval (ushort, ms), entity map as SetState
+#   Get Log Region   request:  id, offset, length (ushort)
+#                    response: id, offset, data
+#
+# A log is a run of fixed size records, one per interval, each laid out as
+# a report payload for the log's entity map without the leading byte.
+#
+# --------------------------------------------------------------------------- #
 
-        return True
+class MEECU_Datalog_GetLogs(MEECU_Message):
 
+    CLASS   = MEECU_MessageClass.DATALOG
+    COMMAND = MEECU_DatalogCommands.GET_LOGS
 
-    def send_message(self, message, recv=True):
-        self.handle.write(message.to_bytes())
-        time.sleep(0.1)
+    LOG_STRUCT = struct.Struct('<HI')
 
-        if recv:
-            rx = self.receive_message()
-            if rx is not None:
-                return MEECU_Message.from_data(rx)
-            else:
-                return None
+    __slots__ = ('logs',)
 
+    def __init__(self, data=None, header=None, verified=False):
+        self.logs = []
+        super().__init__(data, header, verified)
 
-    def receive_message(self):
-        buffer = b''
+        if data is None:
+            self.rtype = MEECU_MessageType.REQUEST
+            self.rclass = self.CLASS
+            self.command = self.COMMAND
+            self._calc_crc()
 
-        if self.handle.in_waiting > 0:
-            buffer = self.handle.read(7)
-            _, hlen, htype, hclass, hcmd = struct.unpack('<2sHBBB', buffer)
-            buffer += self.handle.read(hlen + 2)
-            return buffer
-        else:
-            return None
+
+    def _process_payload(self):
+        if self.rtype != MEECU_MessageType.RESPONSE or len(self.payload) < 2:
+            return
+
+        count, = struct.unpack_from('<H', self.payload)
+        self.logs = [{'id': log_id, 'size': size}
+                     for log_id, size in self.LOG_STRUCT.iter_unpack(
+                         self.payload[2:2 + count * self.LOG_STRUCT.size])]
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_Datalog_GetLogDetail(MEECU_Message):
+
+    CLASS   = MEECU_MessageClass.DATALOG
+    COMMAND = MEECU_DatalogCommands.GET_LOG_DETAIL
+
+    DETAIL_STRUCT = struct.Struct('<HIIHH')
+    ENTITY_STRUCT = struct.Struct('<HB')
+
+    __slots__ = ('log_id', 'size', 'start_time', 'interval', 'entities')
+
+    def __init__(self, data=None, header=None, verified=False):
+        self.log_id = None
+        self.size = 0
+        self.start_time = 0
+        self.interval = 0
+        self.entities = []
+        super().__init__(data, header, verified)
+
+        if data is None:
+            self.rtype = MEECU_MessageType.REQUEST
+            self.rclass = self.CLASS
+            self.command = self.COMMAND
+
+
+    @classmethod
+    def request(cls, log_id):
+        message = cls()
+        message.log_id = log_id
+        message.payload = struct.pack('<H', log_id)
+        return message
+
+
+    def get_decoder(self):
+        return MEECU_ReportDecoder.for_entities(self.entities)
+
+
+    @property
+    def record_size(self):
+        """Bytes per record, the report payload size less its leading byte."""
+        return self.get_decoder().size - 1
+
+
+    def _process_payload(self):
+        if len(self.payload) < 2:
+            return
+
+        if self.rtype != MEECU_MessageType.RESPONSE:
+            self.log_id, = struct.unpack_from('<H', self.payload)
+            return
+
+        if len(self.payload) < self.DETAIL_STRUCT.size:
+            return
+
+        self.log_id, self.size, self.start_time, interval_ms, count = \
+            self.DETAIL_STRUCT.unpack_from(self.payload)
+        self.interval = interval_ms / 1000
+
+        offset = self.DETAIL_STRUCT.size
+        self.entities = [{'id': entity_id, 'type': entity_type}
+                         for entity_id, entity_type
+                         in self.ENTITY_STRUCT.iter_unpack(self.payload[
+                             offset:offset + count * self.ENTITY_STRUCT.size])]
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_Datalog_GetLogRegion(MEECU_Message):
+
+    CLASS   = MEECU_MessageClass.DATALOG
+    COMMAND = MEECU_DatalogCommands.GET_LOG_REGION
+
+    REGION_STRUCT = struct.Struct('<HI')
+    LENGTH_STRUCT = struct.Struct('<H')
+
+    __slots__ = ('log_id', 'offset', 'read_length', 'log_data')
+
+    def __init__(self, data=None, header=None, verified=False):
+        self.log_id = None
+        self.offset = None
+        self.read_length = None
+        self.log_data = b''
+        super().__init__(data, header, verified)
+
+        if data is None:
+            self.rtype = MEECU_MessageType.REQUEST
+            self.rclass = self.CLASS
+            self.command = self.COMMAND
+
+
+    @classmethod
+    def request(cls, log_id, offset, length):
+        message = cls()
+        message.log_id = log_id
+        message.offset = offset
+        message.read_length = length
+        message.payload = cls.REGION_STRUCT.pack(log_id, offset) + \
+                          cls.LENGTH_STRUCT.pack(length)
+        return message
+
+
+    def _process_payload(self):
+        if len(self.payload) < self.REGION_STRUCT.size:
+            return
+
+        self.log_id, self.offset = self.REGION_STRUCT.unpack_from(self.payload)
+        rest = self.payload[self.REGION_STRUCT.size:]
+        if self.rtype == MEECU_MessageType.RESPONSE:
+            self.log_data = rest
+        elif len(rest) >= self.LENGTH_STRUCT.size:
+            self.read_length, = self.LENGTH_STRUCT.unpack_from(rest)
+
+# =========================================================================== #
+# Trigger Log Commands                                                        #
+# =========================================================================== #
+#
+# Trigger logging is switched on and off with Set State, as reporting is.
+# While it is on, the ECU sends Report responses unprompted, each carrying a
+# block of trigger samples whose layout depends on the trigger setup.
+#
+# --------------------------------------------------------------------------- #
+
+class MEECU_Triglog_SetState(MEECU_Message):
+
+    CLASS   = MEECU_MessageClass.TRIGLOG
+    COMMAND = MEECU_TriglogCommands.SET_STATE
+
+    __slots__ = ()
+
+    def __init__(self, data=None, header=None, verified=False):
+        super().__init__(data, header, verified)
+
+        if data is None:
+            self.rtype = MEECU_MessageType.REQUEST
+            self.rclass = self.CLASS
+            self.command = self.COMMAND
+            self.payload = b'\x00'
+
+
+    @classmethod
+    def _build_request(cls, state):
+        message = cls()
+        message.payload = b'\x01' if state else b'\x00'
+        return message
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_Triglog_Report(MEECU_Message):
+
+    CLASS   = MEECU_MessageClass.TRIGLOG
+    COMMAND = MEECU_TriglogCommands.REPORT
+
+    __slots__ = ()
+
+# --------------------------------------------------------------------------- #
+# Report Decoder                                                              #
+# --------------------------------------------------------------------------- #
+
+class MEECU_ReportDecoder:
+    """
+    Decodes SendReport payloads for a fixed entity map. The layout of every
+    report is fully described by the SetState response, so the whole payload
+    is unpacked with a single precompiled struct rather than per-entity.
+    """
+
+    # Most recently built decoder, reused while the entity map is unchanged
+    _cached = None
+
+    def __init__(self, entities):
+        self.ids   = tuple(entity['id'] for entity in entities)
+        self.types = tuple(entity['type'] for entity in entities)
+
+        # Entity id to its position in the decoded values
+        self.index = {entity_id: i for i, entity_id in enumerate(self.ids)}
+
+        # Payload offset of each entity, after the leading byte
+        offsets = []
+        offset = 1
+        for etype in self.types:
+            offsets.append(offset)
+            offset += MEECU_ReportingType(etype)._length
+        self.offsets = tuple(offsets)
+
+        # The first byte of the report payload precedes the entity values
+        fmt = '<x' + ''.join(MEECU_ReportingType(etype)._format
+                             for etype in self.types)
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+        # The entity map this was built for, and a copy of it used to detect
+        # changes when a different list is passed to for_entities()
+        self._entities = entities
+        self._snapshot = [dict(entity) for entity in entities]
+
+    # ----------------------------------------------------------------------- #
+
+    @classmethod
+    def for_entities(cls, entities):
+        """
+        Return the cached decoder if it was built for this entity map. The
+        list the decoder was built from is matched by identity alone, so an
+        entity map changed in place has to be passed as a new list.
+        """
+        decoder = cls._cached
+        if decoder is not None and decoder._entities is entities:
+            return decoder
+
+        if decoder is None or decoder._snapshot != entities:
+            decoder = cls(entities)
+            cls._cached = decoder
+        else:
+            # Equal to the cached map, so matched by identity from now on
+            decoder._entities = entities
+        return decoder
+
+    # ----------------------------------------------------------------------- #
+
+    def decode(self, payload):
+        """Return a tuple of entity values, in entity map order."""
+        return self.struct.unpack_from(payload)
+
+    # ----------------------------------------------------------------------- #
+
+    def decode_entities(self, payload):
+        values = self.struct.unpack_from(payload)
+        return [{'id': eid, 'type': etype, 'value': value}
+                for eid, etype, value in zip(self.ids, self.types, values)]
+
+    # ----------------------------------------------------------------------- #
+
+    def subscribe(self, keys, catalogue=None):
+        return MEECU_ReportSubscription(self, keys, catalogue)
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_ReportSubscription:
+    """
+    Decodes only a chosen set of entities from SendReport payloads. Entities
+    are given by id, or by name when a MEECU_EntityCatalogue is provided, and
+    everything between them is skipped with pad bytes in the compiled struct.
+    """
+
+    def __init__(self, decoder, keys, catalogue=None):
+        self.keys = tuple(keys)
+
+        fields = []
+        for key in self.keys:
+            entity_id = catalogue[key].id if catalogue is not None else key
+            if entity_id not in decoder.index:
+                raise KeyError(f"Entity {key} is not in the entity map")
+
+            i = decoder.index[entity_id]
+            fields.append((decoder.offsets[i], decoder.types[i], key))
+        fields.sort(key=lambda field: field[0])
+
+        fmt = '<'
+        position = 0
+        for offset, etype, _ in fields:
+            if offset > position:
+                fmt += f'{offset - position}x'
+            fmt += MEECU_ReportingType(etype)._format
+            position = offset + MEECU_ReportingType(etype)._length
+        self.struct = struct.Struct(fmt)
+
+        # Values are unpacked in payload order, the keys in that order
+        self._keys = tuple(key for _, _, key in fields)
+
+    # ----------------------------------------------------------------------- #
+
+    def decode(self, payload):
+        """Return a dict of the subscribed keys to their values."""
+        return dict(zip(self._keys, self.struct.unpack_from(payload)))
+
+# --------------------------------------------------------------------------- #
+# Stream Framing                                                              #
+# --------------------------------------------------------------------------- #
+
+class MEECU_Framer:
+    """
+    Incrementally splits a byte stream into frames. Chunks of any size are
+    passed to feed(), and complete frames are returned as memoryview slices
+    of the received data. Anything that doesn't form a frame with a valid
+    header and CRC is discarded until the next 'ME' magic is found.
+
+    The header has no checksum of its own, so a corrupted length can claim
+    far more bytes than the frame really has. While waiting for them, the
+    bytes already received are searched for a complete frame with a valid
+    CRC, and if one is found the frame being waited for is dropped.
+    """
+
+    MAGIC = b'ME'
+    HEADER_LENGTH = 7
+    CRC_LENGTH = 2
+
+    def __init__(self, max_length=0xFFFF):
+        self.max_length = max_length
+        self.dropped = 0
+        self.resyncs = 0
+        self.crc_failures = 0
+        self._buffer = b''
+        self._pos = 0
+
+        # Where the search for a frame inside the incomplete frame at _pos
+        # carries on from, relative to _pos
+        self._lookahead = 0
+
+    # ----------------------------------------------------------------------- #
+
+    def feed(self, data):
+        # Frames already returned keep referencing the old buffer, so only
+        # the unconsumed tail is carried over into the new one
+        self._buffer = self._buffer[self._pos:] + bytes(data)
+        self._pos = 0
+
+    # ----------------------------------------------------------------------- #
+
+    def reset(self):
+        self._buffer = b''
+        self._pos = 0
+        self._lookahead = 0
+
+    # ----------------------------------------------------------------------- #
+
+    def pending(self):
+        return len(self._buffer) - self._pos
+
+    # ----------------------------------------------------------------------- #
+
+    def next_frame(self):
+        buffer = self._buffer
+        end = len(buffer)
+        pos = self._pos
+
+        while True:
+            start = buffer.find(self.MAGIC, pos)
+            if start < 0:
+                # A trailing 'M' may be the first half of the next magic
+                keep = end - 1 if end > pos and buffer[-1] == 0x4D else end
+                self.dropped += keep - pos
+                self._pos = keep
+                self._lookahead = 0
+                return None
+
+            self.dropped += start - pos
+            if start != self._pos:
+                self._lookahead = 0
+
+            if end - start < self.HEADER_LENGTH:
+                self._pos = start
+                return None
+
+            _, length, rtype_int, rclass_int, _ = \
+                HEADER_STRUCT.unpack_from(buffer, start)
+
+            if rtype_int not in type_by_value or \
+               rclass_int not in class_by_value or \
+               length > self.max_length:
+                pos = self._resync(start)
+                continue
+
+            payload_end = start + self.HEADER_LENGTH + length
+            frame_end = payload_end + self.CRC_LENGTH
+            if frame_end > end:
+                found = self._find_frame(buffer, start)
+                if found is None:
+                    self._pos = start
+                    return None
+
+                # The length was wrong, as a whole frame starts within it
+                self.dropped += found - start
+                self.resyncs += 1
+                self._lookahead = 0
+                pos = found
+                continue
+
+            view = memoryview(buffer)
+            crc = int.from_bytes(view[payload_end:frame_end], 'little')
+            if crc != calc_crc(view[start + 4:payload_end]):
+                self.crc_failures += 1
+                pos = self._resync(start)
+                continue
+
+            self._pos = frame_end
+            self._lookahead = 0
+            return view[start:frame_end]
+
+    # ----------------------------------------------------------------------- #
+
+    def _find_frame(self, buffer, start):
+        """
+        Return the position of a complete frame with a valid CRC after the
+        incomplete frame at start, or None. Candidates that are themselves
+        incomplete are checked again once more data arrives.
+        """
+        end = len(buffer)
+        pos = start + max(1, self._lookahead)
+        resume = None
+
+        while True:
+            candidate = buffer.find(self.MAGIC, pos)
+            if candidate < 0:
+                break
+
+            pos = candidate + 1
+            if end - candidate < self.HEADER_LENGTH:
+                if resume is None:
+                    resume = candidate
+                break
+
+            _, length, rtype_int, rclass_int, _ = \
+                HEADER_STRUCT.unpack_from(buffer, candidate)
+            if rtype_int not in type_by_value or \
+               rclass_int not in class_by_value or \
+               length > self.max_length:
+                continue
+
+            payload_end = candidate + self.HEADER_LENGTH + length
+            frame_end = payload_end + self.CRC_LENGTH
+            if frame_end > end:
+                if resume is None:
+                    resume = candidate
+                continue
+
+            view = memoryview(buffer)
+            crc = int.from_bytes(view[payload_end:frame_end], 'little')
+            if crc == calc_crc(view[candidate + 4:payload_end]):
+                return candidate
+
+        # A trailing 'M' may be the first half of the next magic
+        if resume is None:
+            resume = max(start + 1, end - 1)
+        self._lookahead = resume - start
+        return None
+
+    # ----------------------------------------------------------------------- #
+
+    def _resync(self, start):
+        # Skip the 'M' of the bad frame and hunt for the next magic
+        self.dropped += 1
+        self.resyncs += 1
+        self._lookahead = 0
+        return start + 1
+
+    # ----------------------------------------------------------------------- #
+
+    def __iter__(self):
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+# --------------------------------------------------------------------------- #
+# Bulk Frame Parsing                                                          #
+# --------------------------------------------------------------------------- #
+
+class MEECU_FrameView:
+    """
+    A frame within a larger buffer, with its header fields as plain ints and
+    the frame and payload as memoryview slices of the buffer. Nothing is
+    copied until message() builds the full message object.
+    """
+
+    __slots__ = ('offset', 'length', 'rtype', 'rclass', 'command', 'data',
+                 'payload', 'verified')
+
+    def __init__(self, view, offset, length, rtype, rclass, command,
+                 verified=True):
+        self.offset  = offset
+        self.length  = length
+        self.rtype   = rtype
+        self.rclass  = rclass
+        self.command = command
+
+        payload_end = offset + MEECU_Framer.HEADER_LENGTH + length
+        self.data    = view[offset:payload_end + MEECU_Framer.CRC_LENGTH]
+        self.payload = view[offset + MEECU_Framer.HEADER_LENGTH:payload_end]
+
+        # Whether the scanner checked the CRC
+        self.verified = verified
+
+    # ----------------------------------------------------------------------- #
+
+    @property
+    def crc(self):
+        return int.from_bytes(self.data[-MEECU_Framer.CRC_LENGTH:], 'little')
+
+    # ----------------------------------------------------------------------- #
+
+    def is_report(self):
+        return self.rclass == MEECU_MessageClass.REPORTING.value and \
+               self.command == MEECU_ReportingCommands.SEND_REPORT.value
+
+    # ----------------------------------------------------------------------- #
+
+    def message(self):
+        return MEECU_Message.from_data(self.data, self.verified)
+
+    # ----------------------------------------------------------------------- #
+
+    def release(self):
+        self.data.release()
+        self.payload.release()
+
+    # ----------------------------------------------------------------------- #
+
+    def __repr__(self):
+        return (f"MEECU_FrameView(offset={self.offset}, "
+                f"class={self.rclass:#04x}, command={self.command:#04x}, "
+                f"length={self.length})")
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_FrameScanner:
+    """
+    Iterates over back-to-back frames in a bytes, bytearray or mmap object,
+    such as a capture file, yielding a MEECU_FrameView for each one. Data
+    that doesn't form a valid frame is skipped as MEECU_Framer does, and
+    the CRC check can be turned off for trusted data.
+
+    The views reference the buffer, so they (or messages built from them)
+    must be released before an mmap they come from is closed.
+    """
+
+    def __init__(self, buffer, verify=True, max_length=0xFFFF):
+        self.buffer = buffer
+        self.verify = verify
+        self.max_length = max_length
+        self.frames = 0
+        self.dropped = 0
+        self.resyncs = 0
+        self.crc_failures = 0
+
+    # ----------------------------------------------------------------------- #
+
+    def __iter__(self):
+        buffer = self.buffer
+        view = memoryview(buffer)
+        end = len(buffer)
+        header_length = MEECU_Framer.HEADER_LENGTH
+        crc_length = MEECU_Framer.CRC_LENGTH
+        unpack_header = HEADER_STRUCT.unpack_from
+        pos = 0
+
+        try:
+            while True:
+                start = buffer.find(MEECU_Framer.MAGIC, pos)
+                if start < 0 or end - start < header_length:
+                    self.dropped += end - pos
+                    return
+                self.dropped += start - pos
+
+                _, length, rtype, rclass, command = unpack_header(view, start)
+
+                payload_end = start + header_length + length
+                frame_end = payload_end + crc_length
+                if rtype not in type_by_value or \
+                   rclass not in class_by_value or \
+                   length > self.max_length or frame_end > end:
+                    pos = self._resync(start)
+                    continue
+
+                if self.verify:
+                    crc = view[payload_end] | view[payload_end + 1] << 8
+                    if crc != calc_crc(view[start + 4:payload_end]):
+                        self.crc_failures += 1
+                        pos = self._resync(start)
+                        continue
+
+                self.frames += 1
+                yield MEECU_FrameView(view, start, length, rtype, rclass,
+                                      command, self.verify)
+                pos = frame_end
+        finally:
+            view.release()
+
+    # ----------------------------------------------------------------------- #
+
+    def _resync(self, start):
+        self.dropped += 1
+        self.resyncs += 1
+        return start + 1
+
+# --------------------------------------------------------------------------- #
+
+def iter_frames(buffer, verify=True):
+    """Yield a MEECU_FrameView for each frame in a multi-frame buffer."""
+    return iter(MEECU_FrameScanner(buffer, verify))
+
+# --------------------------------------------------------------------------- #
+# Report Buffer                                                               #
+# --------------------------------------------------------------------------- #
+
+class MEECU_ReportBuffer:
+    """
+    Bounded FIFO of received reports shared between the thread reading the
+    serial port and its consumers. When full, either the oldest report is
+    discarded (DROP_OLDEST) or the producer waits for space (BLOCK).
+    """
+
+    DROP_OLDEST = 'drop-oldest'
+    BLOCK       = 'block'
+
+    def __init__(self, size=1024, policy=DROP_OLDEST):
+        if policy not in (self.DROP_OLDEST, self.BLOCK):
+            raise ValueError(f"Unknown report buffer policy: {policy}")
+
+        self.size = size
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+
+        # A fixed length deque gives drop-oldest behaviour on append
+        maxlen = size if policy == self.DROP_OLDEST else None
+        self._items = deque(maxlen=maxlen)
+        self._changed = threading.Condition()
+
+    # ----------------------------------------------------------------------- #
+
+    def __len__(self):
+        return len(self._items)
+
+    # ----------------------------------------------------------------------- #
+
+    def put(self, item, timeout=None):
+        with self._changed:
+            if self.policy == self.BLOCK:
+                has_space = self._changed.wait_for(
+                    lambda: len(self._items) < self.size or self.closed,
+                    timeout)
+                if not has_space or self.closed:
+                    self.dropped += 1
+                    return False
+            elif len(self._items) == self.size:
+                self.dropped += 1
+
+            self._items.append(item)
+            self._changed.notify_all()
+            return True
+
+    # ----------------------------------------------------------------------- #
+
+    def get(self, block=True, timeout=None):
+        with self._changed:
+            if block:
+                self._changed.wait_for(
+                    lambda: self._items or self.closed, timeout)
+
+            if not self._items:
+                return None
+
+            item = self._items.popleft()
+            self._changed.notify_all()
+            return item
+
+    # ----------------------------------------------------------------------- #
+
+    def close(self):
+        with self._changed:
+            self.closed = True
+            self._changed.notify_all()
+
+    # ----------------------------------------------------------------------- #
+
+    def __iter__(self):
+        # Runs until the buffer is closed and everything has been consumed
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            yield item
+
+# --------------------------------------------------------------------------- #
+# Connection Statistics                                                       #
+# --------------------------------------------------------------------------- #
+
+class MEECU_Histogram:
+    """
+    Fixed bucket histogram of durations in seconds, with buckets on a 1-2-5
+    series from 10us to 10s. Percentiles are the upper bound of the bucket
+    they fall in.
+    """
+
+    BOUNDS = tuple(m * 10.0 ** e for e in range(-5, 1) for m in (1, 2, 5)) \
+             + (10.0,)
+
+    def __init__(self):
+        self.reset()
+
+    # ----------------------------------------------------------------------- #
+
+    def reset(self):
+        # The last bucket counts anything above the largest bound
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    # ----------------------------------------------------------------------- #
+
+    def record(self, value):
+        self.counts[bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    # ----------------------------------------------------------------------- #
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+
+        target = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+    # ----------------------------------------------------------------------- #
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_ConnectionStats:
+    """
+    Counters and latency histograms for a connection, enabled with
+    MEECU_Connection.enable_stats(). The connection only updates them while
+    enabled, so disabled stats cost a single attribute check per frame.
+
+    Hooks added with add_hook() are called as hook(event, value) from the
+    thread reading the port, for each request round trip (EVENT_RTT, in
+    seconds), timed out request (EVENT_TIMEOUT) and report received
+    (EVENT_REPORT, the interval since the previous report in seconds).
+    """
+
+    EVENT_RTT     = 'rtt'
+    EVENT_TIMEOUT = 'timeout'
+    EVENT_REPORT  = 'report'
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.hooks = []
+        self.rtt = MEECU_Histogram()
+        self.report_interval = MEECU_Histogram()
+        self.reset()
+
+    # ----------------------------------------------------------------------- #
+
+    def reset(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames = 0
+        self.reports = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.max_queue_depth = 0
+
+        # Smoothed variation in report interval, as RTP (RFC 3550) does
+        self.jitter = 0.0
+        self._last_report = None
+        self._last_interval = None
+
+        self.rtt.reset()
+        self.report_interval.reset()
+
+        framer = self.conn.framer
+        self._framer_base = (framer.crc_failures, framer.resyncs,
+                             framer.dropped)
+
+    # ----------------------------------------------------------------------- #
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    # ----------------------------------------------------------------------- #
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    # ----------------------------------------------------------------------- #
+
+    def _emit(self, event, value):
+        for hook in self.hooks:
+            hook(event, value)
+
+    # ----------------------------------------------------------------------- #
+
+    def record_rtt(self, seconds):
+        if seconds is None:
+            self.timeouts += 1
+            if self.hooks:
+                self._emit(self.EVENT_TIMEOUT, None)
+            return
+
+        self.responses += 1
+        self.rtt.record(seconds)
+        if self.hooks:
+            self._emit(self.EVENT_RTT, seconds)
+
+    # ----------------------------------------------------------------------- #
+
+    def record_report(self, now, queue_depth):
+        self.reports += 1
+        if queue_depth > self.max_queue_depth:
+            self.max_queue_depth = queue_depth
+
+        last = self._last_report
+        self._last_report = now
+        if last is None:
+            return
+
+        interval = now - last
+        self.report_interval.record(interval)
+        if self._last_interval is not None:
+            self.jitter += (abs(interval - self._last_interval) -
+                            self.jitter) / 16
+        self._last_interval = interval
+
+        if self.hooks:
+            self._emit(self.EVENT_REPORT, interval)
+
+    # ----------------------------------------------------------------------- #
+
+    def snapshot(self):
+        """Return the current values as a dict, e.g. for logging as JSON."""
+        framer = self.conn.framer
+        crc_failures, resyncs, dropped = self._framer_base
+
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames': self.frames,
+            'reports': self.reports,
+            'responses': self.responses,
+            'timeouts': self.timeouts,
+            'crc_failures': framer.crc_failures - crc_failures,
+            'resyncs': framer.resyncs - resyncs,
+            'bytes_dropped': framer.dropped - dropped,
+            'queue_depth': len(self.conn.reports),
+            'max_queue_depth': self.max_queue_depth,
+            'reports_dropped': self.conn.reports.dropped,
+            'jitter': self.jitter,
+            'rtt': self.rtt.snapshot(),
+            'report_interval': self.report_interval.snapshot(),
+        }
+
+# --------------------------------------------------------------------------- #
+# Serial Interface                                                            #
+# --------------------------------------------------------------------------- #
+
+class MEECU_Connection:
+    device_path = None
+    baud_rate   = None
+    handle      = None
+    decoder     = None
+    entities    = None
+    recorder    = None
+    record_only = False
+    subscription = None
+    stats       = None
+
+    # Upper bound on how long a blocking read waits before the deadline
+    # for a response, or a request to stop the reader, is rechecked
+    POLL_INTERVAL = 0.05
+
+
+    def __init__(self, device_path, baud_rate, timeout=1.0):
+        self.device_path = device_path
+        self.baud_rate = baud_rate
+        self.timeout = timeout
+        self.framer = MEECU_Framer()
+        self.reports = MEECU_ReportBuffer()
+
+        # Used once start_reader() hands the port to a background thread
+        self._reader = None
+        self._stop_reader = threading.Event()
+        self._responses = deque(maxlen=16)
+        self._response_ready = threading.Condition()
+
+        # Automatic report acknowledgement, see set_auto_ack()
+        self.ack_every = 0
+        self._reports_since_ack = 0
+        self._ack_bytes = MEECU_Reporting_SendAck.encoded()
+
+        # ACKs written by the reader and requests written by the caller
+        # mustn't interleave on the wire
+        self._write_lock = threading.Lock()
+
+        # Frames the reader discarded because handling them raised
+        self.frame_errors = 0
+
+
+    def connect(self):
+        try:
+            self.handle = serial.Serial(self.device_path, self.baud_rate,
+                                        timeout=self.POLL_INTERVAL)
+        except SerialException as err:
+            print(f"Exception when connecting: {err}")
+            return False
+
+        if not self.handle.is_open:
+            print("Failed to open serial port!")
+            return False
+
+        return True
+
+
+    def set_baud_rate(self, baud_rate):
+        """
+        Switch the open port to another baud rate, discarding anything
+        received at the old one. The reader must not be running.
+        """
+        self.baud_rate = baud_rate
+        if self.handle is None:
+            return True
+
+        try:
+            self.handle.baudrate = baud_rate
+        except (SerialException, ValueError) as err:
+            print(f"Exception when setting baud rate: {err}")
+            return False
+
+        self.handle.reset_input_buffer()
+        self.framer.reset()
+        return True
+
+
+    def start_reader(self, buffer_size=1024,
+                     policy=MEECU_ReportBuffer.DROP_OLDEST):
+        """
+        Read the port from a background thread. Reports are decoded as they
+        arrive and placed in a bounded buffer consumed via iter_reports() or
+        receive_report(), while responses are handed to send_message().
+        """
+        if self._reader is not None:
+            return
+
+        self.reports = MEECU_ReportBuffer(buffer_size, policy)
+        self._stop_reader.clear()
+        self._reader = threading.Thread(target=self._reader_loop,
+                                        name=f"MEECU reader {self.device_path}",
+                                        daemon=True)
+        self._reader.start()
+
+
+    def stop_reader(self):
+        if self._reader is None:
+            return
+
+        self._stop_reader.set()
+        self.reports.close()
+        self._reader.join()
+        self._reader = None
+
+
+    def set_auto_ack(self, every=1):
+        """
+        Acknowledge every Nth report as soon as its frame is received, before
+        it is decoded. Passing 0 disables automatic acknowledgement.
+        """
+        self.ack_every = every
+        self._reports_since_ack = 0
+
+
+    def subscribe(self, keys, catalogue=None):
+        """
+        Only decode the given entities from reports received from now on,
+        into a dict of key to value in each report's values attribute.
+        Requires the entity map from a SetState response. None decodes every
+        entity again.
+        """
+        if keys is None:
+            self.subscription = None
+        elif self.decoder is None:
+            raise ValueError("Cannot subscribe before the entity map has "
+                             "been received in a SetState response")
+        else:
+            self.subscription = self.decoder.subscribe(keys, catalogue)
+        return self.subscription
+
+
+    def enable_stats(self):
+        """
+        Start collecting a MEECU_ConnectionStats, returned and kept in the
+        stats attribute. Calling it again resets the stats.
+        """
+        if self.stats is None:
+            self.stats = MEECU_ConnectionStats(self)
+        else:
+            self.stats.reset()
+        return self.stats
+
+
+    def disable_stats(self):
+        self.stats = None
+
+
+    def set_recorder(self, recorder, record_only=False):
+        """
+        Pass the payload of every report received to recorder.write(payload,
+        timestamp), e.g. a MEECU_SessionWriter. None stops recording. With
+        record_only set, reports only go to the recorder: they aren't
+        decoded or placed in the report buffer.
+        """
+        self.recorder = recorder
+        self.record_only = record_only and recorder is not None
+
+
+    def iter_reports(self):
+        """Yield reports from the reader until it is stopped."""
+        return iter(self.reports)
+
+
+    def send_message(self, message, recv=True, timeout=None):
+        return self.send_raw(message.to_bytes(), recv, timeout)
+
+
+    def send_raw(self, data, recv=True, timeout=None):
+        """
+        Send an already encoded message, e.g. from MEECU_Message.encoded(),
+        waiting for the response to it if recv is set.
+        """
+        if recv and self._reader is not None:
+            # Don't let a late response to an earlier request match this one
+            with self._response_ready:
+                self._responses.clear()
+
+        stats = self.stats
+        if stats is not None:
+            stats.bytes_out += len(data)
+            sent = time.monotonic()
+
+        with self._write_lock:
+            self.handle.write(data)
+
+        if recv:
+            response = self.wait_for_response(class_by_value.get(data[5]),
+                                              command_by_value.get((data[5],
+                                                                    data[6])),
+                                              timeout)
+            if stats is not None:
+                stats.record_rtt(None if response is None
+                                 else time.monotonic() - sent)
+            return response
+
+
+    def wait_for_response(self, rclass, command, timeout=None):
+        """
+        Wait until a response with the given class and command arrives, or
+        the deadline passes, in which case None is returned. Reports received
+        while waiting are queued for receive_report().
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+
+        if self._reader is not None:
+            return self._wait_for_reader(rclass, command, deadline)
+
+        while True:
+            frame = self._read_frame(deadline)
+            if frame is None:
+                return None
+
+            message = self._handle_frame(frame)
+            if message is not None and \
+               message.rclass is rclass and message.command is command:
+                return message
+
+
+    def _wait_for_reader(self, rclass, command, deadline):
+        with self._response_ready:
+            while True:
+                for message in self._responses:
+                    if message.rclass is rclass and \
+                       message.command is command:
+                        self._responses.remove(message)
+                        return message
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._response_ready.wait(remaining)
+
+
+    def clock(self):
+        """Time reports are stamped with as they are received."""
+        return time.time()
+
+
+    def _handle_frame(self, frame):
+        """
+        Decode a frame, routing reports to the report buffer. Any other
+        response is returned.
+        """
+        if self.ack_every:
+            self._ack_report(frame)
+
+        stats = self.stats
+        if stats is not None:
+            stats.frames += 1
+
+        if self.record_only and \
+           frame[5] == MEECU_MessageClass.REPORTING.value and \
+           frame[6] == MEECU_ReportingCommands.SEND_REPORT.value:
+            # Straight from the frame, without building a message
+            self.recorder.write(bytes(frame[7:-2]), self.clock())
+            if stats is not None:
+                stats.record_report(time.monotonic(), 0)
+            return None
+
+        # Frames come from the framer, which has already checked the CRC
+        message = MEECU_Message.from_data(frame, verified=True)
+        if message is None:
+            return None
+
+        if isinstance(message, MEECU_Reporting_SendReport):
+            message.received = self.clock()
+            if self.recorder is not None:
+                self.recorder.write(message.payload, message.received)
+            if self.subscription is not None:
+                message.values = self.subscription.decode(message.payload)
+            elif self.decoder is not None:
+                message.parse_report(self.decoder)
+            self.reports.put(message)
+            if stats is not None:
+                stats.record_report(time.monotonic(), len(self.reports))
+            return None
+
+        if message.rtype is not MEECU_MessageType.RESPONSE:
+            print(f"Warning: Discarding unexpected message {message}")
+            return None
+
+        # Keep the entity map so later reports can be decoded on arrival
+        if isinstance(message, MEECU_Reporting_SetState) and message.entities:
+            self.entities = message.entities
+            self.decoder = message.get_decoder()
+
+        return message
+
+
+    def _ack_report(self, frame):
+        # Checked on the raw header so the ACK is sent before decoding
+        if frame[5] != MEECU_MessageClass.REPORTING.value or \
+           frame[6] != MEECU_ReportingCommands.SEND_REPORT.value:
+            return
+
+        self._reports_since_ack += 1
+        if self._reports_since_ack >= self.ack_every:
+            self._reports_since_ack = 0
+            with self._write_lock:
+                self.handle.write(self._ack_bytes)
+            if self.stats is not None:
+                self.stats.bytes_out += len(self._ack_bytes)
+
+
+    def _reader_loop(self):
+        try:
+            while not self._stop_reader.is_set():
+                # Blocks for at most the poll interval if nothing is waiting
+                data = self.handle.read(max(1, self.handle.in_waiting))
+                if not data:
+                    continue
+
+                if self.stats is not None:
+                    self.stats.bytes_in += len(data)
+                self.framer.feed(data)
+                for frame in self.framer:
+                    self._reader_frame(frame)
+        except Exception as err:
+            print(f"Reader for {self.device_path} stopped: {err}")
+        finally:
+            # Wake anything waiting on reports that will now never arrive
+            self.reports.close()
+
+
+    def _reader_frame(self, frame):
+        # A frame that can't be handled, e.g. a report that doesn't match
+        # the entity map, mustn't stop the reader
+        try:
+            message = self._handle_frame(frame)
+        except Exception as err:
+            self.frame_errors += 1
+            print(f"Warning: Discarding frame that could not be handled: {err}")
+            return
+
+        if message is not None:
+            with self._response_ready:
+                self._responses.append(message)
+                self._response_ready.notify_all()
+
+
+    def receive_report(self):
+        # Reports queued while waiting for a response are returned first
+        report = self.reports.get(block=False)
+        if report is not None or self._reader is not None:
+            return report
+
+        while True:
+            frame = self.receive_message()
+            if frame is None:
+                return None
+
+            # Reports are queued, anything else is discarded
+            self._handle_frame(frame)
+            report = self.reports.get(block=False)
+            if report is not None:
+                return report
+
+
+    def _read_frame(self, deadline):
+        frame = self.framer.next_frame()
+
+        while frame is None:
+            if time.monotonic() >= deadline:
+                return None
+
+            # Blocks for at most the poll interval if nothing is waiting
+            data = self.handle.read(max(1, self.handle.in_waiting))
+            if data:
+                if self.stats is not None:
+                    self.stats.bytes_in += len(data)
+                self.framer.feed(data)
+                frame = self.framer.next_frame()
+
+        return frame
+
+
+    def receive_message(self):
+        frame = self.framer.next_frame()
+
+        # Drain whatever the port has buffered in one read until a complete
+        # frame is available
+        while frame is None:
+            waiting = self.handle.in_waiting
+            if waiting == 0:
+                return None
+
+            data = self.handle.read(waiting)
+            if self.stats is not None:
+                self.stats.bytes_in += len(data)
+            self.framer.feed(data)
+            frame = self.framer.next_frame()
+
+        return frame
+
+# --------------------------------------------------------------------------- #
+# Reporting Session                                                           #
+# --------------------------------------------------------------------------- #
+
+class MEECU_ReportingSession:
+    """
+    Enables reporting on a connection and streams the decoded reports, with
+    reports acknowledged automatically by the connection's reader.
+    """
+
+    def __init__(self, conn, ack_every=1, buffer_size=1024,
+                 policy=MEECU_ReportBuffer.DROP_OLDEST):
+        self.conn = conn
+        self.ack_every = ack_every
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.entities = []
+
+
+    def start(self, timeout=None):
+        self.conn.start_reader(self.buffer_size, self.policy)
+
+        # Enabled first so the very first reports are acknowledged too
+        self.conn.set_auto_ack(self.ack_every)
+
+        response = self.conn.send_raw(MEECU_Reporting_SetState.encoded(True),
+                                      timeout=timeout)
+        if response is None:
+            print("No response to reporting set state request!")
+            self.conn.set_auto_ack(0)
+            return False
+
+        self.entities = response.entities
+        return True
+
+
+    def stop(self):
+        self.conn.set_auto_ack(0)
+
+        self.conn.send_raw(MEECU_Reporting_SetState.encoded(False),
+                           recv=False)
+        self.conn.stop_reader()
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+    def __iter__(self):
+        return self.conn.iter_reports()
+
+# --------------------------------------------------------------------------- #
+# Pipelined Requests                                                          #
+# --------------------------------------------------------------------------- #
+
+class MEECU_RequestPipeline:
+    """
+    Sends one request per chunk with up to window requests in flight, rather
+    than waiting for each response before sending the next request. Chunks
+    are tuples starting with the two values (e.g. an id and byte offset) the
+    response echoes back, which key(response) returns to match it up.
+    Chunks whose response times out are requested again, up to retries
+    times. While the connection's reader is running, the window must not
+    exceed the 16 responses it holds.
+    """
+
+    def __init__(self, conn, rclass, command, window=8, retries=3,
+                 timeout=None):
+        self.conn = conn
+        self.rclass = rclass
+        self.command = command
+        self.window = window
+        self.retries = retries
+        self.timeout = timeout
+
+        # Requests sent by the last run, including retries
+        self.requests = 0
+
+
+    def run(self, chunks, request, key, complete):
+        """
+        Send request(chunk) for each chunk, passing each matching response
+        to complete(chunk, response), which returns False if the chunk has
+        to be requested again. Returns False once a chunk runs out of
+        retries.
+        """
+        chunks = iter(chunks)
+        retry = deque()
+        in_flight = {}
+        attempts = {}
+        self.requests = 0
+
+        while True:
+            while len(in_flight) < self.window:
+                if retry:
+                    chunk = retry.popleft()
+                else:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+
+                in_flight[chunk[:2]] = chunk
+                self.conn.send_raw(request(chunk), recv=False)
+                self.requests += 1
+
+            if not in_flight:
+                return True
+
+            response = self.conn.wait_for_response(self.rclass, self.command,
+                                                   self.timeout)
+            if response is None:
+                # Everything still in flight is assumed lost
+                failed = list(in_flight.values())
+                in_flight.clear()
+            else:
+                # Responses to chunks already received are ignored
+                chunk = in_flight.pop(key(response), None)
+                if chunk is None or complete(chunk, response):
+                    continue
+                failed = [chunk]
+
+            for chunk in failed:
+                chunk_key = chunk[:2]
+                attempts[chunk_key] = attempts.get(chunk_key, 0) + 1
+                if attempts[chunk_key] > self.retries:
+                    print(f"{self.command.desc} request for {chunk_key[0]} at "
+                          f"offset {chunk_key[1]} failed after "
+                          f"{self.retries} retries!")
+                    return False
+                retry.append(chunk)
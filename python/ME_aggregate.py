@@ -0,0 +1,143 @@
+import math
+import time
+from collections import namedtuple
+
+# --------------------------------------------------------------------------- #
+# Report Stream Stages                                                        #
+# --------------------------------------------------------------------------- #
+#
+# Generators for thinning out a stream of reports before it reaches a
+# display or uplink. Each stage takes and yields (timestamp, values) pairs,
+# where values is a dict of entity id (or subscription key) to value, or a
+# sequence as returned by MEECU_ReportDecoder.decode(). Stages keep a fixed
+# amount of state per entity, so they can be chained on an endless stream:
+#
+#   stream = timestamped(session)
+#   for timestamp, stats in aggregate(stream, 0.1):
+#       ...
+#
+# --------------------------------------------------------------------------- #
+
+MEECU_WindowStats = namedtuple('MEECU_WindowStats',
+                               ('min', 'max', 'mean', 'last', 'count'))
+
+# --------------------------------------------------------------------------- #
+
+def _items(values):
+    if isinstance(values, dict):
+        return values.items()
+    return enumerate(values)
+
+# --------------------------------------------------------------------------- #
+
+def timestamped(reports, clock=time.time):
+    """
+    Pair each report message with the time the connection received it, or
+    the time it was taken from the stream if it wasn't stamped. Reports
+    decoded by a subscription keep their values dict, otherwise the parsed
+    entities are keyed by entity id.
+    """
+    for report in reports:
+        values = report.values
+        if values is None:
+            values = {entity['id']: entity['value']
+                      for entity in report.entities}
+
+        received = report.received
+        yield (clock() if received is None else received), values
+
+# --------------------------------------------------------------------------- #
+
+def aggregate(stream, interval):
+    """
+    Summarise each entity over fixed windows of interval seconds, yielding
+    (window start, {key: MEECU_WindowStats}) for every window that received
+    reports. A window is yielded when the first report after it arrives, or
+    when the stream ends.
+    """
+    window = None
+    # key: [min, max, total, count, last]
+    accumulators = {}
+
+    for timestamp, values in stream:
+        start = math.floor(timestamp / interval) * interval
+
+        if start != window:
+            if accumulators:
+                yield window, _window_stats(accumulators)
+                accumulators = {}
+            window = start
+
+        for key, value in _items(values):
+            acc = accumulators.get(key)
+            if acc is None:
+                accumulators[key] = [value, value, value, 1, value]
+                continue
+
+            if value < acc[0]:
+                acc[0] = value
+            elif value > acc[1]:
+                acc[1] = value
+            acc[2] += value
+            acc[3] += 1
+            acc[4] = value
+
+    if accumulators:
+        yield window, _window_stats(accumulators)
+
+# --------------------------------------------------------------------------- #
+
+def _window_stats(accumulators):
+    return {key: MEECU_WindowStats(low, high, total / count, last, count)
+            for key, (low, high, total, count, last) in accumulators.items()}
+
+# --------------------------------------------------------------------------- #
+
+def decimate(stream, every=None, interval=None):
+    """
+    Pass on every Nth item, or the first item in each interval seconds.
+    Intermediate values are discarded, so use aggregate() where peaks
+    matter.
+    """
+    if (every is None) == (interval is None):
+        raise ValueError("Exactly one of every and interval must be given")
+
+    if every is not None:
+        for i, item in enumerate(stream):
+            if i % every == 0:
+                yield item
+        return
+
+    next_time = None
+    for item in stream:
+        if next_time is None or item[0] >= next_time:
+            next_time = item[0] + interval
+            yield item
+
+# --------------------------------------------------------------------------- #
+
+def on_change(stream, deadband=0.0):
+    """
+    Yield (timestamp, changed) holding only the values that moved by more
+    than the deadband since they were last passed on. The deadband is either
+    one value for every entity, or a dict of key to deadband with anything
+    missing passed on whenever it changes. Items with no changes are
+    dropped, and the first item is always passed on in full.
+    """
+    last = {}
+    per_key = isinstance(deadband, dict)
+
+    for timestamp, values in stream:
+        changed = {}
+        for key, value in _items(values):
+            previous = last.get(key)
+            if previous is not None:
+                band = deadband.get(key, 0.0) if per_key else deadband
+                if abs(value - previous) <= band:
+                    continue
+
+            last[key] = value
+            changed[key] = value
+
+        if changed:
+            yield timestamp, changed
@@ -0,0 +1,232 @@
+import asyncio
+import time
+from collections import deque
+
+import serial
+from serial.serialutil import SerialException
+
+from ME import MEECU_Framer, MEECU_Message, MEECU_MessageType, \
+               MEECU_Reporting_SendAck, MEECU_Reporting_SendReport, \
+               MEECU_Reporting_SetState, MEECU_ReportingCommands, \
+               MEECU_MessageClass, class_by_value, command_by_value
+
+# --------------------------------------------------------------------------- #
+# asyncio Serial Interface                                                    #
+# --------------------------------------------------------------------------- #
+
+class MEECU_AsyncConnection:
+    """
+    asyncio counterpart of MEECU_Connection. The port is opened non-blocking
+    and watched with loop.add_reader(), so any number of ECUs can be served
+    from a single event loop without a thread per port.
+    """
+
+    device_path = None
+    baud_rate   = None
+    handle      = None
+    decoder     = None
+
+    def __init__(self, device_path, baud_rate, timeout=1.0, queue_size=1024):
+        self.device_path = device_path
+        self.baud_rate = baud_rate
+        self.timeout = timeout
+        self.framer = MEECU_Framer()
+        self.reports_dropped = 0
+
+        self._loop = None
+        self._queue_size = queue_size
+        self._reports = None
+
+        # (class, command) to the futures of requests awaiting a response,
+        # oldest first, as responses to the same request come back in order
+        self._pending = {}
+        # (class, command) to the number of responses still due to requests
+        # that timed out while later ones were in flight, which are dropped
+        # rather than handed to the later requests
+        self._stale = {}
+
+        # Frames that couldn't be handled, e.g. a report not matching the
+        # entity map
+        self.frame_errors = 0
+
+        self.ack_every = 0
+        self._reports_since_ack = 0
+        self._ack_bytes = MEECU_Reporting_SendAck.encoded()
+
+    # ----------------------------------------------------------------------- #
+
+    async def connect(self):
+        try:
+            # A zero timeout makes reads return whatever is already buffered
+            self.handle = serial.Serial(self.device_path, self.baud_rate,
+                                        timeout=0)
+        except SerialException as err:
+            print(f"Exception when connecting: {err}")
+            return False
+
+        if not self.handle.is_open:
+            print("Failed to open serial port!")
+            return False
+
+        self._loop = asyncio.get_running_loop()
+        self._reports = asyncio.Queue(self._queue_size)
+        self._loop.add_reader(self.handle.fileno(), self._on_readable)
+        return True
+
+    # ----------------------------------------------------------------------- #
+
+    def close(self):
+        if self.handle is None:
+            return
+
+        self._loop.remove_reader(self.handle.fileno())
+        self.handle.close()
+        self.handle = None
+
+        for futures in self._pending.values():
+            for future in futures:
+                future.cancel()
+        self._pending.clear()
+        self._stale.clear()
+
+        # Ends iteration over reports() once the queued reports are read
+        self._put_report(None)
+
+    # ----------------------------------------------------------------------- #
+
+    def set_auto_ack(self, every=1):
+        self.ack_every = every
+        self._reports_since_ack = 0
+
+    # ----------------------------------------------------------------------- #
+
+    def send(self, message):
+        self.handle.write(message.to_bytes())
+
+    # ----------------------------------------------------------------------- #
+
+    async def request(self, message, timeout=None):
+        """
+        Send a request and wait for the response with the same class and
+        command. Returns None if none arrives before the timeout.
+        """
+        return await self.request_raw(message.to_bytes(), timeout)
+
+    # ----------------------------------------------------------------------- #
+
+    async def request_raw(self, data, timeout=None):
+        """As request(), for an already encoded message."""
+        if timeout is None:
+            timeout = self.timeout
+
+        key = (class_by_value.get(data[5]),
+               command_by_value.get((data[5], data[6])))
+        future = self._loop.create_future()
+        futures = self._pending.setdefault(key, deque())
+        if not futures:
+            # Nothing in flight, so any late response has been dropped
+            self._stale.pop(key, None)
+        futures.append(future)
+        self.handle.write(data)
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # Its response may still arrive ahead of those to later requests
+            if any(other is not future for other in futures):
+                self._stale[key] = self._stale.get(key, 0) + 1
+            return None
+        finally:
+            if future in futures:
+                futures.remove(future)
+            if not futures and self._pending.get(key) is futures:
+                del self._pending[key]
+
+    # ----------------------------------------------------------------------- #
+
+    async def start_reporting(self, ack_every=1, timeout=None):
+        self.set_auto_ack(ack_every)
+
+        response = await self.request_raw(
+            MEECU_Reporting_SetState.encoded(True), timeout)
+        if response is None:
+            self.set_auto_ack(0)
+        return response
+
+    # ----------------------------------------------------------------------- #
+
+    async def reports(self):
+        """Yield reports as they arrive, until the connection is closed."""
+        while True:
+            report = await self._reports.get()
+            if report is None:
+                # Left in place for any other consumer
+                self._put_report(None)
+                return
+            yield report
+
+    # ----------------------------------------------------------------------- #
+
+    def _on_readable(self):
+        data = self.handle.read(self.handle.in_waiting or 1)
+        if not data:
+            return
+
+        self.framer.feed(data)
+        for frame in self.framer:
+            # A frame that can't be handled mustn't stop the reader
+            try:
+                self._handle_frame(frame)
+            except Exception as err:
+                self.frame_errors += 1
+                print(f"Warning: Discarding frame that could not be handled: {err}")
+
+    # ----------------------------------------------------------------------- #
+
+    def _handle_frame(self, frame):
+        is_report = frame[5] == MEECU_MessageClass.REPORTING.value and \
+                    frame[6] == MEECU_ReportingCommands.SEND_REPORT.value
+
+        if is_report and self.ack_every:
+            self._reports_since_ack += 1
+            if self._reports_since_ack >= self.ack_every:
+                self._reports_since_ack = 0
+                self.handle.write(self._ack_bytes)
+
+        message = MEECU_Message.from_data(frame, verified=True)
+        if message is None:
+            return
+
+        if isinstance(message, MEECU_Reporting_SendReport):
+            message.received = time.time()
+            if self.decoder is not None:
+                message.parse_report(self.decoder)
+            self._put_report(message)
+            return
+
+        if message.rtype is not MEECU_MessageType.RESPONSE:
+            return
+
+        if isinstance(message, MEECU_Reporting_SetState) and message.entities:
+            self.decoder = message.get_decoder()
+
+        key = (message.rclass, message.command)
+        if self._stale.get(key):
+            self._stale[key] -= 1
+            return
+
+        futures = self._pending.get(key)
+        while futures:
+            future = futures.popleft()
+            if not future.done():
+                future.set_result(message)
+                break
+
+    # ----------------------------------------------------------------------- #
+
+    def _put_report(self, message):
+        # Drop the oldest report rather than stall the event loop
+        if self._reports.full():
+            self._reports.get_nowait()
+            self.reports_dropped += 1
+        self._reports.put_nowait(message)
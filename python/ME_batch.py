@@ -0,0 +1,160 @@
+import struct
+import numpy as np
+
+from ME import MEECU_ReportingType, MEECU_MessageClass, \
+               MEECU_ReportingCommands
+
+# --------------------------------------------------------------------------- #
+# Columnar Report Decoding                                                    #
+# --------------------------------------------------------------------------- #
+
+# NumPy equivalents of each reporting type, all little endian and unaligned
+reporting_type_dtype = {
+    MEECU_ReportingType.FLOAT_4B: '<f4',
+    MEECU_ReportingType.INT_2B:   '<i2',
+    MEECU_ReportingType.UINT_2B:  '<u2',
+    MEECU_ReportingType.INT_1B:   'i1',
+    MEECU_ReportingType.UINT_1B:  'u1',
+    MEECU_ReportingType.BOOL_1B:  '?',
+}
+
+HEADER_FIELDS = [
+    ('magic',   'S2'),
+    ('length',  '<u2'),
+    ('type',    'u1'),
+    ('class',   'u1'),
+    ('command', 'u1'),
+]
+
+# --------------------------------------------------------------------------- #
+
+def entity_field(entity_id):
+    return f"e{entity_id}"
+
+# --------------------------------------------------------------------------- #
+
+def payload_dtype(entities):
+    """
+    Structured dtype of a SendReport payload for the given entity map, with
+    one field per entity named by entity_field().
+    """
+    fields = [('flags', 'u1')]
+    for entity in entities:
+        etype = MEECU_ReportingType(entity['type'])
+        fields.append((entity_field(entity['id']),
+                       reporting_type_dtype[etype]))
+    return np.dtype(fields)
+
+# --------------------------------------------------------------------------- #
+
+def frame_dtype(entities):
+    """Structured dtype of a complete SendReport frame, header to CRC."""
+    fields = list(HEADER_FIELDS)
+    fields.extend(payload_dtype(entities).descr)
+    fields.append(('crc', '<u2'))
+    return np.dtype(fields)
+
+# --------------------------------------------------------------------------- #
+
+def decode_reports(data, entities):
+    """
+    Decode a buffer of back-to-back SendReport frames into a structured
+    array with one record per frame. The buffer isn't copied, so the array
+    is a read-only view when given bytes.
+    """
+    dtype = frame_dtype(entities)
+    if len(data) % dtype.itemsize:
+        raise ValueError(f"Buffer length {len(data)} is not a multiple of "
+                         f"the {dtype.itemsize} byte report frame")
+
+    records = np.frombuffer(data, dtype=dtype)
+
+    valid = (records['magic'] == b'ME') & \
+            (records['length'] == dtype.itemsize - 9) & \
+            (records['class'] == MEECU_MessageClass.REPORTING.value) & \
+            (records['command'] == MEECU_ReportingCommands.SEND_REPORT.value)
+    if not valid.all():
+        bad = int(np.argmin(valid))
+        raise ValueError(f"Frame {bad} is not a report matching the entity map")
+
+    return records
+
+# --------------------------------------------------------------------------- #
+
+def decode_payloads(data, entities):
+    """
+    Decode a buffer of back-to-back SendReport payloads, without the frame
+    header and CRC.
+    """
+    return np.frombuffer(data, dtype=payload_dtype(entities))
+
+# --------------------------------------------------------------------------- #
+
+def report_columns(records, entities):
+    """Split decoded records into a dict of entity id to column array."""
+    return {entity['id']: records[entity_field(entity['id'])]
+            for entity in entities}
+
+# --------------------------------------------------------------------------- #
+# Bulk CRC Verification                                                       #
+# --------------------------------------------------------------------------- #
+
+def frame_offsets(data):
+    """
+    Walk the length fields of back-to-back frames, returning arrays of the
+    start offset and payload length of each complete frame.
+    """
+    starts = []
+    lengths = []
+    offset = 0
+    end = len(data)
+    while offset + 9 <= end:
+        length, = struct.unpack_from('<H', data, offset + 2)
+        if offset + 9 + length > end:
+            break
+        starts.append(offset)
+        lengths.append(length)
+        offset += 9 + length
+
+    return np.array(starts, dtype=np.int64), np.array(lengths, dtype=np.int64)
+
+# --------------------------------------------------------------------------- #
+
+def frame_crcs(data, starts, lengths):
+    """
+    Calculate the CRC of many frames at once. The checksum covers the type,
+    class and command bytes followed by the payload, and the running sum
+    term is computed as each byte weighted by its distance from the end.
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.uint16)
+
+    counts = lengths + 3
+    total = int(counts.sum())
+    segments = np.cumsum(counts) - counts
+
+    # Position of every covered byte relative to the start of its segment
+    relative = np.arange(total, dtype=np.int64) - np.repeat(segments, counts)
+    values = buffer[np.repeat(starts + 4, counts) + relative].astype(np.int64)
+    weights = np.repeat(counts, counts) - relative
+
+    num = np.add.reduceat(values, segments) % 255
+    num2 = np.add.reduceat(values * weights, segments) % 255
+    return ((num2 << 8) | num).astype(np.uint16)
+
+# --------------------------------------------------------------------------- #
+
+def verify_frames(data):
+    """
+    Check the trailing CRC of every frame in a buffer of back-to-back frames.
+    Returns the frame start offsets and a boolean array of which are valid.
+    """
+    starts, lengths = frame_offsets(data)
+    buffer = np.frombuffer(data, dtype=np.uint8)
+
+    crc_offsets = starts + 7 + lengths
+    received = buffer[crc_offsets].astype(np.uint16) | \
+               (buffer[crc_offsets + 1].astype(np.uint16) << 8)
+
+    return starts, frame_crcs(data, starts, lengths) == received
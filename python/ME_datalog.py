@@ -0,0 +1,254 @@
+import json
+import os
+import struct
+import time
+
+from ME import MEECU_MessageClass, MEECU_DatalogCommands, \
+               MEECU_TriglogCommands, MEECU_Datalog_GetLogs, \
+               MEECU_Datalog_GetLogDetail, MEECU_Datalog_GetLogRegion, \
+               MEECU_Triglog_SetState, MEECU_RequestPipeline
+from ME_session import MEECU_SessionWriter, to_timestamp_us
+
+# --------------------------------------------------------------------------- #
+# Data Log Download                                                           #
+# --------------------------------------------------------------------------- #
+#
+# Next to each download, a small JSON file records which log it came from,
+# as the log id, start time and size. A download is only resumed if the log
+# on the ECU still matches, as a log erased and recorded again with the
+# same entity map would otherwise be joined on to the old one.
+#
+# --------------------------------------------------------------------------- #
+
+def origin_path(path):
+    return path + '.origin'
+
+# --------------------------------------------------------------------------- #
+
+def read_origin(path):
+    try:
+        with open(origin_path(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_DatalogDownloader:
+    """
+    Downloads onboard logs into session files, reading chunk_size bytes per
+    request with up to window requests in flight. Records are written as
+    soon as every chunk before them has arrived, so only the chunks in
+    flight are ever held in memory.
+
+    A download that was interrupted (e.g. the cable was pulled) can be
+    resumed by downloading to the same path again, which carries on after
+    the last whole record written if the log on the ECU is unchanged.
+    """
+
+    def __init__(self, conn, chunk_size=192, window=8, retries=3,
+                 timeout=None):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.window = window
+        self.retries = retries
+        self.timeout = timeout
+
+        # Records already on disk when the last download started, and the
+        # region requests it sent
+        self.resumed = 0
+        self.requests = 0
+
+    # ----------------------------------------------------------------------- #
+
+    def list_logs(self):
+        """Return a list of {'id', 'size'} for each log, or None."""
+        response = self.conn.send_raw(MEECU_Datalog_GetLogs.encoded(),
+                                      timeout=self.timeout)
+        if response is None:
+            print("No response to get logs request!")
+            return None
+        return response.logs
+
+    # ----------------------------------------------------------------------- #
+
+    def log_detail(self, log_id):
+        response = self.conn.send_raw(
+            MEECU_Datalog_GetLogDetail.request(log_id).to_bytes(),
+            timeout=self.timeout)
+        if response is None:
+            print(f"No response to log detail request for log {log_id}!")
+        return response
+
+    # ----------------------------------------------------------------------- #
+
+    def download(self, log_id, path, index_interval=1000, progress=None):
+        """
+        Download a log to a session file, returning the number of records
+        in it, or None if the download failed part way. progress(records,
+        total) is called as records are written.
+        """
+        detail = self.log_detail(log_id)
+        if detail is None:
+            return None
+
+        record_size = detail.record_size
+        if record_size <= 0:
+            print(f"Log {log_id} has no entities!")
+            return None
+
+        origin = {'log_id': log_id, 'start_time': detail.start_time,
+                  'size': detail.size}
+        if os.path.exists(path) and os.path.getsize(path) > 0 and \
+           read_origin(path) != origin:
+            print(f"Cannot resume download of log {log_id}: {path} was "
+                  f"downloaded from a different log!")
+            return None
+
+        try:
+            writer = MEECU_SessionWriter(path, detail.entities,
+                                         record_size + 1, index_interval)
+        except ValueError as err:
+            print(f"Cannot resume download of log {log_id}: {err}")
+            return None
+
+        with open(origin_path(path), 'w') as f:
+            json.dump(origin, f)
+
+        # A partial record at the end of the log is left out
+        total = detail.size // record_size
+        self.resumed = writer.count
+        self.requests = 0
+
+        if writer.count > total:
+            print(f"{path} holds more records than log {log_id}!")
+            writer.close()
+            return None
+
+        end = total * record_size
+        chunks = ((log_id, offset, min(self.chunk_size, end - offset))
+                  for offset in range(writer.count * record_size, end,
+                                      self.chunk_size))
+
+        # Chunks that arrived ahead of one still outstanding, by offset
+        pending = {}
+        # Bytes of a record split across chunks
+        partial = bytearray()
+        next_offset = writer.count * record_size
+
+        def complete(chunk, response):
+            nonlocal next_offset
+            _, offset, length = chunk
+            if len(response.log_data) != length:
+                return False
+
+            pending[offset] = response.log_data
+            while next_offset in pending:
+                data = pending.pop(next_offset)
+                next_offset += len(data)
+                partial.extend(data)
+
+                whole = len(partial) - len(partial) % record_size
+                for start in range(0, whole, record_size):
+                    writer.write(b'\x00' + partial[start:start + record_size],
+                                 detail.start_time +
+                                 writer.count * detail.interval)
+                del partial[:whole]
+
+            if progress is not None:
+                progress(writer.count, total)
+            return True
+
+        def request(chunk):
+            return MEECU_Datalog_GetLogRegion.request(*chunk).to_bytes()
+
+        pipeline = MEECU_RequestPipeline(self.conn, MEECU_MessageClass.DATALOG,
+                                         MEECU_DatalogCommands.GET_LOG_REGION,
+                                         self.window, self.retries,
+                                         self.timeout)
+        try:
+            done = pipeline.run(chunks, request,
+                                lambda response: (response.log_id,
+                                                  response.offset),
+                                complete)
+        finally:
+            # Whatever was written is kept for the download to be resumed
+            writer.close()
+            self.requests = pipeline.requests
+
+        return writer.count if done else None
+
+# --------------------------------------------------------------------------- #
+# Trigger Log Capture                                                         #
+# --------------------------------------------------------------------------- #
+#
+# Trigger log blocks are written as they arrive, each as a timestamp
+# (int64, microseconds), the block length (ushort), then the block:
+#
+#   f.write(TRIGGER_RECORD.pack(timestamp_us, len(block)) + block)
+#
+# --------------------------------------------------------------------------- #
+
+TRIGGER_RECORD = struct.Struct('<qH')
+
+# --------------------------------------------------------------------------- #
+
+def capture_trigger_log(conn, path, blocks=None, duration=None, timeout=None):
+    """
+    Enable trigger logging and append each block the ECU sends to a file,
+    until blocks have been captured, duration seconds have passed or no
+    block arrives within the timeout. Returns the number of blocks captured,
+    or None if trigger logging could not be enabled.
+    """
+    response = conn.send_raw(MEECU_Triglog_SetState.encoded(True),
+                             timeout=timeout)
+    if response is None:
+        print("No response to trigger log set state request!")
+        return None
+
+    if timeout is None:
+        timeout = conn.timeout
+    deadline = None if duration is None else time.monotonic() + duration
+    captured = 0
+
+    try:
+        with open(path, 'ab') as f:
+            while blocks is None or captured < blocks:
+                wait = timeout
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    wait = min(wait, remaining)
+
+                report = conn.wait_for_response(MEECU_MessageClass.TRIGLOG,
+                                                MEECU_TriglogCommands.REPORT,
+                                                wait)
+                if report is None:
+                    break
+
+                f.write(TRIGGER_RECORD.pack(to_timestamp_us(time.time()),
+                                            len(report.payload)))
+                f.write(report.payload)
+                captured += 1
+    finally:
+        conn.send_raw(MEECU_Triglog_SetState.encoded(False), recv=False)
+
+    return captured
+
+# --------------------------------------------------------------------------- #
+
+def read_trigger_log(path):
+    """Yield (timestamp, block) for each block in a trigger log file."""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(TRIGGER_RECORD.size)
+            if len(header) < TRIGGER_RECORD.size:
+                return
+
+            timestamp_us, length = TRIGGER_RECORD.unpack(header)
+            block = f.read(length)
+            if len(block) < length:
+                # Cut short while it was being written
+                return
+            yield timestamp_us / 1_000_000, block
@@ -0,0 +1,179 @@
+import struct
+import time
+
+from ME import MEECU_ReportingType
+
+# --------------------------------------------------------------------------- #
+# Delta Encoding                                                              #
+# --------------------------------------------------------------------------- #
+#
+# Consecutive reports mostly repeat the previous values, so after a keyframe
+# holding the full payload only the fields that changed are sent:
+#
+#   Keyframe    FRAME_KEY, payload
+#   Delta       FRAME_DELTA, bitmap of changed fields (1 bit per field,
+#               little endian), changed field bytes in entity map order
+#
+# Fields are the leading payload byte followed by each entity, and are
+# compared as raw bytes so float values round trip exactly.
+#
+# --------------------------------------------------------------------------- #
+
+FRAME_KEY   = 0x00
+FRAME_DELTA = 0x01
+
+# Stream framing used when delta frames are written to a file or socket
+STREAM_RECORD = struct.Struct('<qH')
+
+# --------------------------------------------------------------------------- #
+
+def field_widths(decoder):
+    return [1] + [MEECU_ReportingType(etype)._length
+                  for etype in decoder.types]
+
+# --------------------------------------------------------------------------- #
+
+def field_struct(decoder):
+    """Struct splitting a report payload into the raw bytes of each field."""
+    return struct.Struct(''.join(f'{width}s'
+                                 for width in field_widths(decoder)))
+
+# --------------------------------------------------------------------------- #
+# Encoder                                                                     #
+# --------------------------------------------------------------------------- #
+
+class MEECU_DeltaEncoder:
+
+    def __init__(self, decoder, keyframe_interval=100):
+        self.fields = field_struct(decoder)
+        self.field_count = len(decoder.types) + 1
+        self.bitmap_length = (self.field_count + 7) // 8
+        self.keyframe_interval = keyframe_interval
+
+        self._previous = None
+        self._since_keyframe = 0
+
+    # ----------------------------------------------------------------------- #
+
+    def force_keyframe(self):
+        """Make the next frame a keyframe, e.g. for a new subscriber."""
+        self._previous = None
+
+    # ----------------------------------------------------------------------- #
+
+    def encode(self, payload):
+        current = self.fields.unpack(payload)
+        previous = self._previous
+        self._previous = current
+
+        if previous is None or self._since_keyframe >= self.keyframe_interval:
+            self._since_keyframe = 1
+            return bytes([FRAME_KEY]) + bytes(payload)
+        self._since_keyframe += 1
+
+        bitmap = 0
+        changed = []
+        for i, (new, old) in enumerate(zip(current, previous)):
+            if new != old:
+                bitmap |= 1 << i
+                changed.append(new)
+
+        return bytes([FRAME_DELTA]) + \
+               bitmap.to_bytes(self.bitmap_length, 'little') + \
+               b''.join(changed)
+
+# --------------------------------------------------------------------------- #
+# Decoder                                                                     #
+# --------------------------------------------------------------------------- #
+
+class MEECU_DeltaDecoder:
+
+    def __init__(self, decoder):
+        self.fields = field_struct(decoder)
+        self.field_count = len(decoder.types) + 1
+        self.bitmap_length = (self.field_count + 7) // 8
+        self.widths = field_widths(decoder)
+
+        self._current = None
+
+    # ----------------------------------------------------------------------- #
+
+    def decode(self, frame):
+        """
+        Return the full report payload for an encoded frame, or None for a
+        delta received before any keyframe.
+        """
+        if frame[0] == FRAME_KEY:
+            payload = bytes(frame[1:])
+            self._current = list(self.fields.unpack(payload))
+            return payload
+
+        if frame[0] != FRAME_DELTA:
+            raise ValueError(f"Unknown delta frame type {frame[0]:#04x}")
+
+        if self._current is None:
+            return None
+
+        current = self._current
+        bitmap = int.from_bytes(frame[1:1 + self.bitmap_length], 'little')
+        offset = 1 + self.bitmap_length
+        field = 0
+        while bitmap:
+            if bitmap & 1:
+                width = self.widths[field]
+                current[field] = bytes(frame[offset:offset + width])
+                offset += width
+            bitmap >>= 1
+            field += 1
+
+        return b''.join(current)
+
+# --------------------------------------------------------------------------- #
+# Streams                                                                     #
+# --------------------------------------------------------------------------- #
+
+class MEECU_DeltaRecorder:
+    """
+    Connection recorder writing delta encoded reports to a binary stream,
+    each prefixed with its timestamp and length.
+    """
+
+    def __init__(self, stream, decoder, keyframe_interval=100):
+        self.stream = stream
+        self.encoder = MEECU_DeltaEncoder(decoder, keyframe_interval)
+
+    # ----------------------------------------------------------------------- #
+
+    def write(self, payload, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        frame = self.encoder.encode(payload)
+        self.stream.write(STREAM_RECORD.pack(int(round(timestamp * 1_000_000)),
+                                             len(frame)))
+        self.stream.write(frame)
+
+    # ----------------------------------------------------------------------- #
+
+    def close(self):
+        self.stream.close()
+
+# --------------------------------------------------------------------------- #
+
+def read_delta_stream(stream, decoder):
+    """Yield (timestamp, payload) from a stream written by MEECU_DeltaRecorder."""
+    delta_decoder = MEECU_DeltaDecoder(decoder)
+
+    while True:
+        record = stream.read(STREAM_RECORD.size)
+        if len(record) < STREAM_RECORD.size:
+            return
+
+        timestamp_us, length = STREAM_RECORD.unpack(record)
+        frame = stream.read(length)
+        if len(frame) < length:
+            return
+
+        payload = delta_decoder.decode(frame)
+        if payload is not None:
+            yield timestamp_us / 1_000_000, payload
@@ -0,0 +1,238 @@
+import time
+from collections import namedtuple
+
+from ME import MEECU_ConnectionStats, MEECU_ReportingSession, \
+               MEECU_Sys_GetECUInfo
+
+# --------------------------------------------------------------------------- #
+# Link Probing                                                                #
+# --------------------------------------------------------------------------- #
+#
+# The protocol has no command to change the ECU's baud rate, so the host
+# has to find the rate the ECU is using by trying the port at each
+# candidate and measuring how the link holds up: request round trips first,
+# then a burst of reports. A rate that doesn't match the ECU's, or that the
+# harness can't carry, shows up as timed out requests, CRC failures and
+# resyncs, which make up the error rate:
+#
+#   (timeouts + resyncs) / (frames received + timeouts + CRC failures)
+#
+# The framer resyncs after every CRC failure, so CRC failures are already
+# counted as errors through the resyncs, along with bad headers and lengths.
+#
+# --------------------------------------------------------------------------- #
+
+BAUD_RATES = (57600, 115200, 230400, 460800, 921600)
+
+# Counters from MEECU_ConnectionStats.snapshot() the error rate is made of
+ERROR_COUNTERS = ('frames', 'timeouts', 'crc_failures', 'resyncs')
+
+MEECU_LinkResult = namedtuple('MEECU_LinkResult',
+                              ('baud_rate', 'round_trips', 'rtt', 'reports',
+                               'bytes_per_s', 'reports_per_s', 'error_rate'))
+
+# --------------------------------------------------------------------------- #
+
+def error_rate(*snapshots):
+    """Error rate over one or more stats snapshots, or deltas of them."""
+    frames, timeouts, crc_failures, resyncs = (
+        sum(snapshot[key] for snapshot in snapshots)
+        for key in ERROR_COUNTERS)
+
+    attempts = frames + timeouts + crc_failures
+    if not attempts:
+        return 0.0
+    return min(1.0, (timeouts + resyncs) / attempts)
+
+# --------------------------------------------------------------------------- #
+
+def _delta(current, base):
+    return {key: current[key] - base[key] for key in ERROR_COUNTERS}
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_LinkProbe:
+    """
+    Measures the link at each candidate baud rate with round_trips ECU info
+    requests and burst seconds of reporting, and switches the connection to
+    the fastest rate whose error rate is within max_error_rate. Reporting
+    and the reader must be stopped while probing.
+
+    Probing isn't free: each rate the ECU isn't using costs give_up timed
+    out requests (0.6 s by default) before it is abandoned, and a rate that
+    answers costs round_trips round trips plus the burst. With the default
+    candidates, an ECU at 115200 is found in about 3 s.
+    """
+
+    def __init__(self, conn, candidates=BAUD_RATES, round_trips=20,
+                 burst=1.0, max_error_rate=0.01, timeout=0.2, give_up=3):
+        self.conn = conn
+        self.candidates = sorted(candidates, reverse=True)
+        self.round_trips = round_trips
+        self.burst = burst
+        self.max_error_rate = max_error_rate
+        self.timeout = timeout
+        self.give_up = give_up
+
+        # MEECU_LinkResult for each rate measured by the last select()
+        self.results = []
+
+    # ----------------------------------------------------------------------- #
+
+    def measure(self, baud_rate):
+        """Return a MEECU_LinkResult for one rate, or None if it can't be set."""
+        conn = self.conn
+        if not conn.set_baud_rate(baud_rate):
+            return None
+
+        # Measured separately so stats the caller has enabled aren't reset
+        previous = conn.stats
+        stats = conn.stats = MEECU_ConnectionStats(conn)
+        try:
+            request = MEECU_Sys_GetECUInfo.encoded()
+            for i in range(self.round_trips):
+                conn.send_raw(request, timeout=self.timeout)
+
+                # Nothing at all comes back at a rate the ECU isn't using
+                if i + 1 == self.give_up and not stats.responses:
+                    trips = stats.snapshot()
+                    return MEECU_LinkResult(baud_rate, 0, None, 0, 0.0, 0.0,
+                                            error_rate(trips))
+            trips = stats.snapshot()
+
+            stats.reset()
+            start = time.monotonic()
+            session = MEECU_ReportingSession(conn)
+            if session.start(self.timeout):
+                time.sleep(self.burst)
+                session.stop()
+            else:
+                conn.stop_reader()
+            elapsed = time.monotonic() - start
+            burst = stats.snapshot()
+        finally:
+            conn.stats = previous
+
+        return MEECU_LinkResult(
+            baud_rate, trips['responses'], trips['rtt']['p50'],
+            burst['reports'], burst['bytes_in'] / elapsed,
+            burst['reports'] / elapsed, error_rate(trips, burst))
+
+    # ----------------------------------------------------------------------- #
+
+    def reliable(self, result):
+        return result is not None and result.round_trips > 0 and \
+               result.error_rate <= self.max_error_rate
+
+    # ----------------------------------------------------------------------- #
+
+    def select(self):
+        """
+        Probe from the fastest candidate down, leaving the connection at the
+        first reliable rate. Returns its MEECU_LinkResult, or None with the
+        original rate restored if no rate is reliable.
+        """
+        original = self.conn.baud_rate
+        self.results = []
+
+        for baud_rate in self.candidates:
+            result = self.measure(baud_rate)
+            if result is None:
+                continue
+
+            self.results.append(result)
+            if self.reliable(result):
+                return result
+
+        print("Warning: No reliable baud rate found!")
+        self.conn.set_baud_rate(original)
+        return None
+
+# --------------------------------------------------------------------------- #
+# Link Monitor                                                                #
+# --------------------------------------------------------------------------- #
+
+class MEECU_LinkMonitor:
+    """
+    Watches the error rate of a connection in use and reconnects once it
+    exceeds max_error_rate. check() is meant to be called regularly, e.g.
+    for every report, and only judges the link once min_frames have been
+    received since the last judgement.
+
+    The ECU's baud rate can't be changed from the host, so reconnecting
+    restarts the reporting session (if one is given) at the current rate,
+    with anything received so far discarded. Only if the ECU then doesn't
+    answer, e.g. because it was reset to another rate, is its rate found
+    again with the probe, a MEECU_LinkProbe over BAUD_RATES by default.
+    """
+
+    def __init__(self, conn, session=None, probe=None, max_error_rate=0.05,
+                 min_frames=100):
+        self.conn = conn
+        self.session = session
+        self.probe = probe if probe is not None else MEECU_LinkProbe(conn)
+        self.max_error_rate = max_error_rate
+        self.min_frames = min_frames
+
+        self.error_rate = 0.0
+        self.reconnects = 0
+
+        if conn.stats is None:
+            conn.enable_stats()
+        self._base = conn.stats.snapshot()
+
+    # ----------------------------------------------------------------------- #
+
+    def check(self):
+        """Return the baud rate if the link was reconnected, else None."""
+        current = self.conn.stats.snapshot()
+        delta = _delta(current, self._base)
+        if delta['frames'] + delta['timeouts'] < self.min_frames:
+            return None
+
+        self._base = current
+        self.error_rate = error_rate(delta)
+        if self.error_rate <= self.max_error_rate:
+            return None
+
+        print(f"Link error rate {self.error_rate:.1%}, reconnecting")
+        return self.reconnect()
+
+    # ----------------------------------------------------------------------- #
+
+    def reconnect(self):
+        """
+        Restart the link at the current rate, or at the rate found by the
+        probe if the ECU doesn't answer. Returns the rate, or None if the
+        ECU couldn't be reached at all.
+        """
+        if self.session is not None:
+            self.session.stop()
+
+        # Setting the same rate again drops whatever was half received
+        if self.conn.set_baud_rate(self.conn.baud_rate) and \
+           self._restart_session():
+            return self._reconnected()
+
+        print(f"No response at {self.conn.baud_rate} baud, probing")
+        if self.probe.select() is None or not self._restart_session():
+            print("Warning: Could not reconnect to the ECU!")
+            return None
+        return self._reconnected()
+
+    # ----------------------------------------------------------------------- #
+
+    def _restart_session(self):
+        if self.session is not None:
+            return self.session.start()
+
+        response = self.conn.send_raw(MEECU_Sys_GetECUInfo.encoded(),
+                                      timeout=self.probe.timeout)
+        return response is not None
+
+    # ----------------------------------------------------------------------- #
+
+    def _reconnected(self):
+        self.reconnects += 1
+        self._base = self.conn.stats.snapshot()
+        return self.conn.baud_rate
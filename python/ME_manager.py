@@ -0,0 +1,207 @@
+import heapq
+import multiprocessing
+import queue
+import struct
+import threading
+import time
+from collections import deque
+
+from ME import MEECU_Connection, MEECU_ReportingSession, MEECU_ReportDecoder
+
+# --------------------------------------------------------------------------- #
+# Multi-ECU Connection Manager                                                #
+# --------------------------------------------------------------------------- #
+
+EVENT_ENTITIES = 'entities'
+EVENT_REPORT   = 'report'
+EVENT_ERROR    = 'error'
+
+# --------------------------------------------------------------------------- #
+
+class _QueueRecorder:
+    """
+    Connection recorder forwarding raw report payloads to the manager. It is
+    called from the thread that handles the SetState response, so the entity
+    map is always queued ahead of the first report it describes.
+    """
+
+    def __init__(self, name, out_queue, conn):
+        self.name = name
+        self.out_queue = out_queue
+        self.conn = conn
+        self._entities = None
+
+    def write(self, payload, timestamp):
+        if self.conn.entities is not self._entities:
+            self._entities = self.conn.entities
+            self.out_queue.put((EVENT_ENTITIES, self.name, self._entities))
+
+        self.out_queue.put((EVENT_REPORT, self.name, timestamp, bytes(payload)))
+
+# --------------------------------------------------------------------------- #
+
+def _ecu_worker(name, device_path, baud_rate, out_queue, stop, ack_every):
+    """
+    Runs in its own process (or thread) per ECU: enables reporting and
+    forwards the timestamped payload of each report, leaving decoding to the
+    manager so only raw bytes cross the process boundary.
+    """
+    conn = MEECU_Connection(device_path, baud_rate)
+    if not conn.connect():
+        out_queue.put((EVENT_ERROR, name, f"Failed to connect to {device_path}"))
+        return
+
+    # Set first so no report received after the SetState response is missed.
+    # Payloads are forwarded as received, so they aren't decoded or buffered
+    # here.
+    conn.set_recorder(_QueueRecorder(name, out_queue, conn), record_only=True)
+
+    session = MEECU_ReportingSession(conn, ack_every)
+    if not session.start():
+        out_queue.put((EVENT_ERROR, name, "No response to reporting request"))
+        conn.stop_reader()
+        return
+
+    stop.wait()
+    session.stop()
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_ConnectionManager:
+    """
+    Streams reports from several ECUs at once, each read by its own worker
+    process (or thread) so no single interpreter has to keep up with all of
+    them. Reports are merged into one stream ordered by receive time,
+    holding each back for reorder_delay seconds to absorb worker skew.
+    """
+
+    def __init__(self, use_processes=True, reorder_delay=0.05, ack_every=1):
+        self.use_processes = use_processes
+        self.reorder_delay = reorder_delay
+        self.ack_every = ack_every
+
+        self.ports = {}
+        self.entities = {}
+        self.decoders = {}
+        self.errors = {}
+
+        self._workers = []
+        self._queue = None
+        self._stop = None
+        self._sequence = 0
+
+        # Events taken off the queue by stop() while waiting for workers
+        self._backlog = deque()
+
+    # ----------------------------------------------------------------------- #
+
+    def add(self, name, device_path, baud_rate):
+        self.ports[name] = (device_path, baud_rate)
+
+    # ----------------------------------------------------------------------- #
+
+    def start(self):
+        if self.use_processes:
+            self._queue = multiprocessing.Queue()
+            self._stop = multiprocessing.Event()
+            worker_type = multiprocessing.Process
+        else:
+            self._queue = queue.Queue()
+            self._stop = threading.Event()
+            worker_type = threading.Thread
+
+        for name, (device_path, baud_rate) in self.ports.items():
+            worker = worker_type(target=_ecu_worker,
+                                 args=(name, device_path, baud_rate,
+                                       self._queue, self._stop,
+                                       self.ack_every),
+                                 name=f"MEECU worker {name}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    # ----------------------------------------------------------------------- #
+
+    def stop(self):
+        if self._stop is None:
+            return
+
+        self._stop.set()
+
+        # A worker process can't exit until everything it queued has been
+        # read, so keep reading in case nothing is consuming reports()
+        for worker in self._workers:
+            while worker.is_alive():
+                self._drain()
+                worker.join(0.01)
+        self._drain()
+        self._workers = []
+
+    # ----------------------------------------------------------------------- #
+
+    def _drain(self):
+        while True:
+            try:
+                self._backlog.append(self._queue.get_nowait())
+            except queue.Empty:
+                return
+
+    # ----------------------------------------------------------------------- #
+
+    def running(self):
+        return any(worker.is_alive() for worker in self._workers)
+
+    # ----------------------------------------------------------------------- #
+
+    def _handle_event(self, event, heap):
+        kind, name = event[0], event[1]
+
+        if kind == EVENT_ENTITIES:
+            self.entities[name] = event[2]
+            self.decoders[name] = MEECU_ReportDecoder(event[2])
+        elif kind == EVENT_ERROR:
+            self.errors[name] = event[2]
+            print(f"ECU {name}: {event[2]}")
+        elif kind == EVENT_REPORT:
+            try:
+                values = self.decoders[name].decode(event[3])
+            except (KeyError, struct.error) as err:
+                # No entity map yet, or one the payload doesn't match
+                self.errors[name] = f"Undecodable report: {err}"
+                return
+
+            # The sequence number keeps equal timestamps in arrival order
+            self._sequence += 1
+            heapq.heappush(heap, (event[2], self._sequence, name, values))
+
+    # ----------------------------------------------------------------------- #
+
+    def reports(self):
+        """
+        Yield (timestamp, name, values) for every report from every ECU in
+        time order, where values are decoded with that ECU's entity map.
+        Runs until every worker has finished, because the manager was
+        stopped or they all failed, and all reports are consumed.
+        """
+        heap = []
+
+        while True:
+            if self._backlog:
+                event = self._backlog.popleft()
+            else:
+                try:
+                    event = self._queue.get(timeout=self.reorder_delay)
+                except queue.Empty:
+                    event = None
+
+            if event is not None:
+                self._handle_event(event, heap)
+
+            finished = not self.running() and event is None
+            cutoff = time.time() - self.reorder_delay
+
+            while heap and (finished or heap[0][0] <= cutoff):
+                timestamp, _, name, values = heapq.heappop(heap)
+                yield timestamp, name, values
+
+            if finished:
+                return
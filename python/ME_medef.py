@@ -0,0 +1,209 @@
+import hashlib
+import os
+import struct
+import xml.etree.ElementTree as ET
+
+# --------------------------------------------------------------------------- #
+# Entity Catalogue                                                            #
+# --------------------------------------------------------------------------- #
+#
+# MEITE describes each datalink (reporting entity) in its .medef definition
+# file as a DataLinkModel element. Only the id and name are known to always
+# be present, so units and scaling fall back to no units and a raw value.
+#
+# --------------------------------------------------------------------------- #
+
+UNITS_TAGS  = ('units', 'unit')
+SCALE_TAGS  = ('scale', 'multiplier', 'factor')
+OFFSET_TAGS = ('offset',)
+
+CACHE_MAGIC   = b'MECC'
+CACHE_VERSION = 1
+CACHE_HEADER  = struct.Struct('<4sHI')
+CACHE_ENTITY  = struct.Struct('<Hdd')
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_Entity:
+
+    __slots__ = ('id', 'name', 'units', 'scale', 'offset')
+
+    def __init__(self, entity_id, name, units='', scale=1.0, offset=0.0):
+        self.id = entity_id
+        self.name = name
+        self.units = units
+        self.scale = scale
+        self.offset = offset
+
+    def convert(self, raw):
+        return raw * self.scale + self.offset
+
+    def __eq__(self, other):
+        return isinstance(other, MEECU_Entity) and \
+               all(getattr(self, attr) == getattr(other, attr)
+                   for attr in self.__slots__)
+
+    def __repr__(self):
+        return f"MEECU_Entity({self.id}, {self.name!r}, {self.units!r})"
+
+# --------------------------------------------------------------------------- #
+
+def _find_text(element, tags, default=None):
+    for tag in tags:
+        child = element.find(tag)
+        if child is not None and child.text is not None:
+            return child.text.strip()
+    return default
+
+# --------------------------------------------------------------------------- #
+
+def parse_medef(path):
+    """Parse the DataLinkModel entries of a .medef file into entities."""
+    entities = []
+
+    # Elements are cleared and detached from their parent once read, so
+    # nothing but the element being read and its ancestors is held in
+    # memory. The children of a DataLinkModel are kept until it ends.
+    parents = []
+    in_datalink = 0
+
+    for event, element in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            if element.tag == 'DataLinkModel':
+                in_datalink += 1
+            continue
+
+        parents.pop()
+        if element.tag == 'DataLinkModel':
+            in_datalink -= 1
+            entity_id = _find_text(element, ('id',))
+            name = _find_text(element, ('name',), '')
+            if entity_id is not None:
+                entities.append(MEECU_Entity(
+                    int(entity_id), name,
+                    _find_text(element, UNITS_TAGS, ''),
+                    float(_find_text(element, SCALE_TAGS, 1.0)),
+                    float(_find_text(element, OFFSET_TAGS, 0.0))))
+        elif in_datalink:
+            continue
+
+        element.clear()
+        if parents:
+            parents[-1].remove(element)
+
+    return entities
+
+# --------------------------------------------------------------------------- #
+
+def _pack_string(value):
+    data = value.encode('utf-8')
+    return struct.pack('<H', len(data)) + data
+
+# --------------------------------------------------------------------------- #
+
+def _unpack_string(data, offset):
+    length, = struct.unpack_from('<H', data, offset)
+    offset += 2
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_EntityCatalogue:
+    """
+    Entities from a .medef file, indexed by id and by name. load() keeps a
+    binary copy of the parsed catalogue named after the file's SHA-256, so
+    the XML is only parsed again when the definition file changes.
+    """
+
+    def __init__(self, entities):
+        self.entities = list(entities)
+        self.by_id = {entity.id: entity for entity in self.entities}
+        self.by_name = {entity.name: entity for entity in self.entities}
+
+    # ----------------------------------------------------------------------- #
+
+    @classmethod
+    def load(cls, path, cache_dir=None):
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+
+        if cache_dir is None:
+            cache_dir = os.path.dirname(os.path.abspath(path))
+        cache_path = os.path.join(cache_dir, f"{digest}.mecat")
+
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'rb') as f:
+                    return cls.from_bytes(f.read())
+            except (ValueError, struct.error, UnicodeDecodeError) as err:
+                print(f"Ignoring unreadable catalogue cache: {err}")
+
+        catalogue = cls(parse_medef(path))
+
+        # Written to a temporary name first so readers never see half a file
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(catalogue.to_bytes())
+            os.replace(tmp_path, cache_path)
+        except OSError as err:
+            print(f"Warning: Could not write catalogue cache: {err}")
+
+        return catalogue
+
+    # ----------------------------------------------------------------------- #
+
+    def to_bytes(self):
+        parts = [CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION,
+                                   len(self.entities))]
+        for entity in self.entities:
+            parts.append(CACHE_ENTITY.pack(entity.id, entity.scale,
+                                           entity.offset))
+            parts.append(_pack_string(entity.name))
+            parts.append(_pack_string(entity.units))
+        return b''.join(parts)
+
+    # ----------------------------------------------------------------------- #
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, count = CACHE_HEADER.unpack_from(data)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            raise ValueError("Not an entity catalogue cache!")
+
+        entities = []
+        offset = CACHE_HEADER.size
+        for _ in range(count):
+            entity_id, scale, entity_offset = \
+                CACHE_ENTITY.unpack_from(data, offset)
+            offset += CACHE_ENTITY.size
+            name, offset = _unpack_string(data, offset)
+            units, offset = _unpack_string(data, offset)
+            entities.append(MEECU_Entity(entity_id, name, units, scale,
+                                         entity_offset))
+        return cls(entities)
+
+    # ----------------------------------------------------------------------- #
+
+    def __len__(self):
+        return len(self.entities)
+
+    # ----------------------------------------------------------------------- #
+
+    def __getitem__(self, key):
+        """Look up an entity by name, or by id if given an int."""
+        if isinstance(key, int):
+            return self.by_id[key]
+        return self.by_name[key]
+
+    # ----------------------------------------------------------------------- #
+
+    def value(self, name, decoder, values):
+        """
+        Scaled value of a named entity, from the values decoded from a report
+        by a MEECU_ReportDecoder.
+        """
+        entity = self.by_name[name]
+        return entity.convert(values[decoder.index[entity.id]])
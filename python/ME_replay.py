@@ -0,0 +1,367 @@
+import threading
+import time
+
+from ME import MEECU_Connection, MEECU_Framer, MEECU_MessageClass, \
+               MEECU_MessageType, MEECU_ReportingCommands, iter_frames
+from ME_session import SESSION_MAGIC, MEECU_SessionReader
+from ME_sim import build_frame, set_state_payload
+
+# --------------------------------------------------------------------------- #
+# Captures                                                                    #
+# --------------------------------------------------------------------------- #
+
+SET_STATE_KEY = (MEECU_MessageClass.REPORTING.value,
+                 MEECU_ReportingCommands.SET_STATE.value)
+SEND_ACK_KEY  = (MEECU_MessageClass.REPORTING.value,
+                 MEECU_ReportingCommands.SEND_ACK.value)
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_Capture:
+    """
+    Recorded ECU traffic to replay, from either a raw capture of bytes
+    received from the ECU (e.g. the sample-data files) or a session log
+    written by MEECU_SessionWriter.
+
+    The first response of each class and command is kept to answer requests
+    with, and reports() yields (timestamp, frame) for every report. Raw
+    captures have no timestamps, so these are None. If a capture has no
+    SetState response, one is made from entities when given.
+    """
+
+    def __init__(self, path, entities=None):
+        self.path = path
+        self.responses = {}
+        self.entities = entities
+
+        self._data = None
+        self._session = None
+
+        with open(path, 'rb') as f:
+            is_session = f.read(len(SESSION_MAGIC)) == SESSION_MAGIC
+
+        if is_session:
+            self._session = MEECU_SessionReader(path)
+            self.entities = self._session.entities
+        else:
+            with open(path, 'rb') as f:
+                self._data = f.read()
+            self._find_responses()
+
+        if SET_STATE_KEY not in self.responses and self.entities:
+            self.responses[SET_STATE_KEY] = build_frame(
+                MEECU_MessageClass.REPORTING,
+                MEECU_ReportingCommands.SET_STATE,
+                set_state_payload(self.entities))
+
+    # ----------------------------------------------------------------------- #
+
+    def _find_responses(self):
+        for frame in iter_frames(self._data):
+            if not frame.is_report() and \
+               frame.rtype == MEECU_MessageType.RESPONSE.value:
+                self.responses.setdefault((frame.rclass, frame.command),
+                                          bytes(frame.data))
+
+    # ----------------------------------------------------------------------- #
+
+    def reports(self):
+        if self._session is not None:
+            for timestamp, payload in self._session:
+                yield timestamp, build_frame(MEECU_MessageClass.REPORTING,
+                                             MEECU_ReportingCommands.SEND_REPORT,
+                                             payload)
+            return
+
+        for frame in iter_frames(self._data):
+            if frame.is_report():
+                yield None, frame.data
+
+    # ----------------------------------------------------------------------- #
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+# --------------------------------------------------------------------------- #
+# Replay Transport                                                            #
+# --------------------------------------------------------------------------- #
+
+class MEECU_ReplaySerial:
+    """
+    Stand-in for a serial.Serial handle that plays back a capture. Requests
+    are answered with the recorded response to them, and recorded reports
+    are sent once reporting is enabled by a SetState request.
+
+    Reports are sent with their original timing divided by speed, or as fast
+    as they are read if speed is None. Reports without timestamps are spaced
+    1 / report_rate seconds apart, or sent as fast as possible if no rate is
+    given. With loop set, the capture restarts when it runs out.
+    """
+
+    # Reports are held back once this many bytes are unread, so a long
+    # capture replayed faster than it is read isn't one huge buffer
+    MAX_BUFFER = 65536
+
+    def __init__(self, capture, speed=1.0, report_rate=None, loop=False,
+                 timeout=0.05):
+        self.capture = capture
+        self.speed = speed
+        self.report_rate = report_rate
+        self.loop = loop
+        self.timeout = timeout
+        self.is_open = True
+
+        self.reporting = False
+        self.finished = False
+        self.reports_sent = 0
+
+        # Called once all reports have been sent and read
+        self.on_end = None
+
+        self._rx = bytearray()
+        self._lock = threading.Lock()
+        # Wakes a blocked read() when a request starts reporting
+        self._written = threading.Condition(self._lock)
+        self._framer = MEECU_Framer()
+
+        self._reports = None
+        self._next = None
+        self._start = None
+        self._origin = None
+        self._first = None
+        self._offset = 0.0
+        self._last = 0.0
+        self._gap = 0.0
+        self._index = 0
+
+    # ----------------------------------------------------------------------- #
+
+    def _start_reports(self):
+        self.reporting = True
+        self.finished = False
+        self._reports = self.capture.reports()
+        self._start = time.monotonic()
+        self._origin = None
+        self._first = None
+        self._offset = 0.0
+        self._last = 0.0
+        self._gap = 0.0
+        self._index = 0
+        self._next = self._next_report()
+
+    # ----------------------------------------------------------------------- #
+
+    def _next_report(self):
+        """Return (capture time, frame) for the next report, or None."""
+        for attempt in range(2):
+            for timestamp, frame in self._reports:
+                if timestamp is None and self.report_rate:
+                    timestamp = self._index / self.report_rate
+                self._index += 1
+
+                if timestamp is not None:
+                    if self._first is None:
+                        self._first = timestamp
+                    if self._origin is None:
+                        self._origin = timestamp
+                    timestamp = timestamp - self._first + self._offset
+                    self._gap = timestamp - self._last
+                    self._last = timestamp
+                return timestamp, frame
+
+            if not self.loop or attempt:
+                break
+
+            # Carry on one report interval after the end of the capture
+            gap = self._gap
+            if not gap and self.report_rate:
+                gap = 1 / self.report_rate
+
+            self._reports = self.capture.reports()
+            self._first = None
+            self._index = 0
+            self._offset = self._last + gap
+
+        self.finished = True
+        return None
+
+    # ----------------------------------------------------------------------- #
+
+    def _due(self, timestamp):
+        if timestamp is None or self.speed is None:
+            return None
+        return self._start + timestamp / self.speed
+
+    # ----------------------------------------------------------------------- #
+
+    def _pump(self):
+        if not self.reporting:
+            return
+
+        now = time.monotonic()
+        while self._next is not None:
+            if len(self._rx) >= self.MAX_BUFFER:
+                break
+
+            timestamp, frame = self._next
+            due = self._due(timestamp)
+            if due is not None and due > now:
+                break
+
+            self._rx += frame
+            self.reports_sent += 1
+            self._next = self._next_report()
+
+    # ----------------------------------------------------------------------- #
+
+    def clock(self):
+        """
+        Capture time now being played, or None if reports aren't replayed
+        to their original timing.
+        """
+        if self._origin is None or self.speed is None:
+            return None
+        return self._origin + (time.monotonic() - self._start) * self.speed
+
+    # ----------------------------------------------------------------------- #
+
+    def next_report_due(self):
+        """Seconds until the next report is due, or None if none is."""
+        if not self.reporting or self._next is None:
+            return None
+
+        due = self._due(self._next[0])
+        if due is None:
+            return 0.0
+        return max(0.0, due - time.monotonic())
+
+    # ----------------------------------------------------------------------- #
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            self._pump()
+            return len(self._rx)
+
+    # ----------------------------------------------------------------------- #
+
+    def read(self, size=1):
+        deadline = time.monotonic() + (self.timeout or 0)
+
+        while True:
+            with self._lock:
+                self._pump()
+                if self._rx:
+                    data = bytes(self._rx[:size])
+                    del self._rx[:size]
+                    return data
+
+                if self.finished and self.on_end is not None:
+                    on_end, self.on_end = self.on_end, None
+                    on_end()
+
+                if self.timeout is not None and \
+                   time.monotonic() >= deadline:
+                    return b''
+
+                wait = deadline - time.monotonic()
+                due = self.next_report_due()
+                if due is not None:
+                    wait = min(wait, due)
+                self._written.wait(max(wait, 0.0001))
+
+    # ----------------------------------------------------------------------- #
+
+    def write(self, data):
+        with self._lock:
+            self._framer.feed(data)
+            for frame in self._framer:
+                self._handle_request(frame)
+            self._written.notify_all()
+        return len(data)
+
+    # ----------------------------------------------------------------------- #
+
+    def _handle_request(self, frame):
+        key = (frame[5], frame[6])
+        if key == SEND_ACK_KEY:
+            return
+
+        if key == SET_STATE_KEY:
+            if frame[7]:
+                self._rx += self.capture.responses.get(key, b'')
+                self._start_reports()
+            else:
+                self.reporting = False
+                self._rx += build_frame(MEECU_MessageClass.REPORTING,
+                                        MEECU_ReportingCommands.SET_STATE,
+                                        b'\x00')
+            return
+
+        # Anything not in the capture goes unanswered
+        self._rx += self.capture.responses.get(key, b'')
+
+    # ----------------------------------------------------------------------- #
+
+    def close(self):
+        self.is_open = False
+        self.capture.close()
+
+# --------------------------------------------------------------------------- #
+# Replay Connection                                                           #
+# --------------------------------------------------------------------------- #
+
+class MEECU_ReplayConnection(MEECU_Connection):
+    """
+    MEECU_Connection reading from a capture file rather than a serial port,
+    so anything written against a live connection can be run offline. When
+    the capture has been played through, the report buffer is closed, ending
+    iteration over a MEECU_ReportingSession or iter_reports().
+    """
+
+    def __init__(self, path, speed=1.0, report_rate=None, loop=False,
+                 entities=None, timeout=1.0):
+        super().__init__(path, 0, timeout)
+        self.speed = speed
+        self.report_rate = report_rate
+        self.loop = loop
+        self.capture_entities = entities
+
+    # ----------------------------------------------------------------------- #
+
+    def connect(self):
+        try:
+            capture = MEECU_Capture(self.device_path, self.capture_entities)
+        except (OSError, ValueError) as err:
+            print(f"Exception when opening capture: {err}")
+            return False
+
+        self.handle = MEECU_ReplaySerial(capture, self.speed,
+                                         self.report_rate, self.loop,
+                                         self.POLL_INTERVAL)
+        self.handle.on_end = self._on_replay_end
+        return True
+
+    # ----------------------------------------------------------------------- #
+
+    @property
+    def finished(self):
+        return self.handle is not None and self.handle.finished
+
+    # ----------------------------------------------------------------------- #
+
+    def clock(self):
+        # Stamp reports with the time they were captured at, so they are
+        # windowed the same at any replay speed
+        if self.handle is not None:
+            timestamp = self.handle.clock()
+            if timestamp is not None:
+                return timestamp
+        return super().clock()
+
+    # ----------------------------------------------------------------------- #
+
+    def _on_replay_end(self):
+        self.reports.close()
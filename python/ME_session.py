@@ -0,0 +1,287 @@
+import bisect
+import mmap
+import os
+import struct
+import time
+
+# --------------------------------------------------------------------------- #
+# Session Log Format                                                          #
+# --------------------------------------------------------------------------- #
+#
+# A session file holds the reports received over one reporting session:
+#
+#   Header      magic 'MESL', version, entity count, payload size, index
+#               interval
+#   Entity map  entity count * (id: ushort, type: uchar), as sent in the
+#               SetState response
+#   Records     timestamp (int64, microseconds since the epoch) followed by
+#               the report payload, all the same size
+#
+# The file is only ever appended to. Every index interval records, the
+# record number and timestamp are appended to a sidecar '.idx' file, which
+# readers use to narrow a time lookup before searching the records.
+#
+# --------------------------------------------------------------------------- #
+
+SESSION_MAGIC   = b'MESL'
+SESSION_VERSION = 1
+
+SESSION_HEADER   = struct.Struct('<4sHHII')
+SESSION_ENTITY   = struct.Struct('<HB')
+RECORD_TIMESTAMP = struct.Struct('<q')
+INDEX_ENTRY      = struct.Struct('<qQ')
+
+# --------------------------------------------------------------------------- #
+
+def index_path(path):
+    return path + '.idx'
+
+# --------------------------------------------------------------------------- #
+
+def to_timestamp_us(timestamp):
+    return int(round(timestamp * 1_000_000))
+
+# --------------------------------------------------------------------------- #
+
+def read_session_header(f):
+    """
+    Read the header and entity map from the start of an open session file.
+    Returns (entities, payload_size, index_interval, data_offset).
+    """
+    header = f.read(SESSION_HEADER.size)
+    if len(header) < SESSION_HEADER.size:
+        raise ValueError("Session file is truncated!")
+
+    magic, version, entity_count, payload_size, index_interval = \
+        SESSION_HEADER.unpack(header)
+    if magic != SESSION_MAGIC:
+        raise ValueError("File is not a session log!")
+    if version != SESSION_VERSION:
+        raise ValueError(f"Unsupported session log version {version}")
+
+    entity_data = f.read(entity_count * SESSION_ENTITY.size)
+    entities = [{'id': entity_id, 'type': entity_type}
+                for entity_id, entity_type
+                in SESSION_ENTITY.iter_unpack(entity_data)]
+
+    data_offset = SESSION_HEADER.size + len(entity_data)
+    return entities, payload_size, index_interval, data_offset
+
+# --------------------------------------------------------------------------- #
+# Session Writer                                                              #
+# --------------------------------------------------------------------------- #
+
+class MEECU_SessionWriter:
+    """
+    Appends timestamped report payloads to a session file. An existing file
+    is appended to if it was written with the same entity map.
+    """
+
+    def __init__(self, path, entities, payload_size, index_interval=1000):
+        self.path = path
+        self.entities = [{'id': entity['id'], 'type': entity['type']}
+                         for entity in entities]
+        self.payload_size = payload_size
+        self.index_interval = index_interval
+        self.count = 0
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self._open_existing()
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(SESSION_HEADER.pack(
+                SESSION_MAGIC, SESSION_VERSION, len(self.entities),
+                payload_size, index_interval))
+            for entity in self.entities:
+                self._file.write(SESSION_ENTITY.pack(entity['id'],
+                                                     entity['type']))
+            self._index = open(index_path(path), 'wb')
+
+    # ----------------------------------------------------------------------- #
+
+    @classmethod
+    def for_decoder(cls, path, decoder, index_interval=1000):
+        """Create a writer for the entity map of a MEECU_ReportDecoder."""
+        entities = [{'id': entity_id, 'type': entity_type}
+                    for entity_id, entity_type
+                    in zip(decoder.ids, decoder.types)]
+        return cls(path, entities, decoder.size, index_interval)
+
+    # ----------------------------------------------------------------------- #
+
+    def _open_existing(self):
+        with open(self.path, 'rb') as f:
+            entities, payload_size, index_interval, data_offset = \
+                read_session_header(f)
+
+        if entities != self.entities or payload_size != self.payload_size:
+            raise ValueError(f"{self.path} was recorded with a different "
+                             f"entity map!")
+        self.index_interval = index_interval
+
+        # Drop a partial record left behind if the logger was interrupted
+        record_size = RECORD_TIMESTAMP.size + payload_size
+        self.count = (os.path.getsize(self.path) - data_offset) // record_size
+        self._file = open(self.path, 'r+b')
+        self._file.truncate(data_offset + self.count * record_size)
+        self._file.seek(0, os.SEEK_END)
+
+        # Likewise for index entries of records that were never written
+        self._index = open(index_path(self.path), 'ab')
+        indexed = (self.count + index_interval - 1) // index_interval
+        self._index.truncate(min(self._index.tell(),
+                                 indexed * INDEX_ENTRY.size))
+        self._index.seek(0, os.SEEK_END)
+
+    # ----------------------------------------------------------------------- #
+
+    def write(self, payload, timestamp=None):
+        if len(payload) != self.payload_size:
+            raise ValueError(f"Report payload is {len(payload)} bytes, "
+                             f"expected {self.payload_size}")
+
+        if timestamp is None:
+            timestamp = time.time()
+        timestamp_us = to_timestamp_us(timestamp)
+
+        if self.count % self.index_interval == 0:
+            self._index.write(INDEX_ENTRY.pack(timestamp_us, self.count))
+
+        self._file.write(RECORD_TIMESTAMP.pack(timestamp_us))
+        self._file.write(payload)
+        self.count += 1
+
+    # ----------------------------------------------------------------------- #
+
+    def flush(self):
+        self._file.flush()
+        self._index.flush()
+
+    # ----------------------------------------------------------------------- #
+
+    def close(self):
+        self._file.close()
+        self._index.close()
+
+    # ----------------------------------------------------------------------- #
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# --------------------------------------------------------------------------- #
+# Session Reader                                                              #
+# --------------------------------------------------------------------------- #
+
+class MEECU_SessionReader:
+    """
+    Memory-maps a session file for random access to its records. Lookups by
+    time use the sparse index and a binary search over the fixed-width
+    records, so nothing outside the requested range is read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self.entities, self.payload_size, self.index_interval, \
+                self.data_offset = read_session_header(f)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._view = memoryview(self._mmap)
+        self.record_size = RECORD_TIMESTAMP.size + self.payload_size
+        self.count = (len(self._mmap) - self.data_offset) // self.record_size
+
+        self._index_times = []
+        self._index_records = []
+        if os.path.exists(index_path(path)):
+            with open(index_path(path), 'rb') as f:
+                for timestamp_us, record in INDEX_ENTRY.iter_unpack(f.read()):
+                    if record < self.count:
+                        self._index_times.append(timestamp_us)
+                        self._index_records.append(record)
+
+    # ----------------------------------------------------------------------- #
+
+    def __len__(self):
+        return self.count
+
+    # ----------------------------------------------------------------------- #
+
+    def _offset(self, record):
+        return self.data_offset + record * self.record_size
+
+    # ----------------------------------------------------------------------- #
+
+    def timestamp_us(self, record):
+        return RECORD_TIMESTAMP.unpack_from(self._mmap,
+                                            self._offset(record))[0]
+
+    # ----------------------------------------------------------------------- #
+
+    def record(self, record):
+        """Return (timestamp, payload) for a record number."""
+        offset = self._offset(record)
+        timestamp_us, = RECORD_TIMESTAMP.unpack_from(self._mmap, offset)
+        payload_start = offset + RECORD_TIMESTAMP.size
+        return (timestamp_us / 1_000_000,
+                self._view[payload_start:payload_start + self.payload_size])
+
+    # ----------------------------------------------------------------------- #
+
+    def find(self, timestamp):
+        """Number of the first record at or after the given time."""
+        timestamp_us = to_timestamp_us(timestamp)
+
+        # Narrow the search down to one index interval where possible,
+        # starting before any index entry at the time itself as records
+        # before it may share that time
+        lo, hi = 0, self.count
+        i = bisect.bisect_left(self._index_times, timestamp_us)
+        if i > 0:
+            lo = self._index_records[i - 1]
+        if i < len(self._index_records):
+            hi = self._index_records[i]
+
+        return bisect.bisect_left(range(lo, hi), timestamp_us,
+                                  key=self.timestamp_us) + lo
+
+    # ----------------------------------------------------------------------- #
+
+    def range_buffer(self, start, end):
+        """
+        Return a memoryview over the records between two times, each made
+        up of an int64 timestamp followed by the report payload.
+        """
+        first = self.find(start)
+        last = self.find(end)
+        return self._view[self._offset(first):self._offset(last)]
+
+    # ----------------------------------------------------------------------- #
+
+    def read_range(self, start, end):
+        """Yield (timestamp, payload) for records from start up to end."""
+        for record in range(self.find(start), self.find(end)):
+            yield self.record(record)
+
+    # ----------------------------------------------------------------------- #
+
+    def __iter__(self):
+        for record in range(self.count):
+            yield self.record(record)
+
+    # ----------------------------------------------------------------------- #
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+
+    # ----------------------------------------------------------------------- #
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
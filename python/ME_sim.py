@@ -0,0 +1,555 @@
+import math
+import os
+import random
+import select
+import struct
+import threading
+import time
+import zlib
+
+from ME import HEADER_STRUCT, MEECU_Framer, MEECU_MessageType, \
+               MEECU_MessageClass, MEECU_ReportingCommands, \
+               MEECU_ReportingType, MEECU_SysCommands, MEECU_ReportDecoder, \
+               MEECU_Message, MEECU_Sys_GetHash, MEECU_TablesCommands, \
+               MEECU_Tables_GetDataAtOffset, MEECU_Tables_SetDataAtOffsets, \
+               MEECU_DatalogCommands, MEECU_Datalog_GetLogDetail, \
+               MEECU_Datalog_GetLogRegion, MEECU_TriglogCommands, calc_crc
+
+# --------------------------------------------------------------------------- #
+# ECU Simulator                                                               #
+# --------------------------------------------------------------------------- #
+
+# Mix of reporting types in the order they are cycled through when
+# generating an entity map, roughly matching what an ME221 reports
+GENERATED_TYPES = (
+    MEECU_ReportingType.FLOAT_4B, MEECU_ReportingType.UINT_1B,
+    MEECU_ReportingType.FLOAT_4B, MEECU_ReportingType.INT_2B,
+    MEECU_ReportingType.FLOAT_4B, MEECU_ReportingType.UINT_2B,
+    MEECU_ReportingType.UINT_1B, MEECU_ReportingType.INT_1B,
+)
+
+# Value ranges the simulated entities sweep through, per type
+GENERATED_RANGES = {
+    MEECU_ReportingType.FLOAT_4B: (0.0, 100.0),
+    MEECU_ReportingType.INT_2B:   (-1000, 1000),
+    MEECU_ReportingType.UINT_2B:  (0, 8000),
+    MEECU_ReportingType.INT_1B:   (-100, 100),
+    MEECU_ReportingType.UINT_1B:  (0, 200),
+    MEECU_ReportingType.BOOL_1B:  (0, 1),
+}
+
+ECU_INFO = b'ME221 Simulator'
+
+# --------------------------------------------------------------------------- #
+
+def build_frame(rclass, command, payload=b'',
+                rtype=MEECU_MessageType.RESPONSE):
+    header = HEADER_STRUCT.pack(b'ME', len(payload), rtype.value,
+                                rclass.value, command.value)
+    crc = calc_crc(header[4:] + payload)
+    return header + payload + crc.to_bytes(2, 'little')
+
+# --------------------------------------------------------------------------- #
+
+def set_state_payload(entities):
+    """SetState response payload describing an entity map."""
+    payload = struct.pack('<BH', 0x02, len(entities))
+    for entity in entities:
+        payload += struct.pack('<HB', entity['id'], entity['type'])
+    return payload
+
+# --------------------------------------------------------------------------- #
+
+def generate_entities(count):
+    return [{'id': i + 1, 'type': GENERATED_TYPES[i % len(GENERATED_TYPES)].value}
+            for i in range(count)]
+
+# --------------------------------------------------------------------------- #
+
+class MEECU_Simulator:
+    """
+    Speaks the ECU side of the protocol. Requests written by the host are
+    passed to receive(), which returns the bytes the ECU sends in reply,
+    and poll() returns the reports due since it was last called while
+    reporting is enabled.
+
+    The entity map is generated with entity_count entities unless one is
+    given, e.g. from a capture via from_capture(). noise_rate and drop_rate
+    are the chance of each frame sent having one byte corrupted or one byte
+    dropped. If max_unacked is set, reports stop after that many are sent
+    without an ACK, as the real ECU does.
+
+    tables is a dict of table id to contents, which can be read and written
+    a chunk at a time and are listed by a detailed GetHash.
+
+    Onboard logs are added with record_log(), and trigger_blocks are sent
+    as trigger log reports once trigger logging is enabled.
+    """
+
+    def __init__(self, entities=None, entity_count=150, report_rate=100.0,
+                 noise_rate=0.0, drop_rate=0.0, max_unacked=None, seed=None,
+                 tables=None):
+        if entities is None:
+            entities = generate_entities(entity_count)
+
+        self.entities = entities
+        self.tables = {table_id: bytearray(data)
+                       for table_id, data in (tables or {}).items()}
+        self.stored = 0
+        self.datalogs = {}
+        self.trigger_blocks = []
+        self.trigger_logging = False
+        self.decoder = MEECU_ReportDecoder(entities)
+        self.report_rate = report_rate
+        self.noise_rate = noise_rate
+        self.drop_rate = drop_rate
+        self.max_unacked = max_unacked
+        self.random = random.Random(seed)
+
+        self.reporting = False
+        self.reports_sent = 0
+        self.acks_received = 0
+        self.requests = []
+
+        # A fixed payload to repeat, set by from_capture()
+        self.report_payload = None
+
+        self._framer = MEECU_Framer()
+        self._next_report = None
+        self._unacked = 0
+        self._tick = 0
+
+    # ----------------------------------------------------------------------- #
+
+    @classmethod
+    def from_capture(cls, set_state_frame, report_frame=None, **kwargs):
+        """
+        Simulate the ECU from a captured SetState response and, optionally, a
+        report which is then sent repeatedly.
+        """
+        set_state = MEECU_Message.from_data(set_state_frame)
+        simulator = cls(set_state.entities, **kwargs)
+        if report_frame is not None:
+            simulator.report_payload = MEECU_Message.from_data(
+                report_frame).payload
+        return simulator
+
+    # ----------------------------------------------------------------------- #
+
+    def set_state_payload(self):
+        return set_state_payload(self.entities)
+
+    # ----------------------------------------------------------------------- #
+
+    def table_hash(self, table_id):
+        # Not the real hash algorithm, but changes with the contents
+        return zlib.crc32(self.tables[table_id])
+
+    # ----------------------------------------------------------------------- #
+
+    def hash_payload(self, mode):
+        if mode == MEECU_Sys_GetHash.MODE_DETAILED:
+            payload = bytes([mode]) + struct.pack('<H', len(self.tables))
+            for table_id in sorted(self.tables):
+                payload += MEECU_Sys_GetHash.TABLE_STRUCT.pack(
+                    table_id, self.table_hash(table_id))
+            return payload
+
+        overall = zlib.crc32(self.set_state_payload())
+        for table_id in sorted(self.tables):
+            overall = zlib.crc32(self.tables[table_id], overall)
+        return bytes([mode]) + struct.pack('<I', overall)
+
+    # ----------------------------------------------------------------------- #
+
+    def record_log(self, log_id, count, start_time=0, interval=0.01):
+        """Record count reports into an onboard log, returning its data."""
+        data = bytearray()
+        for _ in range(count):
+            data += self.decoder.struct.pack(*self.report_values())[1:]
+            self._tick += 1
+
+        self.datalogs[log_id] = {
+            'entities': self.entities,
+            'start_time': start_time,
+            'interval_ms': int(round(interval * 1000)),
+            'data': bytes(data),
+        }
+        return bytes(data)
+
+    # ----------------------------------------------------------------------- #
+
+    def report_values(self):
+        """Entity values for the next report, each sweeping its range."""
+        values = []
+        for i, etype in enumerate(self.decoder.types):
+            etype = MEECU_ReportingType(etype)
+            low, high = GENERATED_RANGES[etype]
+            phase = math.sin((self._tick + i * 7) / 50.0) * 0.5 + 0.5
+            value = low + (high - low) * phase
+            if etype is MEECU_ReportingType.BOOL_1B:
+                value = value >= 0.5
+            elif etype is not MEECU_ReportingType.FLOAT_4B:
+                value = int(value)
+            values.append(value)
+        return values
+
+    # ----------------------------------------------------------------------- #
+
+    def report_frame(self):
+        if self.report_payload is not None:
+            payload = self.report_payload
+        else:
+            payload = self.decoder.struct.pack(*self.report_values())
+        self._tick += 1
+
+        return build_frame(MEECU_MessageClass.REPORTING,
+                           MEECU_ReportingCommands.SEND_REPORT, payload)
+
+    # ----------------------------------------------------------------------- #
+
+    def receive(self, data):
+        """Handle bytes written by the host, returning the ECU's reply."""
+        self._framer.feed(data)
+
+        reply = b''
+        for frame in self._framer:
+            reply += self._handle_request(bytes(frame))
+        return reply
+
+    # ----------------------------------------------------------------------- #
+
+    def _handle_request(self, frame):
+        rclass, command = frame[5], frame[6]
+        payload = frame[7:-2]
+        self.requests.append((rclass, command, payload))
+
+        if rclass == MEECU_MessageClass.SYSTEM.value:
+            if command == MEECU_SysCommands.GET_ECU_INFO.value:
+                return self._response(MEECU_MessageClass.SYSTEM,
+                                      MEECU_SysCommands.GET_ECU_INFO,
+                                      ECU_INFO)
+            if command == MEECU_SysCommands.GET_HASH.value:
+                mode = payload[0] if payload else 0
+                return self._response(MEECU_MessageClass.SYSTEM,
+                                      MEECU_SysCommands.GET_HASH,
+                                      self.hash_payload(mode))
+
+        if rclass == MEECU_MessageClass.TABLES.value:
+            return self._handle_table_request(frame, command)
+
+        if rclass == MEECU_MessageClass.DATALOG.value:
+            return self._handle_datalog_request(frame, command)
+
+        if rclass == MEECU_MessageClass.TRIGLOG.value and \
+           command == MEECU_TriglogCommands.SET_STATE.value:
+            self.trigger_logging = bool(payload and payload[0])
+            reply = self._response(MEECU_MessageClass.TRIGLOG,
+                                   MEECU_TriglogCommands.SET_STATE, b'\x00')
+            if self.trigger_logging:
+                for block in self.trigger_blocks:
+                    reply += self._response(MEECU_MessageClass.TRIGLOG,
+                                            MEECU_TriglogCommands.REPORT,
+                                            block)
+            return reply
+
+        if rclass == MEECU_MessageClass.REPORTING.value:
+            if command == MEECU_ReportingCommands.SEND_ACK.value:
+                self.acks_received += 1
+                self._unacked = 0
+                return b''
+
+            if command == MEECU_ReportingCommands.SET_STATE.value:
+                enable = bool(payload and payload[0])
+                self.reporting = enable
+                self._next_report = time.monotonic() if enable else None
+                self._unacked = 0
+                return self._response(MEECU_MessageClass.REPORTING,
+                                      MEECU_ReportingCommands.SET_STATE,
+                                      self.set_state_payload() if enable
+                                      else b'\x00')
+
+        return b''
+
+    # ----------------------------------------------------------------------- #
+
+    def _handle_table_request(self, frame, command):
+        if command == MEECU_TablesCommands.STORE_NVM.value:
+            self.stored += 1
+            return self._response(MEECU_MessageClass.TABLES,
+                                  MEECU_TablesCommands.STORE_NVM)
+
+        message = MEECU_Message.from_data(frame)
+        if message is None or message.table_id not in self.tables:
+            return b''
+
+        table = self.tables[message.table_id]
+        chunk = MEECU_Tables_GetDataAtOffset.CHUNK_STRUCT.pack(
+            message.table_id, message.offset)
+
+        if isinstance(message, MEECU_Tables_GetDataAtOffset):
+            data = table[message.offset:message.offset + message.read_length]
+            return self._response(MEECU_MessageClass.TABLES,
+                                  MEECU_TablesCommands.GET_DATA_AT_OFFSET,
+                                  chunk + bytes(data))
+
+        if isinstance(message, MEECU_Tables_SetDataAtOffsets):
+            end = message.offset + len(message.table_data)
+            status = MEECU_Tables_SetDataAtOffsets.STATUS_OK
+            if end > len(table):
+                status = 0x01
+            else:
+                table[message.offset:end] = message.table_data
+            return self._response(MEECU_MessageClass.TABLES,
+                                  MEECU_TablesCommands.SET_DATA_AT_OFFSETS,
+                                  chunk + bytes([status]))
+
+        return b''
+
+    # ----------------------------------------------------------------------- #
+
+    def _handle_datalog_request(self, frame, command):
+        if command == MEECU_DatalogCommands.GET_LOGS.value:
+            payload = struct.pack('<H', len(self.datalogs))
+            for log_id in sorted(self.datalogs):
+                payload += struct.pack('<HI', log_id,
+                                       len(self.datalogs[log_id]['data']))
+            return self._response(MEECU_MessageClass.DATALOG,
+                                  MEECU_DatalogCommands.GET_LOGS, payload)
+
+        message = MEECU_Message.from_data(frame)
+        if message is None or message.log_id not in self.datalogs:
+            return b''
+        log = self.datalogs[message.log_id]
+
+        if isinstance(message, MEECU_Datalog_GetLogDetail):
+            payload = MEECU_Datalog_GetLogDetail.DETAIL_STRUCT.pack(
+                message.log_id, len(log['data']), log['start_time'],
+                log['interval_ms'], len(log['entities']))
+            for entity in log['entities']:
+                payload += struct.pack('<HB', entity['id'], entity['type'])
+            return self._response(MEECU_MessageClass.DATALOG,
+                                  MEECU_DatalogCommands.GET_LOG_DETAIL,
+                                  payload)
+
+        if isinstance(message, MEECU_Datalog_GetLogRegion):
+            region = MEECU_Datalog_GetLogRegion.REGION_STRUCT.pack(
+                message.log_id, message.offset)
+            data = log['data'][message.offset:
+                               message.offset + message.read_length]
+            return self._response(MEECU_MessageClass.DATALOG,
+                                  MEECU_DatalogCommands.GET_LOG_REGION,
+                                  region + data)
+
+        return b''
+
+    # ----------------------------------------------------------------------- #
+
+    def _response(self, rclass, command, payload=b''):
+        return self._inject_errors(build_frame(rclass, command, payload))
+
+    # ----------------------------------------------------------------------- #
+
+    def next_report_due(self):
+        """Seconds until the next report is due, or None if not reporting."""
+        if not self.reporting:
+            return None
+        return max(0.0, self._next_report - time.monotonic())
+
+    # ----------------------------------------------------------------------- #
+
+    def poll(self):
+        """Return the reports that have fallen due since the last poll."""
+        if not self.reporting:
+            return b''
+
+        now = time.monotonic()
+        interval = 1.0 / self.report_rate
+
+        frames = []
+        while self._next_report <= now:
+            if self.max_unacked is not None and \
+               self._unacked >= self.max_unacked:
+                # Stalled until the host acknowledges
+                self._next_report = now + interval
+                break
+
+            frames.append(self._inject_errors(self.report_frame()))
+            self.reports_sent += 1
+            self._unacked += 1
+            self._next_report += interval
+
+        return b''.join(frames)
+
+    # ----------------------------------------------------------------------- #
+
+    def _inject_errors(self, frame):
+        if self.noise_rate and self.random.random() < self.noise_rate:
+            frame = bytearray(frame)
+            frame[self.random.randrange(len(frame))] ^= \
+                1 << self.random.randrange(8)
+            frame = bytes(frame)
+
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            i = self.random.randrange(len(frame))
+            frame = frame[:i] + frame[i + 1:]
+
+        return frame
+
+# --------------------------------------------------------------------------- #
+# Loopback Transport                                                          #
+# --------------------------------------------------------------------------- #
+
+class MEECU_LoopbackSerial:
+    """
+    In-memory stand-in for a serial.Serial handle connected to a simulator,
+    assigned to MEECU_Connection.handle in place of connect().
+    """
+
+    def __init__(self, simulator, timeout=0.05, baudrate=115200):
+        self.simulator = simulator
+        self.timeout = timeout
+        self.baudrate = baudrate
+        self.is_open = True
+        self.bytes_written = 0
+
+        self._rx = bytearray()
+        self._lock = threading.Lock()
+
+    # ----------------------------------------------------------------------- #
+
+    def _pump(self):
+        self._rx += self.simulator.poll()
+
+    # ----------------------------------------------------------------------- #
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            self._pump()
+            return len(self._rx)
+
+    # ----------------------------------------------------------------------- #
+
+    def read(self, size=1):
+        deadline = time.monotonic() + (self.timeout or 0)
+
+        while True:
+            with self._lock:
+                self._pump()
+                if self._rx or self.timeout is not None and \
+                   time.monotonic() >= deadline:
+                    data = bytes(self._rx[:size])
+                    del self._rx[:size]
+                    return data
+
+                due = self.simulator.next_report_due()
+
+            # Sleep until the next report, or the read times out
+            wait = deadline - time.monotonic()
+            if due is not None:
+                wait = min(wait, due)
+            time.sleep(max(wait, 0.0001))
+
+    # ----------------------------------------------------------------------- #
+
+    def write(self, data):
+        with self._lock:
+            self._rx += self.simulator.receive(data)
+            self.bytes_written += len(data)
+        return len(data)
+
+    # ----------------------------------------------------------------------- #
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._pump()
+            self._rx.clear()
+
+    # ----------------------------------------------------------------------- #
+
+    def close(self):
+        self.is_open = False
+
+# --------------------------------------------------------------------------- #
+# PTY Transport                                                               #
+# --------------------------------------------------------------------------- #
+
+class MEECU_SimulatorPTY:
+    """
+    Serves a simulator on a pseudo-terminal, so the slave path can be opened
+    by anything expecting a serial device, such as MEECU_Connection.
+    """
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.path = None
+
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    # ----------------------------------------------------------------------- #
+
+    def start(self):
+        self._master, self._slave = os.openpty()
+        self.path = os.ttyname(self._slave)
+
+        # Writes wait in _write() instead, where stop() can interrupt them
+        os.set_blocking(self._master, False)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="MEECU simulator")
+        self._thread.start()
+        return self.path
+
+    # ----------------------------------------------------------------------- #
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        os.close(self._master)
+        os.close(self._slave)
+
+    # ----------------------------------------------------------------------- #
+
+    def _run(self):
+        while not self._stop.is_set():
+            due = self.simulator.next_report_due()
+            wait = 0.05 if due is None else min(due, 0.05)
+
+            readable, _, _ = select.select([self._master], [], [], wait)
+            if readable:
+                self._write(self.simulator.receive(os.read(self._master,
+                                                           4096)))
+            self._write(self.simulator.poll())
+
+    # ----------------------------------------------------------------------- #
+
+    def _write(self, data):
+        # Nothing reading the slave side fills the pty, so wait for space
+        # rather than block, in case the simulator is stopped meanwhile
+        while data and not self._stop.is_set():
+            _, writable, _ = select.select([], [self._master], [], 0.05)
+            if not writable:
+                continue
+            try:
+                written = os.write(self._master, data)
+            except BlockingIOError:
+                continue
+            data = data[written:]
+
+    # ----------------------------------------------------------------------- #
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
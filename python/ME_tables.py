@@ -0,0 +1,232 @@
+import glob
+import os
+
+from ME import MEECU_MessageClass, MEECU_TablesCommands, MEECU_Sys_GetHash, \
+               MEECU_Tables_GetDataAtOffset, MEECU_Tables_SetDataAtOffsets, \
+               MEECU_Tables_StoreNVM, MEECU_RequestPipeline
+
+# --------------------------------------------------------------------------- #
+# Table Cache                                                                 #
+# --------------------------------------------------------------------------- #
+
+class MEECU_TableCache:
+    """
+    Table contents kept on disk, one file per table named after the table
+    id and the hash the ECU reported for it. A table only needs reading
+    again once the ECU reports a different hash.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # ----------------------------------------------------------------------- #
+
+    def path(self, table_id, table_hash):
+        return os.path.join(self.cache_dir,
+                            f"table-{table_id:04x}-{table_hash:08x}.bin")
+
+    # ----------------------------------------------------------------------- #
+
+    def get(self, table_id, table_hash):
+        try:
+            with open(self.path(table_id, table_hash), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    # ----------------------------------------------------------------------- #
+
+    def put(self, table_id, table_hash, data):
+        self.discard(table_id)
+
+        # Written to a temporary name first so readers never see half a file
+        path = self.path(table_id, table_hash)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    # ----------------------------------------------------------------------- #
+
+    def discard(self, table_id):
+        """Remove every cached copy of a table."""
+        for path in glob.glob(os.path.join(self.cache_dir,
+                                           f"table-{table_id:04x}-*.bin")):
+            os.remove(path)
+
+# --------------------------------------------------------------------------- #
+# Table Transfer Engine                                                       #
+# --------------------------------------------------------------------------- #
+
+class MEECU_TableEngine:
+    """
+    Reads and writes tables in chunks of chunk_size bytes, keeping up to
+    window chunk requests in flight rather than waiting for each response
+    before sending the next request. Chunks that time out are requested
+    again, up to retries times. While the connection's reader is running,
+    the window must not exceed the 16 responses it holds.
+
+    With a cache directory, read_tables() first fetches the detailed hash
+    and only reads the tables whose hash differs from the cached copy.
+    """
+
+    def __init__(self, conn, cache_dir=None, chunk_size=192, window=8,
+                 retries=3, timeout=None):
+        self.conn = conn
+        self.cache = MEECU_TableCache(cache_dir) if cache_dir else None
+        self.chunk_size = chunk_size
+        self.window = window
+        self.retries = retries
+        self.timeout = timeout
+
+        # Tables served from the cache and chunks requested by the last read
+        self.cached = 0
+        self.requests = 0
+
+    # ----------------------------------------------------------------------- #
+
+    def table_hashes(self):
+        """Return a dict of table id to hash from the ECU, or None."""
+        response = self.conn.send_raw(
+            MEECU_Sys_GetHash.encoded(MEECU_Sys_GetHash.MODE_DETAILED),
+            timeout=self.timeout)
+        if response is None:
+            print("No response to detailed hash request!")
+            return None
+        return response.hashes
+
+    # ----------------------------------------------------------------------- #
+
+    def read_table(self, table_id, size):
+        tables = self.read_tables({table_id: size})
+        return None if tables is None else tables[table_id]
+
+    # ----------------------------------------------------------------------- #
+
+    def read_tables(self, sizes):
+        """
+        Read the tables given as a dict of table id to size in bytes,
+        returning a dict of table id to contents, or None on failure.
+        """
+        tables = {}
+        hashes = {}
+        self.cached = 0
+
+        if self.cache is not None:
+            hashes = self.table_hashes()
+            if hashes is None:
+                return None
+
+            for table_id in sizes:
+                if table_id not in hashes:
+                    continue
+                data = self.cache.get(table_id, hashes[table_id])
+                if data is not None and len(data) == sizes[table_id]:
+                    tables[table_id] = data
+                    self.cached += 1
+
+        missing = {table_id: size for table_id, size in sizes.items()
+                   if table_id not in tables}
+        read = self._read_chunks(missing)
+        if read is None:
+            return None
+
+        for table_id, data in read.items():
+            tables[table_id] = data
+            if self.cache is not None and table_id in hashes:
+                self.cache.put(table_id, hashes[table_id], data)
+
+        return tables
+
+    # ----------------------------------------------------------------------- #
+
+    def _chunks(self, sizes):
+        for table_id, size in sizes.items():
+            for offset in range(0, size, self.chunk_size):
+                yield table_id, offset, min(self.chunk_size, size - offset)
+
+    # ----------------------------------------------------------------------- #
+
+    def _read_chunks(self, sizes):
+        buffers = {table_id: bytearray(size)
+                   for table_id, size in sizes.items()}
+
+        def request(chunk):
+            table_id, offset, length = chunk
+            return MEECU_Tables_GetDataAtOffset.request(
+                table_id, offset, length).to_bytes()
+
+        def complete(chunk, response):
+            table_id, offset, length = chunk
+            if len(response.table_data) != length:
+                return False
+            buffers[table_id][offset:offset + length] = response.table_data
+            return True
+
+        if not self._transfer(self._chunks(sizes), request,
+                              MEECU_TablesCommands.GET_DATA_AT_OFFSET,
+                              complete):
+            return None
+        return {table_id: bytes(data) for table_id, data in buffers.items()}
+
+    # ----------------------------------------------------------------------- #
+
+    def write_table(self, table_id, data, offset=0, store=False):
+        """
+        Write data into a table starting at offset, then have the ECU store
+        its tables to non-volatile memory if store is set.
+
+        The Set Data At Offsets layout hasn't been confirmed against a real
+        ECU, so writes are only committed to NVM when asked for, either with
+        store or with a separate store() once the tables read back right.
+        """
+        data = bytes(data)
+        chunks = ((table_id, offset + start,
+                   data[start:start + self.chunk_size])
+                  for start in range(0, len(data), self.chunk_size))
+
+        rejected = []
+
+        def request(chunk):
+            return MEECU_Tables_SetDataAtOffsets.request(*chunk).to_bytes()
+
+        def complete(chunk, response):
+            if response.status != MEECU_Tables_SetDataAtOffsets.STATUS_OK:
+                print(f"Warning: Table {table_id} write at offset "
+                      f"{chunk[1]} failed with status {response.status}")
+                rejected.append(chunk)
+            return True
+
+        if self.cache is not None:
+            self.cache.discard(table_id)
+
+        if not self._transfer(chunks, request,
+                              MEECU_TablesCommands.SET_DATA_AT_OFFSETS,
+                              complete) or rejected:
+            return False
+
+        return self.store() if store else True
+
+    # ----------------------------------------------------------------------- #
+
+    def store(self):
+        """Have the ECU store its tables to non-volatile memory."""
+        response = self.conn.send_raw(MEECU_Tables_StoreNVM.encoded(),
+                                      timeout=self.timeout)
+        if response is None:
+            print("No response to table store request!")
+            return False
+        return True
+
+    # ----------------------------------------------------------------------- #
+
+    def _transfer(self, chunks, request, command, complete):
+        pipeline = MEECU_RequestPipeline(self.conn, MEECU_MessageClass.TABLES,
+                                         command, self.window, self.retries,
+                                         self.timeout)
+        done = pipeline.run(chunks, request,
+                            lambda response: (response.table_id,
+                                              response.offset),
+                            complete)
+        self.requests = pipeline.requests
+        return done
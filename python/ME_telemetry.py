@@ -0,0 +1,264 @@
+import os
+import struct
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+from ME import MEECU_ReportDecoder
+
+# --------------------------------------------------------------------------- #
+# Shared Memory Telemetry Bus                                                 #
+# --------------------------------------------------------------------------- #
+#
+# The process owning the serial port publishes the latest report into a
+# named shared memory segment, which any number of local processes can read
+# without copying or asking the owner for anything:
+#
+#   Header      magic 'MESH', version, entity count, payload size,
+#               sequence (uint64), timestamp (int64, microseconds)
+#   Entity map  entity count * (id: ushort, type: uchar)
+#   Payload     the report payload, padded to 8 bytes
+#
+# The sequence is a seqlock: it is odd while the payload is being written
+# and incremented again once done, so a reader that sees the same even
+# sequence before and after reading knows it read one whole report.
+#
+# --------------------------------------------------------------------------- #
+
+TELEMETRY_MAGIC   = b'MESH'
+TELEMETRY_VERSION = 1
+
+TELEMETRY_HEADER = struct.Struct('<4sHHI')
+TELEMETRY_ENTITY = struct.Struct('<HB')
+SEQUENCE         = struct.Struct('<Q')
+TIMESTAMP        = struct.Struct('<q')
+
+SEQUENCE_OFFSET  = TELEMETRY_HEADER.size
+TIMESTAMP_OFFSET = SEQUENCE_OFFSET + SEQUENCE.size
+ENTITIES_OFFSET  = TIMESTAMP_OFFSET + TIMESTAMP.size
+
+# Segments published from this process, which the resource tracker has to
+# keep track of for the publisher
+_published = set()
+
+# --------------------------------------------------------------------------- #
+
+def payload_offset(entity_count):
+    # Aligned so the payload doesn't straddle more cache lines than needed
+    end = ENTITIES_OFFSET + entity_count * TELEMETRY_ENTITY.size
+    return (end + 7) & ~7
+
+# --------------------------------------------------------------------------- #
+
+def _attach(name):
+    """
+    Attach to an existing segment, returning (buffer, close). The segment
+    is kept out of the resource tracker, which would otherwise unlink it
+    when the reader exits.
+    """
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name, track=False)
+    else:
+        shm = shared_memory.SharedMemory(name)
+        if os.name == 'posix' and name not in _published:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm.buf, shm.close
+
+# --------------------------------------------------------------------------- #
+# Publisher                                                                   #
+# --------------------------------------------------------------------------- #
+
+class MEECU_TelemetryPublisher:
+    """
+    Owns a telemetry segment laid out for one entity map. It is a connection
+    recorder, so conn.set_recorder(publisher) publishes every report as it
+    arrives. Only one process may publish to a segment.
+    """
+
+    def __init__(self, name, entities):
+        self.name = name
+        self.entities = [{'id': entity['id'], 'type': entity['type']}
+                         for entity in entities]
+        self.decoder = MEECU_ReportDecoder(self.entities)
+        self.payload_size = self.decoder.size
+        self.payload_offset = payload_offset(len(self.entities))
+        self.sequence = 0
+
+        self.shm = shared_memory.SharedMemory(
+            name, create=True, size=self.payload_offset + self.payload_size)
+        _published.add(name)
+        buf = self.shm.buf
+
+        TELEMETRY_HEADER.pack_into(buf, 0, TELEMETRY_MAGIC, TELEMETRY_VERSION,
+                                   len(self.entities), self.payload_size)
+        SEQUENCE.pack_into(buf, SEQUENCE_OFFSET, 0)
+        TIMESTAMP.pack_into(buf, TIMESTAMP_OFFSET, 0)
+        for i, entity in enumerate(self.entities):
+            TELEMETRY_ENTITY.pack_into(
+                buf, ENTITIES_OFFSET + i * TELEMETRY_ENTITY.size,
+                entity['id'], entity['type'])
+
+        self._payload = buf[self.payload_offset:
+                            self.payload_offset + self.payload_size]
+
+    # ----------------------------------------------------------------------- #
+
+    @classmethod
+    def for_decoder(cls, name, decoder):
+        return cls(name, [{'id': entity_id, 'type': etype}
+                          for entity_id, etype in zip(decoder.ids,
+                                                      decoder.types)])
+
+    # ----------------------------------------------------------------------- #
+
+    def write(self, payload, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        if len(payload) != self.payload_size:
+            print(f"Warning: Report payload is {len(payload)} bytes, expected "
+                  f"{self.payload_size}. Not publishing.")
+            return False
+
+        buf = self.shm.buf
+        sequence = self.sequence
+
+        SEQUENCE.pack_into(buf, SEQUENCE_OFFSET, sequence + 1)
+        TIMESTAMP.pack_into(buf, TIMESTAMP_OFFSET,
+                            int(round(timestamp * 1_000_000)))
+        self._payload[:] = payload
+        SEQUENCE.pack_into(buf, SEQUENCE_OFFSET, sequence + 2)
+
+        self.sequence = sequence + 2
+        return True
+
+    # ----------------------------------------------------------------------- #
+
+    def close(self):
+        """Stop publishing and remove the segment."""
+        if self.shm is None:
+            return
+
+        self._payload.release()
+        self.shm.close()
+        self.shm.unlink()
+        _published.discard(self.name)
+        self.shm = None
+
+    # ----------------------------------------------------------------------- #
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# --------------------------------------------------------------------------- #
+# Reader                                                                      #
+# --------------------------------------------------------------------------- #
+
+class MEECU_TelemetryReader:
+    """
+    Reads the latest report from a segment written by a publisher. Values
+    are unpacked straight from shared memory, retrying if the publisher was
+    part way through writing.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._payload = None
+        self.buf, self._close = _attach(name)
+        buf = self.buf
+
+        magic, version, entity_count, self.payload_size = \
+            TELEMETRY_HEADER.unpack_from(buf)
+        if magic != TELEMETRY_MAGIC or version != TELEMETRY_VERSION:
+            self.close()
+            raise ValueError(f"{name} is not a telemetry segment!")
+
+        self.entities = []
+        for i in range(entity_count):
+            entity_id, etype = TELEMETRY_ENTITY.unpack_from(
+                buf, ENTITIES_OFFSET + i * TELEMETRY_ENTITY.size)
+            self.entities.append({'id': entity_id, 'type': etype})
+
+        self.decoder = MEECU_ReportDecoder(self.entities)
+        offset = payload_offset(entity_count)
+        self._payload = buf[offset:offset + self.payload_size]
+        self.sequence = 0
+
+    # ----------------------------------------------------------------------- #
+
+    def subscribe(self, keys, catalogue=None):
+        """Decoder for only the given entities, to pass to read()."""
+        return self.decoder.subscribe(keys, catalogue)
+
+    # ----------------------------------------------------------------------- #
+
+    def read(self, decoder=None):
+        """
+        Return (sequence, timestamp, values) for the latest report, decoded
+        by the given subscription or decoder, or the full entity map decoder
+        by default. Returns None if nothing has been published yet.
+        """
+        if decoder is None:
+            decoder = self.decoder
+
+        buf = self.buf
+        while True:
+            before, = SEQUENCE.unpack_from(buf, SEQUENCE_OFFSET)
+            if before == 0:
+                return None
+            if before & 1:
+                # Publisher is mid-write, which takes microseconds
+                time.sleep(0)
+                continue
+
+            timestamp_us, = TIMESTAMP.unpack_from(buf, TIMESTAMP_OFFSET)
+            values = decoder.decode(self._payload)
+
+            after, = SEQUENCE.unpack_from(buf, SEQUENCE_OFFSET)
+            if after == before:
+                self.sequence = before
+                return before, timestamp_us / 1_000_000, values
+
+    # ----------------------------------------------------------------------- #
+
+    def wait(self, decoder=None, timeout=None, poll_interval=0.001):
+        """
+        Wait for a report newer than the last one read, returning as read()
+        does, or None on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            sequence, = SEQUENCE.unpack_from(self.buf, SEQUENCE_OFFSET)
+            if sequence > self.sequence:
+                result = self.read(decoder)
+                if result is not None:
+                    return result
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_interval)
+
+    # ----------------------------------------------------------------------- #
+
+    def close(self):
+        if self.buf is None:
+            return
+
+        # Views of the mapping have to be released before it can be closed
+        if self._payload is not None:
+            self._payload.release()
+        self.buf.release()
+        self._close()
+        self.buf = None
+
+    # ----------------------------------------------------------------------- #
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+import argparse
+import gc
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from ME import *
+from ME_sim import MEECU_Simulator, MEECU_LoopbackSerial
+
+# --------------------------------------------------------------------------- #
+#
+# Measures the cost of encoding, decoding and framing messages, and of the
+# full read-decode-ACK loop against a simulated ECU, for entity maps of
+# different sizes. Results are written as JSON so runs from different commits
+# can be compared with --compare.
+#
+#   frames_per_s      Frames processed per second
+#   us_per_frame      Microseconds per frame
+#   blocks_per_frame  Memory blocks still held per frame by what each call
+#                     returns, from a separate traced run
+#   bytes_per_frame   Size of those blocks, in bytes
+#   peak_bytes_per_frame
+#                     Peak memory allocated during a call whose result is
+#                     dropped straight away, so short-lived allocations
+#                     are counted even though nothing is kept
+#   gc_per_1k_frames  Generation 0 garbage collections run per 1000 calls
+#
+# --------------------------------------------------------------------------- #
+
+ENTITY_COUNTS = (10, 150, 1000)
+
+# Each timing is the fastest of this many runs, to reduce noise
+REPEAT = 3
+
+# --------------------------------------------------------------------------- #
+
+def report_frame(entity_count):
+    simulator = MEECU_Simulator(entity_count=entity_count)
+    return simulator.decoder, simulator.report_frame()
+
+# --------------------------------------------------------------------------- #
+
+def measure_allocations(func, count):
+    """
+    Per call: blocks and bytes still allocated while the results are kept,
+    the peak bytes allocated during a call with its result dropped, and
+    generation 0 collections run.
+    """
+    results = [None] * count
+    gc.collect()
+
+    tracemalloc.start()
+    before_blocks = sys.getallocatedblocks()
+    before_bytes, _ = tracemalloc.get_traced_memory()
+    for i in range(count):
+        results[i] = func()
+    after_bytes, _ = tracemalloc.get_traced_memory()
+    after_blocks = sys.getallocatedblocks()
+
+    results = None
+    gc.collect()
+
+    # Whatever a call allocates and frees again before returning shows up
+    # in the peak, which the blocks still held afterwards would miss
+    peak_bytes = 0
+    collections = gc.get_stats()[0]['collections']
+    for _ in range(count):
+        tracemalloc.reset_peak()
+        start_bytes, _ = tracemalloc.get_traced_memory()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        peak_bytes += peak - start_bytes
+    collections = gc.get_stats()[0]['collections'] - collections
+    tracemalloc.stop()
+
+    # tracemalloc's own bookkeeping blocks are counted too, so this slightly
+    # overstates small values
+    return (max(0, after_blocks - before_blocks) / count,
+            max(0, after_bytes - before_bytes) / count,
+            peak_bytes / count,
+            collections * 1000 / count)
+
+# --------------------------------------------------------------------------- #
+
+def time_calls(func, count, repeat=REPEAT):
+    best = None
+
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(count):
+                func()
+            seconds = time.perf_counter() - start
+            if best is None or seconds < best:
+                best = seconds
+    finally:
+        gc.enable()
+
+    return best
+
+# --------------------------------------------------------------------------- #
+
+def result(name, entity_count, frames, seconds, allocations=None):
+    """allocations is what measure_allocations() returns, if measured."""
+    blocks, size, peak, collections = allocations or (None,) * 4
+
+    return {
+        'name': name,
+        'entities': entity_count,
+        'frames': frames,
+        'seconds': round(seconds, 6),
+        'frames_per_s': round(frames / seconds, 1),
+        'us_per_frame': round(seconds / frames * 1_000_000, 3),
+        'blocks_per_frame': None if blocks is None else round(blocks, 2),
+        'bytes_per_frame': None if size is None else round(size, 1),
+        'peak_bytes_per_frame': None if peak is None else round(peak, 1),
+        'gc_per_1k_frames': None if collections is None
+                            else round(collections, 2),
+    }
+
+# --------------------------------------------------------------------------- #
+
+def bench_call(name, entity_count, func, count):
+    # Warm up caches, e.g. the decoder and encoded request caches
+    for _ in range(min(count, 100)):
+        func()
+
+    seconds = time_calls(func, count)
+    allocations = measure_allocations(func, min(count, 1000))
+    return result(name, entity_count, count, seconds, allocations)
+
+# --------------------------------------------------------------------------- #
+
+def bench_messages(entity_count, count):
+    decoder, frame = report_frame(entity_count)
+    message = MEECU_Message.from_data(frame)
+
+    return [
+        bench_call('from_data', entity_count,
+                   lambda: MEECU_Message.from_data(frame), count),
+        bench_call('to_bytes', entity_count, message.to_bytes, count),
+        bench_call('calc_crc', entity_count, message._calc_crc, count),
+        bench_call('parse_report', entity_count,
+                   lambda: message.parse_report(decoder), count),
+        bench_call('decode', entity_count,
+                   lambda: decoder.decode(message.payload), count),
+    ]
+
+# --------------------------------------------------------------------------- #
+
+def bench_framer(entity_count, count):
+    _, frame = report_frame(entity_count)
+    data = frame * count
+    framer = MEECU_Framer()
+
+    def run():
+        framer.feed(data)
+        for _ in framer:
+            pass
+
+    seconds = time_calls(run, 1)
+    return result('framer', entity_count, count, seconds)
+
+# --------------------------------------------------------------------------- #
+
+def bench_scanner(entity_count, count):
+    _, frame = report_frame(entity_count)
+    data = frame * count
+
+    def run():
+        for view in iter_frames(data):
+            pass
+
+    seconds = time_calls(run, 1)
+    return result('scanner', entity_count, count, seconds)
+
+# --------------------------------------------------------------------------- #
+
+def bench_loopback(entity_count, count):
+    """
+    Reports read, decoded and acknowledged through a connection's reader
+    thread, from a simulator sending as fast as reports are acknowledged.
+    The simulator runs in the same process, so its cost is included.
+    """
+    simulator = MEECU_Simulator(entity_count=entity_count, report_rate=1e6,
+                                max_unacked=64)
+    simulator.report_payload = report_frame(entity_count)[1][7:-2]
+
+    conn = MEECU_Connection('loopback', 115200)
+    conn.handle = MEECU_LoopbackSerial(simulator)
+
+    session = MEECU_ReportingSession(conn, policy=MEECU_ReportBuffer.BLOCK)
+    if not session.start():
+        return None
+
+    received = 0
+    start = time.perf_counter()
+    for _ in session:
+        received += 1
+        if received == count:
+            break
+    seconds = time.perf_counter() - start
+    session.stop()
+
+    return result('loopback', entity_count, received, seconds)
+
+# --------------------------------------------------------------------------- #
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# --------------------------------------------------------------------------- #
+
+def run_benchmarks(entity_counts=ENTITY_COUNTS, count=10000,
+                   loopback_count=2000):
+    results = []
+    for entity_count in entity_counts:
+        results += bench_messages(entity_count, count)
+        results.append(bench_framer(entity_count, count))
+        results.append(bench_scanner(entity_count, count))
+        if loopback_count:
+            loopback = bench_loopback(entity_count, loopback_count)
+            if loopback is not None:
+                results.append(loopback)
+
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+# --------------------------------------------------------------------------- #
+
+def compare(baseline, current, threshold):
+    """
+    Print the change in µs per frame against a baseline run, returning the
+    number of benchmarks slower by more than threshold percent.
+    """
+    previous = {(r['name'], r['entities']): r for r in baseline['results']}
+    regressions = 0
+
+    for r in current['results']:
+        old = previous.get((r['name'], r['entities']))
+        if old is None:
+            continue
+
+        change = (r['us_per_frame'] / old['us_per_frame'] - 1) * 100
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{r['name']:>14} {r['entities']:>5} entities: "
+              f"{old['us_per_frame']:>10.3f} -> {r['us_per_frame']:>10.3f} "
+              f"us/frame ({change:+.1f}%){flag}", file=sys.stderr)
+
+    return regressions
+
+# --------------------------------------------------------------------------- #
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark message encoding, decoding and framing.")
+    parser.add_argument('-n', '--count', type=int, default=10000,
+                        help="frames per benchmark")
+    parser.add_argument('-e', '--entities', type=int, nargs='+',
+                        default=list(ENTITY_COUNTS),
+                        help="entity map sizes to benchmark")
+    parser.add_argument('--loopback-count', type=int, default=2000,
+                        help="reports for the loopback benchmark, 0 to skip")
+    parser.add_argument('-o', '--output', help="write results to a file")
+    parser.add_argument('--compare', help="results file from a previous run")
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help="slowdown in percent counted as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.entities, args.count, args.loopback_count)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+# --------------------------------------------------------------------------- #
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 from ME import *
+from ME_link import MEECU_LinkProbe, MEECU_LinkMonitor
 import serial
 import time
 import struct
@@ -7,9 +8,18 @@ from serial.serialutil import SerialException
 
 # --------------------------------------------------------------------------- #
 
-def main():
-    entity_map = None
+RPM_ID          = 1
+COOLANT_TEMP_ID = 14
+
+# Find the ECU's baud rate before starting, rather than assuming 115200.
+# Off by default as it takes a few seconds: each rate the ECU isn't using
+# costs a few timed out requests, and the rate it is using a burst of
+# reports (see MEECU_LinkProbe)
+PROBE_BAUD_RATE = False
 
+# --------------------------------------------------------------------------- #
+
+def main():
     conn = MEECU_Connection('/dev/ttyUSB0', 115200)
     if conn.connect():
         print("Connected to ECU successfully!")
@@ -17,42 +27,45 @@ def main():
         print("Failed to connect to ECU!")
         return
 
+    if PROBE_BAUD_RATE:
+        result = MEECU_LinkProbe(conn).select()
+        if result is not None:
+            print(f"Using {result.baud_rate} baud, "
+                  f"{result.bytes_per_s / 1000:.1f} kB/s")
+
     # Get ECU Info
-    response = conn.send_message(MEECU_Sys_GetECUInfo())
+    response = conn.send_raw(MEECU_Sys_GetECUInfo.encoded())
     print(response)
 
     # Get Hash Table
-    message = MEECU_Sys_GetHash()
-    message.set_mode(MEECU_Sys_GetHash.MODE_DETAILED)
-    response = conn.send_message(message)
-    print(response)
-
-    # Set Reporting State
-    message = MEECU_Reporting_SetState()
-    message.set_state(True)
-    response = conn.send_message(message)
+    response = conn.send_raw(
+        MEECU_Sys_GetHash.encoded(MEECU_Sys_GetHash.MODE_DETAILED))
     print(response)
-    if response is not None:
-        print(f"Received info on {len(response.entities)} entities")
-        entity_map = response.entities
 
-    # Receive Reports
-    while(True):
-        rx_bytes = conn.receive_message()
-        if rx_bytes is not None:
-            message = MEECU_Message.from_data(rx_bytes)
-            message.parse_report(entity_map)
-
-            for entity in message.entities:
-                if entity['id'] == 1:
-                    print(f"RPM:           {entity['value']}")
+    # Enable reporting, with each report acknowledged by the connection so
+    # it keeps sending us data
+    session = MEECU_ReportingSession(conn)
+    if not session.start():
+        return
+    print(f"Received info on {len(session.entities)} entities")
 
-                if entity['id'] == 14:
-                    print(f"Coolant Temp.: {entity['value']}")
+    # Restarts the session if errors start creeping in, probing for the
+    # ECU's rate again if it stops answering, which ends iteration over the
+    # old session
+    monitor = MEECU_LinkMonitor(conn, session)
+    reconnects = None
 
+    # Receive Reports, only decoding the RPM and coolant temperature
+    while reconnects != monitor.reconnects:
+        reconnects = monitor.reconnects
+        conn.subscribe([RPM_ID, COOLANT_TEMP_ID])
+        for message in session:
+            monitor.check()
+            if message.values is None:
+                continue
 
-            # Send an ack or it'll eventually stop sending us data
-            conn.send_message(MEECU_Reporting_SendAck())
+            print(f"RPM:           {message.values[RPM_ID]}")
+            print(f"Coolant Temp.: {message.values[COOLANT_TEMP_ID]}")
 
 # --------------------------------------------------------------------------- #
 
@@ -1,18 +1,14 @@
-import xml.etree.ElementTree as ET
+import sys
+from ME_medef import MEECU_EntityCatalogue
 
-# Assuming the XML content is stored in a file named 'data.xml'
+# Assuming the definitions are stored in the MEITE resources file by default
 xml_file = 'MEITEResources.Defs.ME221.Generic.ME221-GENERIC_v86.medef'
+if len(sys.argv) > 1:
+    xml_file = sys.argv[1]
 
-# Parse the XML file
-tree = ET.parse(xml_file)
-root = tree.getroot()
-
-# Find all 'DataLinkModel' elements
-datalink_models = root.findall('.//DataLinkModel')
-
-# Iterate over each model and print its 'id' and 'name'
-for model in datalink_models:
-    model_id = model.find('id').text
-    model_name = model.find('name').text
-    print(f"ID: {model_id}, Name: {model_name}")
+# Parse the file, or load the cached catalogue if it hasn't changed
+catalogue = MEECU_EntityCatalogue.load(xml_file)
 
+# Iterate over each entity and print its 'id' and 'name'
+for entity in catalogue.entities:
+    print(f"ID: {entity.id}, Name: {entity.name}")
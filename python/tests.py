@@ -1,5 +1,111 @@
+import asyncio
+import io
+import os
+import select
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+from unittest import mock
 from ME import *
+from ME_async import MEECU_AsyncConnection
+from ME_session import MEECU_SessionWriter, MEECU_SessionReader
+from ME_medef import MEECU_Entity, MEECU_EntityCatalogue, parse_medef
+from ME_manager import MEECU_ConnectionManager
+from ME_delta import MEECU_DeltaEncoder, MEECU_DeltaDecoder, \
+                     MEECU_DeltaRecorder, read_delta_stream
+from ME_sim import MEECU_Simulator, MEECU_LoopbackSerial, MEECU_SimulatorPTY, \
+                   build_frame
+from ME_replay import MEECU_Capture, MEECU_ReplayConnection
+from ME_aggregate import MEECU_WindowStats, aggregate, decimate, \
+                         on_change, timestamped
+from ME_telemetry import MEECU_TelemetryPublisher, MEECU_TelemetryReader
+from ME_tables import MEECU_TableEngine
+from ME_datalog import MEECU_DatalogDownloader, capture_trigger_log, \
+                       read_trigger_log
+from ME_link import MEECU_LinkProbe, MEECU_LinkMonitor, error_rate
+import benchmark
+
+try:
+    import ME_batch
+except ImportError:
+    ME_batch = None
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', 'sample-data')
+
+def load_sample(name):
+    with open(os.path.join(SAMPLE_DIR, name), 'rb') as f:
+        return f.read()
+
+def first_frame(data):
+    length, = struct.unpack_from('<H', data, 2)
+    return data[:7 + length + 2]
+
+class FakeSerial:
+    """Minimal stand-in for serial.Serial with a scripted receive buffer."""
+
+    def __init__(self, rx=b'', replies=None):
+        self.rx = bytearray(rx)
+        self.tx = bytearray()
+        self.is_open = True
+        # Written request bytes to the data to receive in reply
+        self.replies = replies or {}
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def read(self, size=1):
+        if not self.rx:
+            # Behave like a port opened with a short read timeout
+            time.sleep(0.001)
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    def write(self, data):
+        self.tx += data
+        self.rx += self.replies.get(bytes(data), b'')
+        return len(data)
+
+def pty_responder(replies):
+    """
+    Open a pty and answer requests written to its slave side from a thread.
+    Returns the slave path and a function that stops the responder.
+    """
+    master, slave = os.openpty()
+    stop = threading.Event()
+
+    def respond():
+        received = b''
+        while not stop.is_set():
+            readable, _, _ = select.select([master], [], [], 0.01)
+            if not readable:
+                continue
+            received += os.read(master, 4096)
+            for request, reply in list(replies.items()):
+                if request in received:
+                    received = received.replace(request, b'', 1)
+                    os.write(master, reply)
+
+    thread = threading.Thread(target=respond, daemon=True)
+    thread.start()
+
+    def close():
+        stop.set()
+        thread.join()
+        os.close(master)
+        os.close(slave)
+
+    return os.ttyname(slave), close
+
+def fake_connection(rx=b''):
+    conn = MEECU_Connection('/dev/null', 115200, timeout=0.05)
+    conn.handle = FakeSerial(rx)
+    return conn
 
 VALID_GETECUINFO = '4d4500000004000408'
 VALID_GETHASH_DETAILED = '4d45010000040101060f'
@@ -7,6 +113,7 @@ VALID_GETHASH_OVERALL = '4d45010000040100050e'
 VALID_REP_SETSTATE_ENABLE = '4d450100000002010305'
 VALID_REP_SETSTATE_DISABLE = '4d450100000002000204'
 VALID_REP_SEND_ACK = '4d450100000001000102'
+VALID_REP_SEND_ACK_BYTES = bytes.fromhex(VALID_REP_SEND_ACK)
 
 class TestECUMessages(unittest.TestCase):
 
@@ -103,6 +210,1729 @@ class TestECUMessages(unittest.TestCase):
             "Parsed Reporting_SendAck did not reproduce the same hex!")
 
 
+class TestEncodedRequests(unittest.TestCase):
+
+    def test_encoded_requests(self):
+        self.assertEqual(MEECU_Sys_GetECUInfo.encoded().hex(),
+                         VALID_GETECUINFO)
+        self.assertEqual(MEECU_Reporting_SendAck.encoded().hex(),
+                         VALID_REP_SEND_ACK)
+        self.assertEqual(
+            MEECU_Sys_GetHash.encoded(MEECU_Sys_GetHash.MODE_OVERALL).hex(),
+            VALID_GETHASH_OVERALL)
+        self.assertEqual(
+            MEECU_Sys_GetHash.encoded(MEECU_Sys_GetHash.MODE_DETAILED).hex(),
+            VALID_GETHASH_DETAILED)
+        self.assertEqual(MEECU_Reporting_SetState.encoded(False).hex(),
+                         VALID_REP_SETSTATE_DISABLE)
+
+    def test_encoded_requests_are_cached(self):
+        self.assertIs(MEECU_Reporting_SetState.encoded(True),
+                      MEECU_Reporting_SetState.encoded(True))
+
+    def test_messages_are_slotted(self):
+        for message in (MEECU_Sys_GetECUInfo(), MEECU_Reporting_SetState(),
+                        MEECU_Message.from_data(VALID_REP_SEND_ACK)):
+            self.assertFalse(hasattr(message, '__dict__'))
+
+    def test_send_raw(self):
+        set_state = first_frame(load_sample('set-state-response.bin'))
+        enable = MEECU_Reporting_SetState.encoded(True)
+        conn = fake_connection()
+        conn.handle.replies[enable] = set_state
+
+        response = conn.send_raw(enable)
+        self.assertIsInstance(response, MEECU_Reporting_SetState)
+        self.assertEqual(bytes(conn.handle.tx), enable)
+
+
+class TestMessageDispatch(unittest.TestCase):
+
+    def test_dispatch_table_registered(self):
+        for subclass in (MEECU_Sys_GetECUInfo, MEECU_Sys_GetHash,
+                         MEECU_Reporting_SetState, MEECU_Reporting_SendAck,
+                         MEECU_Reporting_SendReport):
+            key = (subclass.CLASS.value, subclass.COMMAND.value)
+            self.assertIs(MEECU_Message._dispatch[key], subclass)
+
+    def test_unknown_command_not_dispatched(self):
+        # DBW class has no message subclasses
+        self.assertIsNone(MEECU_Message.from_data('4d4500000008000008'))
+
+    def test_header_fields_from_data(self):
+        message = MEECU_Message.from_data(VALID_GETHASH_DETAILED)
+        self.assertIs(message.rtype, MEECU_MessageType.REQUEST)
+        self.assertIs(message.rclass, MEECU_MessageClass.SYSTEM)
+        self.assertIs(message.command, MEECU_SysCommands.GET_HASH)
+        self.assertEqual(message.length, 1)
+        self.assertEqual(message.payload, b'\x01')
+
+
+class TestCRC(unittest.TestCase):
+
+    def reference_crc(self, data):
+        num = 0
+        num2 = 0
+        for byte in data:
+            num = (num + byte) % 255
+            num2 = (num2 + num) % 255
+        return (num2 << 8) | num
+
+    def test_calc_crc_matches_reference(self):
+        report = load_sample('send-report-response.bin')
+        for data in (b'', b'\x00', b'\xff' * 300, report[4:-2], report):
+            self.assertEqual(calc_crc(data), self.reference_crc(data))
+
+    def test_incremental_update(self):
+        data = load_sample('send-report-response.bin')[4:-2]
+        crc = MEECU_CRC()
+        for i in range(0, len(data), 37):
+            crc.update(data[i:i + 37])
+        self.assertEqual(crc.digest(), calc_crc(data))
+
+    def test_received_crc_checked(self):
+        report = load_sample('send-report-response.bin')
+        self.assertTrue(MEECU_Message.from_data(report).crc_valid)
+
+        corrupt = bytearray(report)
+        corrupt[20] ^= 0x01
+        self.assertFalse(MEECU_Message.from_data(bytes(corrupt)).crc_valid)
+
+    def test_verified_frames_not_checked_again(self):
+        report = load_sample('send-report-response.bin')
+        framer = MEECU_Framer()
+        framer.feed(report)
+        frame = framer.next_frame()
+
+        with mock.patch('ME.calc_crc') as crc:
+            message = MEECU_Message.from_data(frame, verified=True)
+            crc.assert_not_called()
+        self.assertTrue(message.crc_valid)
+        self.assertEqual(message.crc, MEECU_Message.from_data(report).crc)
+
+
+class TestReportDecoder(unittest.TestCase):
+
+    def setUp(self):
+        MEECU_ReportDecoder._cached = None
+        self.set_state = MEECU_Message.from_data(
+            first_frame(load_sample('set-state-response.bin')))
+        self.report_data = load_sample('send-report-response.bin')
+
+    def test_decoder_matches_per_entity_unpack(self):
+        payload = MEECU_Message.from_data(self.report_data).payload
+        decoder = self.set_state.get_decoder()
+        self.assertEqual(decoder.size, len(payload))
+
+        offset = 1
+        for entity, value in zip(self.set_state.entities,
+                                 decoder.decode(payload)):
+            etype = MEECU_ReportingType(entity['type'])
+            expected, = struct.unpack_from(etype._format, payload, offset)
+            self.assertEqual(value, expected)
+            offset += etype._length
+
+    def test_parse_report_entities(self):
+        message = MEECU_Message.from_data(self.report_data)
+        message.parse_report(self.set_state.entities)
+        self.assertEqual(len(message.entities), 150)
+        self.assertEqual(message.entities[0], {'id': 3, 'type': 4, 'value': 0})
+        self.assertEqual(message.entities[1]['value'], 31333)
+
+    def test_decoder_cached_until_entity_map_changes(self):
+        entities = self.set_state.entities
+        decoder = MEECU_ReportDecoder.for_entities(entities)
+        self.assertIs(MEECU_ReportDecoder.for_entities(entities), decoder)
+
+        # An equal map from another SetState response reuses it as well
+        copy = [dict(entity) for entity in entities]
+        self.assertIs(MEECU_ReportDecoder.for_entities(copy), decoder)
+
+        changed = entities[:-1]
+        self.assertIsNot(MEECU_ReportDecoder.for_entities(changed), decoder)
+
+
+class TestReportSubscription(unittest.TestCase):
+
+    def setUp(self):
+        set_state = MEECU_Message.from_data(
+            first_frame(load_sample('set-state-response.bin')))
+        self.decoder = set_state.get_decoder()
+        self.entities = set_state.entities
+        self.payload = MEECU_Message.from_data(
+            load_sample('send-report-response.bin')).payload
+
+    def test_subset_matches_full_decode(self):
+        values = self.decoder.decode(self.payload)
+        ids = [self.entities[i]['id'] for i in (100, 3, 57, 149)]
+
+        subscription = self.decoder.subscribe(ids)
+        self.assertEqual(subscription.decode(self.payload),
+                         {entity_id: values[self.decoder.index[entity_id]]
+                          for entity_id in ids})
+
+    def test_subscribe_by_name(self):
+        catalogue = MEECU_EntityCatalogue([MEECU_Entity(17, 'RPM'),
+                                           MEECU_Entity(18, 'MAP')])
+
+        subscription = self.decoder.subscribe(['RPM', 'MAP'], catalogue)
+        decoded = subscription.decode(self.payload)
+        self.assertEqual(decoded['RPM'], 31333)
+        self.assertEqual(set(decoded), {'RPM', 'MAP'})
+
+    def test_unknown_entity(self):
+        with self.assertRaises(KeyError):
+            self.decoder.subscribe([0xFFFF])
+
+    def test_connection_subscription(self):
+        set_state = first_frame(load_sample('set-state-response.bin'))
+        report = load_sample('send-report-response.bin')
+
+        conn = fake_connection(set_state)
+        conn.wait_for_response(MEECU_MessageClass.REPORTING,
+                               MEECU_ReportingCommands.SET_STATE)
+        conn.subscribe([17])
+        conn.handle.rx += report
+
+        message = conn.receive_report()
+        self.assertEqual(message.values, {17: 31333})
+        self.assertEqual(message.entities, [])
+
+    def test_subscription_without_entity_map(self):
+        conn = fake_connection()
+        with self.assertRaises(ValueError):
+            conn.subscribe([17])
+        self.assertIsNone(conn.subscribe(None))
+
+
+class TestFramer(unittest.TestCase):
+
+    def setUp(self):
+        self.set_state = first_frame(load_sample('set-state-response.bin'))
+        self.report = load_sample('send-report-response.bin')
+        self.stream = self.set_state + self.report
+
+    def test_frames_from_small_chunks(self):
+        framer = MEECU_Framer()
+        frames = []
+        for i in range(0, len(self.stream), 7):
+            framer.feed(self.stream[i:i + 7])
+            frames.extend(bytes(frame) for frame in framer)
+
+        self.assertEqual(frames, [self.set_state, self.report])
+        self.assertEqual(framer.dropped, 0)
+        self.assertEqual(framer.pending(), 0)
+
+    def test_frames_are_memoryviews(self):
+        framer = MEECU_Framer()
+        framer.feed(self.report)
+        frame = framer.next_frame()
+        self.assertIsInstance(frame, memoryview)
+        self.assertEqual(MEECU_Message.from_data(frame).__class__,
+                         MEECU_Reporting_SendReport)
+
+    def test_resync_after_leading_garbage(self):
+        framer = MEECU_Framer()
+        framer.feed(b'\x01\x02ME\xff' + self.report[200:] + self.report)
+        self.assertEqual([bytes(frame) for frame in framer], [self.report])
+        self.assertGreater(framer.dropped, 0)
+
+    def test_resync_after_corrupt_frame(self):
+        corrupt = bytearray(self.report)
+        corrupt[100] ^= 0x01
+
+        framer = MEECU_Framer()
+        framer.feed(bytes(corrupt) + VALID_REP_SEND_ACK_BYTES)
+        self.assertEqual([bytes(frame) for frame in framer],
+                         [VALID_REP_SEND_ACK_BYTES])
+        self.assertEqual(framer.dropped, len(corrupt))
+        self.assertGreaterEqual(framer.resyncs, 1)
+
+    def test_resync_after_corrupt_length(self):
+        # A length claiming far more bytes than follow mustn't hold back
+        # the frames after it until that many have arrived
+        corrupt = bytearray(self.report)
+        corrupt[3] = 0xF0
+        stream = bytes(corrupt) + self.report * 150
+
+        framer = MEECU_Framer()
+        frames = []
+        for i in range(0, len(stream), 64):
+            framer.feed(stream[i:i + 64])
+            frames.extend(bytes(frame) for frame in framer)
+
+        self.assertEqual(frames, [self.report] * 150)
+        self.assertEqual(framer.dropped, len(corrupt))
+        self.assertEqual(framer.pending(), 0)
+
+    def test_partial_frame_is_kept(self):
+        framer = MEECU_Framer()
+        framer.feed(self.report[:-1])
+        self.assertIsNone(framer.next_frame())
+        framer.feed(self.report[-1:])
+        self.assertEqual(bytes(framer.next_frame()), self.report)
+
+
+class TestConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.set_state = first_frame(load_sample('set-state-response.bin'))
+        self.report = load_sample('send-report-response.bin')
+
+    def test_response_matched_past_reports(self):
+        conn = fake_connection(self.report + self.set_state + self.report)
+        message = MEECU_Reporting_SetState()
+        message.set_state(True)
+
+        response = conn.send_message(message)
+        self.assertIsInstance(response, MEECU_Reporting_SetState)
+        self.assertEqual(len(response.entities), 150)
+        self.assertEqual(bytes(conn.handle.tx),
+                         bytes.fromhex(VALID_REP_SETSTATE_ENABLE))
+
+        # The report received before the response is queued, the one after
+        # it is still waiting in the framer/port
+        self.assertEqual(len(conn.reports), 1)
+        self.assertIsInstance(conn.receive_report(),
+                              MEECU_Reporting_SendReport)
+        self.assertIsInstance(conn.receive_report(),
+                              MEECU_Reporting_SendReport)
+        self.assertIsNone(conn.receive_report())
+
+    def test_response_deadline(self):
+        conn = fake_connection(self.report)
+        response = conn.send_message(MEECU_Sys_GetECUInfo(), timeout=0.01)
+        self.assertIsNone(response)
+        self.assertEqual(len(conn.reports), 1)
+
+
+class TestFrameScanner(unittest.TestCase):
+
+    def test_capture(self):
+        scanner = MEECU_FrameScanner(load_sample('set-state-response.bin'))
+        frames = list(scanner)
+
+        self.assertEqual([(f.offset, f.rclass, f.command) for f in frames],
+                         [(0, 0x00, 0x02), (462, 0x00, 0x00)])
+        self.assertIsInstance(frames[1].payload, memoryview)
+        self.assertTrue(frames[1].is_report())
+        self.assertEqual(len(frames[0].message().entities), 150)
+        # The trailing partial frame is skipped
+        self.assertEqual(scanner.frames, 2)
+        self.assertGreater(scanner.dropped, 0)
+
+    def test_noise(self):
+        report = load_sample('send-report-response.bin')
+        corrupt = bytearray(report)
+        corrupt[100] ^= 0x01
+        data = bytearray(b'\x00ME\xff' + report + corrupt + b'junk' + report)
+
+        scanner = MEECU_FrameScanner(data)
+        frames = list(scanner)
+        self.assertEqual([f.offset for f in frames],
+                         [4, 4 + 2 * len(report) + 4])
+        self.assertEqual(scanner.crc_failures, 1)
+        self.assertEqual(bytes(frames[0].data), report)
+
+        unverified = list(iter_frames(data, verify=False))
+        self.assertEqual(len(unverified), 3)
+
+    def test_mmap(self):
+        import mmap
+        with open(os.path.join(SAMPLE_DIR, 'send-report-response.bin'),
+                  'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        frame, = iter_frames(mapping)
+        self.assertEqual(frame.crc, calc_crc(mapping[4:-2]))
+        frame.release()
+        mapping.close()
+
+
+class TestReportBuffer(unittest.TestCase):
+
+    def test_drop_oldest(self):
+        buffer = MEECU_ReportBuffer(2)
+        for i in range(3):
+            self.assertTrue(buffer.put(i))
+        self.assertEqual(buffer.dropped, 1)
+        self.assertEqual([buffer.get(block=False) for _ in range(3)],
+                         [1, 2, None])
+
+    def test_block_until_consumed(self):
+        buffer = MEECU_ReportBuffer(1, MEECU_ReportBuffer.BLOCK)
+        buffer.put(0)
+        self.assertFalse(buffer.put(1, timeout=0.01))
+
+        consumer = threading.Timer(0.01, buffer.get)
+        consumer.start()
+        self.assertTrue(buffer.put(2, timeout=1.0))
+        consumer.join()
+        self.assertEqual(list(buffer._items), [2])
+
+    def test_iteration_ends_when_closed(self):
+        buffer = MEECU_ReportBuffer()
+        buffer.put('a')
+        buffer.put('b')
+        buffer.close()
+        self.assertEqual(list(buffer), ['a', 'b'])
+
+
+class TestConnectionReader(unittest.TestCase):
+
+    def test_reader_decodes_reports_and_matches_responses(self):
+        set_state = first_frame(load_sample('set-state-response.bin'))
+        report = load_sample('send-report-response.bin')
+
+        conn = fake_connection()
+        conn.start_reader()
+        try:
+            conn.handle.rx += set_state
+            response = conn.wait_for_response(
+                MEECU_MessageClass.REPORTING,
+                MEECU_ReportingCommands.SET_STATE, timeout=1.0)
+            self.assertIsInstance(response, MEECU_Reporting_SetState)
+
+            conn.handle.rx += report + report
+            reports = conn.iter_reports()
+            for _ in range(2):
+                message = next(reports)
+                self.assertEqual(len(message.entities), 150)
+        finally:
+            conn.stop_reader()
+
+    def test_reader_survives_bad_report(self):
+        set_state = first_frame(load_sample('set-state-response.bin'))
+        report = load_sample('send-report-response.bin')
+
+        # A report with a valid CRC but too short for the entity map
+        short = MEECU_Reporting_SendReport()
+        short.rtype = MEECU_MessageType.RESPONSE
+        short.payload = b'\x00' * 10
+
+        conn = fake_connection(set_state)
+        conn.start_reader()
+        try:
+            conn.wait_for_response(MEECU_MessageClass.REPORTING,
+                                   MEECU_ReportingCommands.SET_STATE, 1.0)
+            with mock.patch('builtins.print'):
+                conn.handle.rx += short.to_bytes() + report
+                message = next(conn.iter_reports())
+            self.assertEqual(len(message.entities), 150)
+            self.assertEqual(conn.frame_errors, 1)
+            self.assertTrue(conn._reader.is_alive())
+        finally:
+            conn.stop_reader()
+
+    def test_acks_and_requests_do_not_interleave(self):
+        report = load_sample('send-report-response.bin')
+
+        class SlowSerial(FakeSerial):
+            # Written a byte at a time, giving other threads a chance to
+            # write in between
+            def write(self, data):
+                for byte in bytes(data):
+                    self.tx.append(byte)
+                    time.sleep(0)
+                return len(data)
+
+        conn = MEECU_Connection('/dev/null', 115200, timeout=0.05)
+        conn.handle = SlowSerial(report * 200)
+        conn.set_auto_ack(1)
+        conn.start_reader()
+        try:
+            request = MEECU_Sys_GetECUInfo.encoded()
+            for _ in range(200):
+                conn.send_raw(request, recv=False)
+            deadline = time.monotonic() + 2.0
+            while conn.handle.rx and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            conn.stop_reader()
+
+        framer = MEECU_Framer()
+        framer.feed(bytes(conn.handle.tx))
+        frames = [bytes(frame) for frame in framer]
+        self.assertEqual(framer.resyncs, 0)
+        self.assertEqual(frames.count(request), 200)
+        self.assertEqual(frames.count(VALID_REP_SEND_ACK_BYTES), 200)
+
+    def test_reports_end_when_reader_fails(self):
+        conn = fake_connection()
+        conn.handle.read = mock.Mock(side_effect=OSError("device gone"))
+        with mock.patch('builtins.print'):
+            conn.start_reader()
+            self.assertEqual(list(conn.iter_reports()), [])
+        conn.stop_reader()
+
+
+class TestReportingSession(unittest.TestCase):
+
+    def test_session_acks_and_decodes_reports(self):
+        set_state = first_frame(load_sample('set-state-response.bin'))
+        report = load_sample('send-report-response.bin')
+        enable = bytes.fromhex(VALID_REP_SETSTATE_ENABLE)
+
+        conn = fake_connection()
+        conn.handle.replies[enable] = set_state + report * 4
+
+        session = MEECU_ReportingSession(conn, ack_every=2)
+        self.assertTrue(session.start())
+        self.assertEqual(len(session.entities), 150)
+
+        reports = iter(session)
+        for _ in range(4):
+            self.assertEqual(len(next(reports).entities), 150)
+        session.stop()
+
+        tx = bytes(conn.handle.tx)
+        self.assertTrue(tx.startswith(enable))
+        self.assertEqual(tx.count(VALID_REP_SEND_ACK_BYTES), 2)
+        self.assertTrue(tx.endswith(bytes.fromhex(VALID_REP_SETSTATE_DISABLE)))
+
+
+class TestAsyncConnection(unittest.TestCase):
+
+    def test_request_and_reports_over_pty(self):
+        set_state = first_frame(load_sample('set-state-response.bin'))
+        report = load_sample('send-report-response.bin')
+
+        master, slave = os.openpty()
+        self.addCleanup(os.close, master)
+        self.addCleanup(os.close, slave)
+
+        async def run():
+            conn = MEECU_AsyncConnection(os.ttyname(slave), 115200)
+            self.assertTrue(await conn.connect())
+            try:
+                loop = asyncio.get_running_loop()
+                loop.call_later(0.01, os.write, master, set_state + report)
+                response = await conn.start_reporting(timeout=1.0)
+                self.assertIsInstance(response, MEECU_Reporting_SetState)
+
+                message = await asyncio.wait_for(
+                    conn.reports().__anext__(), 1.0)
+                self.assertEqual(len(message.entities), 150)
+                await asyncio.sleep(0.01)
+            finally:
+                conn.close()
+
+            sent = os.read(master, 1024)
+            self.assertIn(bytes.fromhex(VALID_REP_SETSTATE_ENABLE), sent)
+            self.assertIn(VALID_REP_SEND_ACK_BYTES, sent)
+
+        asyncio.run(run())
+
+    def test_request_timeout(self):
+        master, slave = os.openpty()
+        self.addCleanup(os.close, master)
+        self.addCleanup(os.close, slave)
+
+        async def run():
+            conn = MEECU_AsyncConnection(os.ttyname(slave), 115200)
+            await conn.connect()
+            try:
+                response = await conn.request(MEECU_Sys_GetECUInfo(), 0.01)
+                self.assertIsNone(response)
+            finally:
+                conn.close()
+
+        asyncio.run(run())
+
+    def test_concurrent_requests_with_same_command(self):
+        master, slave = os.openpty()
+        self.addCleanup(os.close, master)
+        self.addCleanup(os.close, slave)
+
+        responses = [build_frame(MEECU_MessageClass.SYSTEM,
+                                 MEECU_SysCommands.GET_ECU_INFO, name)
+                     for name in (b'first', b'second')]
+
+        async def run():
+            conn = MEECU_AsyncConnection(os.ttyname(slave), 115200)
+            await conn.connect()
+            try:
+                loop = asyncio.get_running_loop()
+                loop.call_later(0.01, os.write, master, b''.join(responses))
+                first, second = await asyncio.gather(
+                    conn.request(MEECU_Sys_GetECUInfo(), 1.0),
+                    conn.request(MEECU_Sys_GetECUInfo(), 1.0))
+            finally:
+                conn.close()
+
+            self.assertEqual(first.payload, b'first')
+            self.assertEqual(second.payload, b'second')
+
+        asyncio.run(run())
+
+    def test_late_response_not_handed_on(self):
+        master, slave = os.openpty()
+        self.addCleanup(os.close, master)
+        self.addCleanup(os.close, slave)
+
+        late, second = (build_frame(MEECU_MessageClass.SYSTEM,
+                                    MEECU_SysCommands.GET_ECU_INFO, name)
+                        for name in (b'late', b'second'))
+
+        async def run():
+            conn = MEECU_AsyncConnection(os.ttyname(slave), 115200)
+            await conn.connect()
+            try:
+                loop = asyncio.get_running_loop()
+                loop.call_later(0.1, os.write, master, late)
+                loop.call_later(0.15, os.write, master, second)
+                return await asyncio.gather(
+                    conn.request(MEECU_Sys_GetECUInfo(), 0.05),
+                    conn.request(MEECU_Sys_GetECUInfo(), 1.0))
+            finally:
+                conn.close()
+
+        first, second = asyncio.run(run())
+        self.assertIsNone(first)
+        self.assertEqual(second.payload, b'second')
+
+    def test_reader_survives_bad_frame(self):
+        master, slave = os.openpty()
+        self.addCleanup(os.close, master)
+        self.addCleanup(os.close, slave)
+
+        # Too short for the float the entity map says it holds
+        bad = build_frame(MEECU_MessageClass.REPORTING,
+                          MEECU_ReportingCommands.SEND_REPORT, b'\x00\x01')
+        response = build_frame(MEECU_MessageClass.SYSTEM,
+                               MEECU_SysCommands.GET_ECU_INFO, b'info')
+
+        async def run():
+            conn = MEECU_AsyncConnection(os.ttyname(slave), 115200)
+            await conn.connect()
+            conn.decoder = MEECU_ReportDecoder([{'id': 1, 'type': 0}])
+            try:
+                asyncio.get_running_loop().call_later(
+                    0.01, os.write, master, bad + response)
+                with mock.patch('builtins.print'):
+                    message = await conn.request(MEECU_Sys_GetECUInfo(), 1.0)
+                return message, conn.frame_errors
+            finally:
+                conn.close()
+
+        message, frame_errors = asyncio.run(run())
+        self.assertEqual(message.payload, b'info')
+        self.assertEqual(frame_errors, 1)
+
+    def test_reports_end_on_close(self):
+        master, slave = os.openpty()
+        self.addCleanup(os.close, master)
+        self.addCleanup(os.close, slave)
+
+        async def run():
+            conn = MEECU_AsyncConnection(os.ttyname(slave), 115200)
+            await conn.connect()
+            asyncio.get_running_loop().call_later(0.01, conn.close)
+            return [report async for report in conn.reports()]
+
+        self.assertEqual(asyncio.run(asyncio.wait_for(run(), 1.0)), [])
+
+
+@unittest.skipIf(ME_batch is None, "NumPy is not installed")
+class TestBatchDecoding(unittest.TestCase):
+
+    def setUp(self):
+        self.set_state = MEECU_Message.from_data(
+            first_frame(load_sample('set-state-response.bin')))
+        self.report = load_sample('send-report-response.bin')
+        self.values = self.set_state.get_decoder().decode(
+            MEECU_Message.from_data(self.report).payload)
+
+    def test_decode_reports(self):
+        entities = self.set_state.entities
+        records = ME_batch.decode_reports(self.report * 3, entities)
+        self.assertEqual(len(records), 3)
+
+        columns = ME_batch.report_columns(records, entities)
+        for entity, value in zip(entities, self.values):
+            self.assertEqual(columns[entity['id']].tolist(), [value] * 3)
+
+    def test_decode_payloads(self):
+        payload = MEECU_Message.from_data(self.report).payload
+        records = ME_batch.decode_payloads(payload * 2,
+                                           self.set_state.entities)
+        self.assertEqual(records[1][ME_batch.entity_field(17)], 31333)
+
+    def test_verify_frames(self):
+        report = load_sample('send-report-response.bin')
+        set_state = first_frame(load_sample('set-state-response.bin'))
+        corrupt = bytearray(report)
+        corrupt[50] ^= 0x01
+
+        data = report + set_state + VALID_REP_SEND_ACK_BYTES + bytes(corrupt)
+        starts, valid = ME_batch.verify_frames(data)
+        self.assertEqual(starts.tolist(),
+                         [0, len(report), len(report) + len(set_state),
+                          len(report) + len(set_state) + 10])
+        self.assertEqual(valid.tolist(), [True, True, True, False])
+
+    def test_rejects_foreign_frames(self):
+        with self.assertRaises(ValueError):
+            ME_batch.decode_reports(self.report[:-1],
+                                    self.set_state.entities)
+
+        bad = bytearray(self.report)
+        bad[6] = MEECU_ReportingCommands.SEND_ACK.value
+        with self.assertRaises(ValueError):
+            ME_batch.decode_reports(bytes(bad), self.set_state.entities)
+
+
+class TestSessionLog(unittest.TestCase):
+
+    def setUp(self):
+        set_state = MEECU_Message.from_data(
+            first_frame(load_sample('set-state-response.bin')))
+        self.decoder = set_state.get_decoder()
+        self.entities = set_state.entities
+        self.payload = MEECU_Message.from_data(
+            load_sample('send-report-response.bin')).payload
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'session.mesl')
+
+    def write_records(self, count, start=0):
+        with MEECU_SessionWriter.for_decoder(self.path, self.decoder,
+                                             index_interval=4) as writer:
+            for i in range(start, start + count):
+                payload = bytes([i]) + self.payload[1:]
+                writer.write(payload, 1000.0 + i * 0.1)
+
+    def test_round_trip(self):
+        self.write_records(10)
+        with MEECU_SessionReader(self.path) as reader:
+            self.assertEqual(len(reader), 10)
+            self.assertEqual(reader.entities, self.entities)
+
+            timestamp, payload = reader.record(3)
+            self.assertAlmostEqual(timestamp, 1000.3)
+            self.assertEqual(bytes(payload), bytes([3]) + self.payload[1:])
+            self.assertEqual(self.decoder.decode(payload),
+                             self.decoder.decode(self.payload))
+            del payload
+
+    def test_time_range(self):
+        self.write_records(20)
+        with MEECU_SessionReader(self.path) as reader:
+            self.assertEqual(reader.find(1000.55), 6)
+            self.assertEqual(reader.find(999.0), 0)
+            self.assertEqual(reader.find(2000.0), 20)
+
+            records = [payload[0] for _, payload
+                       in reader.read_range(1000.5, 1001.0)]
+            self.assertEqual(records, [5, 6, 7, 8, 9])
+            self.assertEqual(len(reader.range_buffer(1000.5, 1001.0)),
+                             5 * reader.record_size)
+
+    def test_duplicate_timestamps(self):
+        # Each run of equal times spans an index entry
+        with MEECU_SessionWriter.for_decoder(self.path, self.decoder,
+                                             index_interval=4) as writer:
+            for i in range(20):
+                writer.write(bytes([i]) + self.payload[1:],
+                             1.0 if i < 10 else 2.0)
+
+        with MEECU_SessionReader(self.path) as reader:
+            self.assertEqual(reader.find(1.0), 0)
+            self.assertEqual(reader.find(2.0), 10)
+            self.assertEqual(reader.find(1.5), 10)
+            self.assertEqual(len(list(reader.read_range(1, 3))), 20)
+
+    def test_append_after_interrupted_write(self):
+        self.write_records(5)
+        with open(self.path, 'ab') as f:
+            f.write(b'\x00' * 10)
+
+        self.write_records(5, start=5)
+        with MEECU_SessionReader(self.path) as reader:
+            self.assertEqual(len(reader), 10)
+            self.assertEqual(reader.find(1000.85), 9)
+
+    def test_append_with_other_entity_map(self):
+        self.write_records(1)
+        with self.assertRaises(ValueError):
+            MEECU_SessionWriter(self.path, self.entities[1:], 10)
+
+    def test_connection_recorder(self):
+        set_state = first_frame(load_sample('set-state-response.bin'))
+        report = load_sample('send-report-response.bin')
+
+        conn = fake_connection(set_state)
+        conn.wait_for_response(MEECU_MessageClass.REPORTING,
+                               MEECU_ReportingCommands.SET_STATE)
+        conn.set_recorder(MEECU_SessionWriter.for_decoder(self.path,
+                                                          conn.decoder))
+        conn.handle.rx += report * 3
+        while conn.receive_report() is not None:
+            pass
+        conn.recorder.close()
+
+        with MEECU_SessionReader(self.path) as reader:
+            self.assertEqual(len(reader), 3)
+
+    def test_record_only(self):
+        set_state = first_frame(load_sample('set-state-response.bin'))
+        report = load_sample('send-report-response.bin')
+
+        conn = fake_connection(set_state)
+        conn.wait_for_response(MEECU_MessageClass.REPORTING,
+                               MEECU_ReportingCommands.SET_STATE)
+        conn.set_recorder(MEECU_SessionWriter.for_decoder(self.path,
+                                                          conn.decoder),
+                          record_only=True)
+        conn.handle.rx += report * 3
+
+        # Reports go to the recorder without being built into messages
+        with mock.patch.object(MEECU_Message, 'from_data') as from_data:
+            self.assertIsNone(conn.receive_report())
+        from_data.assert_not_called()
+        self.assertEqual(len(conn.reports), 0)
+        conn.recorder.close()
+
+        with MEECU_SessionReader(self.path) as reader:
+            self.assertEqual(len(reader), 3)
+            self.assertEqual(bytes(reader.record(2)[1]),
+                             MEECU_Message.from_data(report).payload)
+
+
+class TestDeltaEncoding(unittest.TestCase):
+
+    def setUp(self):
+        set_state = MEECU_Message.from_data(
+            first_frame(load_sample('set-state-response.bin')))
+        self.decoder = set_state.get_decoder()
+        payload = MEECU_Message.from_data(
+            load_sample('send-report-response.bin')).payload
+
+        # Vary the leading byte and the RPM float between frames
+        self.payloads = []
+        for i in range(10):
+            changed = bytearray(payload)
+            changed[0] = i % 3
+            changed[4:8] = struct.pack('<f', 1000.0 + i)
+            self.payloads.append(bytes(changed))
+
+    def test_round_trip_with_keyframes(self):
+        encoder = MEECU_DeltaEncoder(self.decoder, keyframe_interval=4)
+        decoder = MEECU_DeltaDecoder(self.decoder)
+
+        frames = [encoder.encode(payload) for payload in self.payloads]
+        self.assertEqual([frame[0] for frame in frames],
+                         [0, 1, 1, 1, 0, 1, 1, 1, 0, 1])
+        self.assertLess(len(frames[1]), len(self.payloads[1]) // 10)
+
+        for frame, payload in zip(frames, self.payloads):
+            self.assertEqual(decoder.decode(frame), payload)
+
+    def test_delta_before_keyframe(self):
+        encoder = MEECU_DeltaEncoder(self.decoder)
+        frames = [encoder.encode(payload) for payload in self.payloads[:3]]
+
+        decoder = MEECU_DeltaDecoder(self.decoder)
+        self.assertIsNone(decoder.decode(frames[1]))
+
+        encoder.force_keyframe()
+        self.assertEqual(decoder.decode(encoder.encode(self.payloads[3])),
+                         self.payloads[3])
+
+    def test_recorder_stream(self):
+        stream = io.BytesIO()
+        recorder = MEECU_DeltaRecorder(stream, self.decoder)
+        for i, payload in enumerate(self.payloads):
+            recorder.write(payload, 100.0 + i)
+
+        stream.seek(0)
+        records = list(read_delta_stream(stream, self.decoder))
+        self.assertEqual([payload for _, payload in records], self.payloads)
+        self.assertAlmostEqual(records[-1][0], 109.0)
+
+
+TEST_MEDEF = '''<?xml version="1.0"?>
+<Definitions>
+  <DataLinks>
+    <DataLinkModel><id>1</id><name>RPM</name><units>rpm</units></DataLinkModel>
+    <DataLinkModel>
+      <id>14</id><name>Coolant Temp.</name><units>C</units>
+      <scale>0.5</scale><offset>-40</offset>
+    </DataLinkModel>
+  </DataLinks>
+</Definitions>
+'''
+
+
+class TestEntityCatalogue(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = tmpdir.name
+        self.path = os.path.join(self.dir, 'test.medef')
+        with open(self.path, 'w') as f:
+            f.write(TEST_MEDEF)
+
+    def test_parse(self):
+        self.assertEqual(parse_medef(self.path), [
+            MEECU_Entity(1, 'RPM', 'rpm'),
+            MEECU_Entity(14, 'Coolant Temp.', 'C', 0.5, -40.0),
+        ])
+
+    def test_cache_round_trip(self):
+        catalogue = MEECU_EntityCatalogue.load(self.path)
+        cached = [name for name in os.listdir(self.dir)
+                  if name.endswith('.mecat')]
+        self.assertEqual(len(cached), 1)
+
+        # A later load must come from the cache, not the XML
+        with mock.patch('ME_medef.parse_medef') as parse:
+            reloaded = MEECU_EntityCatalogue.load(self.path)
+        parse.assert_not_called()
+        self.assertEqual(reloaded.entities, catalogue.entities)
+
+    def test_parse_large_file(self):
+        with open(self.path, 'w') as f:
+            f.write('<Definitions><Tables>')
+            for i in range(20000):
+                f.write(f'<Table><id>{i}</id><name>Table {i}</name></Table>')
+            f.write('</Tables><DataLinks>')
+            for i in range(100):
+                f.write(f'<DataLinkModel><id>{i}</id><name>Link {i}</name>'
+                        f'</DataLinkModel>')
+            f.write('</DataLinks></Definitions>')
+
+        tracemalloc.start()
+        try:
+            entities = parse_medef(self.path)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(len(entities), 100)
+        self.assertEqual(entities[99], MEECU_Entity(99, 'Link 99'))
+        # Holding every table would take several megabytes
+        self.assertLess(peak, 1_000_000)
+
+    def test_unwritable_cache(self):
+        with mock.patch('os.makedirs', side_effect=PermissionError('denied')), \
+             mock.patch('builtins.print'):
+            catalogue = MEECU_EntityCatalogue.load(
+                self.path, os.path.join(self.dir, 'cache'))
+        self.assertEqual(len(catalogue), 2)
+
+    def test_lookup_by_name(self):
+        catalogue = MEECU_EntityCatalogue.load(self.path)
+        self.assertEqual(catalogue['RPM'].id, 1)
+        self.assertEqual(catalogue[14].units, 'C')
+
+        decoder = MEECU_ReportDecoder([{'id': 1, 'type': 2},
+                                       {'id': 14, 'type': 4}])
+        values = decoder.decode(b'\x00' + struct.pack('<HB', 3000, 130))
+        self.assertEqual(catalogue.value('RPM', decoder, values), 3000)
+        self.assertEqual(catalogue.value('Coolant Temp.', decoder, values),
+                         25.0)
+
+
+class TestConnectionManager(unittest.TestCase):
+
+    def run_manager(self, use_processes):
+        set_state = first_frame(load_sample('set-state-response.bin'))
+        report = load_sample('send-report-response.bin')
+        enable = MEECU_Reporting_SetState.encoded(True)
+
+        manager = MEECU_ConnectionManager(use_processes=use_processes,
+                                          reorder_delay=0.02)
+        for name in ('front', 'rear'):
+            path, close = pty_responder({enable: set_state + report * 3})
+            self.addCleanup(close)
+            manager.add(name, path, 115200)
+
+        manager.start()
+        received = []
+        try:
+            for timestamp, name, values in manager.reports():
+                received.append((timestamp, name))
+                self.assertEqual(values[1], 31333)
+                if len(received) == 6:
+                    break
+        finally:
+            manager.stop()
+
+        self.assertEqual(sorted(received), received)
+        self.assertEqual(sorted(name for _, name in received),
+                         ['front'] * 3 + ['rear'] * 3)
+        self.assertEqual(len(manager.entities['rear']), 150)
+
+    def test_threads(self):
+        self.run_manager(use_processes=False)
+
+    def test_processes(self):
+        self.run_manager(use_processes=True)
+
+    def test_stop_without_consuming(self):
+        # Workers keep queueing reports after the consumer has stopped
+        # reading, which stop() mustn't wait on forever
+        manager = MEECU_ConnectionManager(reorder_delay=0.02)
+        for name in ('front', 'rear'):
+            pty = MEECU_SimulatorPTY(MEECU_Simulator(report_rate=2000.0))
+            manager.add(name, pty.start(), 115200)
+            self.addCleanup(pty.stop)
+
+        manager.start()
+        next(manager.reports())
+        time.sleep(0.5)
+
+        stopper = threading.Thread(target=manager.stop, daemon=True)
+        stopper.start()
+        stopper.join(10)
+        self.assertFalse(stopper.is_alive())
+
+    def test_reports_end_when_all_workers_fail(self):
+        manager = MEECU_ConnectionManager(use_processes=False,
+                                          reorder_delay=0.02)
+        manager.add('missing', '/dev/nonexistent-ecu', 115200)
+
+        manager.start()
+        with mock.patch('builtins.print'):
+            self.assertEqual(list(manager.reports()), [])
+        self.assertIn('missing', manager.errors)
+
+    def test_undecodable_report_skipped(self):
+        manager = MEECU_ConnectionManager(use_processes=False)
+        manager._handle_event(('entities', 'front',
+                               [{'id': 1, 'type': 0}]), [])
+
+        heap = []
+        manager._handle_event(('report', 'front', 1.0, b'\x00\x01'), heap)
+        manager._handle_event(('report', 'rear', 1.0, b'\x00\x01'), heap)
+        self.assertEqual(heap, [])
+        self.assertEqual(sorted(manager.errors), ['front', 'rear'])
+
+class TestSimulator(unittest.TestCase):
+
+    def loopback(self, simulator):
+        conn = MEECU_Connection('loopback', 115200, timeout=0.5)
+        conn.handle = MEECU_LoopbackSerial(simulator)
+        return conn
+
+    def test_requests(self):
+        conn = self.loopback(MEECU_Simulator(entity_count=20))
+
+        info = conn.send_raw(MEECU_Sys_GetECUInfo.encoded())
+        self.assertIsInstance(info, MEECU_Sys_GetECUInfo)
+        self.assertTrue(info.crc_valid)
+
+        detailed = conn.send_raw(MEECU_Sys_GetHash.encoded(
+            MEECU_Sys_GetHash.MODE_DETAILED))
+        self.assertEqual(detailed.payload[0], MEECU_Sys_GetHash.MODE_DETAILED)
+
+        disable = conn.send_raw(MEECU_Reporting_SetState.encoded(False))
+        self.assertEqual(disable.version, MEECU_Reporting_SetState.REPORTING_V1)
+        self.assertEqual(disable.entities, [])
+
+    def test_reporting_from_capture(self):
+        simulator = MEECU_Simulator.from_capture(
+            first_frame(load_sample('set-state-response.bin')),
+            load_sample('send-report-response.bin'), report_rate=500)
+        conn = self.loopback(simulator)
+
+        with MEECU_ReportingSession(conn) as session:
+            self.assertEqual(len(session.entities), 150)
+            reports = []
+            for report in session:
+                reports.append(report)
+                if len(reports) == 10:
+                    break
+
+        self.assertEqual(reports[-1].entities[1]['value'], 31333)
+        self.assertGreaterEqual(simulator.acks_received, 9)
+        self.assertFalse(simulator.reporting)
+
+    def test_generated_reports(self):
+        simulator = MEECU_Simulator(entity_count=40, report_rate=1000)
+        conn = self.loopback(simulator)
+
+        with MEECU_ReportingSession(conn) as session:
+            report = next(iter(session))
+        self.assertEqual(len(report.entities), 40)
+
+    def test_unacked_reports_stall(self):
+        simulator = MEECU_Simulator(entity_count=5, report_rate=1000,
+                                    max_unacked=3)
+        conn = self.loopback(simulator)
+        conn.send_raw(MEECU_Reporting_SetState.encoded(True))
+
+        time.sleep(0.05)
+        conn.handle.in_waiting
+        self.assertEqual(simulator.reports_sent, 3)
+
+    def test_noise_and_drops(self):
+        simulator = MEECU_Simulator(entity_count=30, report_rate=2000,
+                                    noise_rate=0.2, drop_rate=0.2, seed=1)
+        conn = self.loopback(simulator)
+
+        with MEECU_ReportingSession(conn) as session:
+            reports = []
+            for report in session:
+                reports.append(report)
+                if len(reports) == 50:
+                    break
+
+        self.assertGreater(conn.framer.resyncs + conn.framer.dropped, 0)
+        self.assertTrue(all(report.crc_valid for report in reports))
+
+    def test_pty(self):
+        simulator = MEECU_Simulator(entity_count=10, report_rate=200)
+        with MEECU_SimulatorPTY(simulator) as pty:
+            conn = MEECU_Connection(pty.path, 115200, timeout=0.5)
+            self.assertTrue(conn.connect())
+
+            with MEECU_ReportingSession(conn) as session:
+                report = next(iter(session))
+            conn.handle.close()
+
+        self.assertEqual(len(report.entities), 10)
+
+class TestConnectionStats(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = MEECU_Histogram()
+        for value in (0.00015, 0.0003, 0.0003, 0.004):
+            histogram.record(value)
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 4)
+        self.assertEqual(snapshot['min'], 0.00015)
+        self.assertEqual(snapshot['max'], 0.004)
+        self.assertEqual(snapshot['p50'], 0.0005)
+        self.assertEqual(snapshot['p99'], 0.005)
+
+    def test_disabled(self):
+        conn = fake_connection(load_sample('send-report-response.bin'))
+        self.assertIsNotNone(conn.receive_report())
+        self.assertIsNone(conn.stats)
+
+    def test_session(self):
+        simulator = MEECU_Simulator(entity_count=20, report_rate=1000,
+                                    noise_rate=0.1, seed=3)
+        conn = MEECU_Connection('loopback', 115200, timeout=0.5)
+        conn.handle = MEECU_LoopbackSerial(simulator)
+        stats = conn.enable_stats()
+
+        events = []
+        stats.add_hook(lambda event, value: events.append(event))
+
+        with MEECU_ReportingSession(conn) as session:
+            for count, _ in enumerate(session, 1):
+                if count == 30:
+                    break
+        snapshot = stats.snapshot()
+
+        self.assertEqual(snapshot['bytes_out'], conn.handle.bytes_written)
+        self.assertGreater(snapshot['bytes_in'], 0)
+        self.assertGreaterEqual(snapshot['reports'], 30)
+        self.assertEqual(snapshot['frames'], snapshot['reports'] + 1)
+        self.assertEqual(snapshot['rtt']['count'], 1)
+        self.assertGreater(snapshot['crc_failures'], 0)
+        self.assertGreaterEqual(snapshot['resyncs'], snapshot['crc_failures'])
+        self.assertEqual(snapshot['report_interval']['count'],
+                         snapshot['reports'] - 1)
+        self.assertIn(MEECU_ConnectionStats.EVENT_RTT, events)
+        self.assertIn(MEECU_ConnectionStats.EVENT_REPORT, events)
+
+        conn.disable_stats()
+        self.assertIsNone(conn.stats)
+
+    def test_timeout(self):
+        conn = fake_connection()
+        stats = conn.enable_stats()
+        self.assertIsNone(conn.send_raw(MEECU_Sys_GetECUInfo.encoded(),
+                                        timeout=0.01))
+        self.assertEqual(stats.snapshot()['timeouts'], 1)
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.report = load_sample('send-report-response.bin')
+        self.entities = MEECU_Message.from_data(
+            first_frame(load_sample('set-state-response.bin'))).entities
+
+    def write_session(self, timestamps):
+        path = os.path.join(self.dir.name, 'session.mesl')
+        payload = MEECU_Message.from_data(self.report).payload
+        with MEECU_SessionWriter(path, self.entities, len(payload)) as writer:
+            for timestamp in timestamps:
+                writer.write(payload, timestamp)
+        return path
+
+    def replay(self, conn, limit=None):
+        self.assertTrue(conn.connect())
+        reports = []
+        with MEECU_ReportingSession(conn) as session:
+            for report in session:
+                reports.append(report)
+                if len(reports) == limit:
+                    break
+        return reports
+
+    def test_raw_capture(self):
+        path = os.path.join(SAMPLE_DIR, 'set-state-response.bin')
+        capture = MEECU_Capture(path)
+        self.assertIn((0x00, 0x02), capture.responses)
+        self.assertEqual(len(list(capture.reports())), 1)
+
+        conn = MEECU_ReplayConnection(path)
+        reports = self.replay(conn)
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(len(reports[0].entities), 150)
+        self.assertTrue(conn.finished)
+
+    def test_session_timing(self):
+        path = self.write_session([1000.0 + i * 0.1 for i in range(5)])
+
+        start = time.monotonic()
+        reports = self.replay(MEECU_ReplayConnection(path, speed=10))
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(len(reports), 5)
+        self.assertEqual(reports[0].entities[1]['value'], 31333)
+        self.assertGreaterEqual(elapsed, 0.04)
+
+        # Stamped with the time they were captured, not replayed
+        for i, report in enumerate(reports):
+            self.assertAlmostEqual(report.received, 1000.0 + i * 0.1,
+                                   delta=0.05)
+
+    def test_as_fast_as_possible(self):
+        path = self.write_session([1000.0 + i for i in range(200)])
+
+        start = time.monotonic()
+        reports = self.replay(MEECU_ReplayConnection(path, speed=None))
+        self.assertEqual(len(reports), 200)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_loop_with_entities(self):
+        path = os.path.join(SAMPLE_DIR, 'send-report-response.bin')
+        conn = MEECU_ReplayConnection(path, report_rate=1000, loop=True,
+                                      entities=self.entities)
+        reports = self.replay(conn, limit=5)
+
+        self.assertEqual(len(reports), 5)
+        self.assertFalse(conn.finished)
+
+    def test_missing_capture(self):
+        with mock.patch('builtins.print'):
+            conn = MEECU_ReplayConnection(os.path.join(self.dir.name, 'none'))
+            self.assertFalse(conn.connect())
+
+
+class TestAggregation(unittest.TestCase):
+
+    STREAM = [(0.00, {1: 1000, 2: 80.0}),
+              (0.04, {1: 3000, 2: 80.2}),
+              (0.08, {1: 2000, 2: 80.4}),
+              (0.12, {1: 2500, 2: 81.0})]
+
+    def test_timestamped(self):
+        report = MEECU_Message.from_data(load_sample('send-report-response.bin'))
+        report.parse_report(MEECU_Message.from_data(
+            first_frame(load_sample('set-state-response.bin'))).entities)
+
+        timestamp, values = next(timestamped([report], clock=lambda: 5.0))
+        self.assertEqual(timestamp, 5.0)
+        self.assertEqual(values[17], 31333)
+
+        # The time the connection received it wins over the time it was read
+        report.received = 2.0
+        timestamp, _ = next(timestamped([report], clock=lambda: 5.0))
+        self.assertEqual(timestamp, 2.0)
+
+    def test_aggregate(self):
+        windows = list(aggregate(iter(self.STREAM), 0.1))
+        self.assertEqual([start for start, _ in windows], [0.0, 0.1])
+
+        rpm = windows[0][1][1]
+        self.assertEqual(rpm, MEECU_WindowStats(1000, 3000, 2000.0, 2000, 3))
+        self.assertEqual(windows[1][1][2].last, 81.0)
+
+    def test_aggregate_sequences(self):
+        windows = list(aggregate([(0.0, (1, 5)), (0.5, (3, 2))], 1.0))
+        self.assertEqual(windows[0][1][0].mean, 2.0)
+        self.assertEqual(windows[0][1][1].min, 2)
+
+    def test_decimate(self):
+        self.assertEqual(list(decimate(self.STREAM, every=2)),
+                         self.STREAM[::2])
+        self.assertEqual([t for t, _ in decimate(self.STREAM, interval=0.05)],
+                         [0.0, 0.08])
+        with self.assertRaises(ValueError):
+            list(decimate(self.STREAM))
+
+    def test_on_change(self):
+        changes = list(on_change(self.STREAM, deadband={2: 0.5}))
+        self.assertEqual(changes, [(0.00, {1: 1000, 2: 80.0}),
+                                   (0.04, {1: 3000}),
+                                   (0.08, {1: 2000}),
+                                   (0.12, {1: 2500, 2: 81.0})])
+
+        steady = [(0.0, {1: 10}), (0.1, {1: 12}), (0.2, {1: 10})]
+        self.assertEqual(len(list(on_change(steady, deadband=5))), 1)
+
+    def test_chained(self):
+        stream = decimate(on_change(iter(self.STREAM * 100), 100), every=1)
+        self.assertEqual(len(list(aggregate(stream, 1.0))), 1)
+
+
+def telemetry_child(name, out_queue):
+    with MEECU_TelemetryReader(name) as reader:
+        out_queue.put(reader.wait(timeout=5))
+
+class TestTelemetryBus(unittest.TestCase):
+
+    ENTITIES = [{'id': i, 'type': MEECU_ReportingType.UINT_2B.value}
+                for i in range(1, 65)]
+
+    def setUp(self):
+        self.name = f"meecu-test-{os.getpid()}-{id(self)}"
+        self.publisher = MEECU_TelemetryPublisher(self.name, self.ENTITIES)
+        self.addCleanup(self.publisher.close)
+        self.decoder = self.publisher.decoder
+
+    def payload(self, value):
+        return self.decoder.struct.pack(*[value] * len(self.ENTITIES))
+
+    def test_publish_and_read(self):
+        reader = MEECU_TelemetryReader(self.name)
+        self.addCleanup(reader.close)
+        self.assertEqual(reader.entities, self.ENTITIES)
+        self.assertIsNone(reader.read())
+
+        self.assertTrue(self.publisher.write(self.payload(7), 12.5))
+        sequence, timestamp, values = reader.read()
+        self.assertEqual(sequence, 2)
+        self.assertEqual(timestamp, 12.5)
+        self.assertEqual(values, (7,) * 64)
+
+        subscription = reader.subscribe([3, 60])
+        self.assertEqual(reader.read(subscription)[2], {3: 7, 60: 7})
+        self.assertIsNone(reader.wait(timeout=0.01))
+
+        with mock.patch('builtins.print'):
+            self.assertFalse(self.publisher.write(b'\x00'))
+
+    def test_recorder(self):
+        simulator = MEECU_Simulator(self.ENTITIES, report_rate=1000)
+        conn = MEECU_Connection('loopback', 115200, timeout=0.5)
+        conn.handle = MEECU_LoopbackSerial(simulator)
+        conn.set_recorder(self.publisher)
+
+        reader = MEECU_TelemetryReader(self.name)
+        self.addCleanup(reader.close)
+        with MEECU_ReportingSession(conn) as session:
+            next(iter(session))
+            self.assertIsNotNone(reader.wait(timeout=1))
+
+        self.assertGreaterEqual(self.publisher.sequence, 2)
+        self.assertEqual(len(reader.read()[2]), 64)
+
+    def test_consistent_snapshots(self):
+        reader = MEECU_TelemetryReader(self.name)
+        self.addCleanup(reader.close)
+        payloads = [self.payload(i) for i in range(256)]
+        stop = threading.Event()
+
+        def publish():
+            i = 0
+            while not stop.is_set():
+                self.publisher.write(payloads[i % 256])
+                i += 1
+
+        thread = threading.Thread(target=publish)
+        thread.start()
+        try:
+            for _ in range(2000):
+                result = reader.read()
+                if result is not None:
+                    self.assertEqual(len(set(result[2])), 1)
+        finally:
+            stop.set()
+            thread.join()
+
+    def test_other_process(self):
+        import multiprocessing
+        out_queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=telemetry_child,
+                                        args=(self.name, out_queue))
+        child.start()
+        time.sleep(0.1)
+        self.publisher.write(self.payload(42), 1.0)
+
+        result = out_queue.get(timeout=5)
+        child.join()
+        self.assertEqual(result[2], (42,) * 64)
+
+        # The child exiting must not have removed the segment
+        MEECU_TelemetryReader(self.name).close()
+
+
+class TestTableEngine(unittest.TestCase):
+
+    TABLES = {1: bytes(range(256)) * 4, 2: b'\x55' * 300, 7: b'\x01\x02'}
+    SIZES = {table_id: len(data) for table_id, data in TABLES.items()}
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def engine(self, simulator, **kwargs):
+        conn = MEECU_Connection('loopback', 115200, timeout=0.2)
+        conn.handle = MEECU_LoopbackSerial(simulator)
+        return MEECU_TableEngine(conn, chunk_size=64, **kwargs)
+
+    def test_messages(self):
+        request = MEECU_Tables_GetDataAtOffset.request(3, 128, 64)
+        decoded = MEECU_Message.from_data(request.to_bytes())
+        self.assertEqual((decoded.table_id, decoded.offset,
+                          decoded.read_length), (3, 128, 64))
+
+        write = MEECU_Tables_SetDataAtOffsets.request(3, 8, b'\x01\x02')
+        decoded = MEECU_Message.from_data(write.to_bytes())
+        self.assertEqual(decoded.table_data, b'\x01\x02')
+
+        self.assertIs(command_by_value[(0x06, 0x07)],
+                      MEECU_DatalogCommands.GET_LOG_REGION)
+
+    def test_detailed_hash(self):
+        simulator = MEECU_Simulator(entity_count=5, tables=self.TABLES)
+        engine = self.engine(simulator)
+
+        hashes = engine.table_hashes()
+        self.assertEqual(sorted(hashes), [1, 2, 7])
+        self.assertEqual(hashes[2], simulator.table_hash(2))
+
+    def test_read_pipelined(self):
+        simulator = MEECU_Simulator(entity_count=5, tables=self.TABLES)
+        engine = self.engine(simulator, window=4)
+
+        self.assertEqual(engine.read_tables(self.SIZES), self.TABLES)
+        self.assertEqual(engine.requests, 16 + 5 + 1)
+
+    def test_cache(self):
+        simulator = MEECU_Simulator(entity_count=5, tables=self.TABLES)
+        engine = self.engine(simulator, cache_dir=self.dir.name)
+
+        self.assertEqual(engine.read_tables(self.SIZES), self.TABLES)
+        self.assertEqual(engine.cached, 0)
+
+        self.assertEqual(engine.read_tables(self.SIZES), self.TABLES)
+        self.assertEqual(engine.cached, 3)
+        self.assertEqual(engine.requests, 0)
+
+        # Only the changed table is read again
+        simulator.tables[2][0] = 0x00
+        tables = engine.read_tables(self.SIZES)
+        self.assertEqual(tables[2][:2], b'\x00\x55')
+        self.assertEqual(engine.cached, 2)
+
+    def test_write(self):
+        simulator = MEECU_Simulator(entity_count=5, tables=self.TABLES)
+        engine = self.engine(simulator, cache_dir=self.dir.name)
+
+        # Nothing is committed to NVM unless asked for
+        self.assertTrue(engine.write_table(1, b'\xAA' * 100, offset=10))
+        self.assertEqual(simulator.stored, 0)
+        self.assertEqual(engine.read_table(1, 1024)[8:112],
+                         bytes([8, 9]) + b'\xAA' * 100 + bytes([110, 111]))
+        self.assertTrue(engine.store())
+        self.assertEqual(simulator.stored, 1)
+
+        self.assertTrue(engine.write_table(1, b'\xBB', store=True))
+        self.assertEqual(simulator.stored, 2)
+
+        with mock.patch('builtins.print'):
+            self.assertFalse(engine.write_table(7, b'\x00' * 3, store=True))
+        self.assertEqual(simulator.stored, 2)
+
+    def test_lost_responses(self):
+        simulator = MEECU_Simulator(entity_count=5, tables=self.TABLES,
+                                    drop_rate=0.1, seed=4)
+        engine = self.engine(simulator, retries=10, timeout=0.05)
+
+        tables = engine._read_chunks(self.SIZES)
+        self.assertEqual(tables, self.TABLES)
+        self.assertGreater(engine.requests, 16 + 5 + 1)
+
+
+class TestDatalogDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, 'log.mesl')
+
+        self.simulator = MEECU_Simulator(entity_count=20)
+        self.data = self.simulator.record_log(3, 500, start_time=1000,
+                                              interval=0.02)
+        self.record_size = self.simulator.decoder.size - 1
+
+    def downloader(self, simulator=None, **kwargs):
+        conn = MEECU_Connection('loopback', 115200, timeout=0.2)
+        conn.handle = MEECU_LoopbackSerial(simulator or self.simulator)
+        return MEECU_DatalogDownloader(conn, chunk_size=100, **kwargs)
+
+    def assert_session(self, count):
+        with MEECU_SessionReader(self.path) as session:
+            self.assertEqual(len(session), count)
+            self.assertEqual(session.entities, self.simulator.entities)
+            for i in (0, count // 2, count - 1):
+                timestamp, payload = session.record(i)
+                self.assertAlmostEqual(timestamp, 1000 + i * 0.02)
+                self.assertEqual(bytes(payload[1:]), self.data[
+                    i * self.record_size:(i + 1) * self.record_size])
+                payload.release()
+
+    def test_messages(self):
+        request = MEECU_Datalog_GetLogRegion.request(3, 70000, 100)
+        decoded = MEECU_Message.from_data(request.to_bytes())
+        self.assertEqual((decoded.log_id, decoded.offset,
+                          decoded.read_length), (3, 70000, 100))
+
+        downloader = self.downloader()
+        self.assertEqual(downloader.list_logs(),
+                         [{'id': 3, 'size': len(self.data)}])
+
+        detail = downloader.log_detail(3)
+        self.assertEqual(detail.entities, self.simulator.entities)
+        self.assertEqual(detail.record_size, self.record_size)
+        self.assertAlmostEqual(detail.interval, 0.02)
+
+    def test_download(self):
+        downloader = self.downloader(window=4)
+        progress = []
+
+        count = downloader.download(3, self.path,
+                                    progress=lambda done, total:
+                                    progress.append((done, total)))
+        self.assertEqual(count, 500)
+        self.assertEqual(progress[-1], (500, 500))
+        self.assertEqual(downloader.requests,
+                         -(-len(self.data) // 100))
+        self.assert_session(500)
+
+    def test_resume(self):
+        # The link drops part way, leaving the records read so far on disk
+        downloader = self.downloader(retries=1, timeout=0.02)
+        with mock.patch.object(MEECU_LoopbackSerial, 'write', autospec=True,
+                               side_effect=self.cut_after(40)), \
+             mock.patch('builtins.print'):
+            self.assertIsNone(downloader.download(3, self.path))
+
+        with MEECU_SessionReader(self.path) as session:
+            written = len(session)
+        self.assertGreater(written, 0)
+        self.assertLess(written, 500)
+
+        downloader = self.downloader()
+        self.assertEqual(downloader.download(3, self.path), 500)
+        self.assertEqual(downloader.resumed, written)
+        self.assert_session(500)
+
+    def test_resume_refuses_different_log(self):
+        downloader = self.downloader()
+        self.assertEqual(downloader.download(3, self.path), 500)
+        size = os.path.getsize(self.path)
+
+        # Erased and recorded again with the same entity map
+        self.simulator.record_log(3, 600, start_time=2000, interval=0.02)
+        with mock.patch('builtins.print'):
+            self.assertIsNone(downloader.download(3, self.path))
+        self.assertEqual(os.path.getsize(self.path), size)
+
+        # Nothing records where a file without an origin came from
+        os.remove(self.path + '.origin')
+        self.simulator.record_log(3, 500, start_time=1000, interval=0.02)
+        with mock.patch('builtins.print'):
+            self.assertIsNone(downloader.download(3, self.path))
+
+    def cut_after(self, requests):
+        write = MEECU_LoopbackSerial.write
+        sent = []
+
+        def cut(handle, data):
+            sent.append(data)
+            if len(sent) > requests:
+                return len(data)
+            return write(handle, data)
+        return cut
+
+    def test_trigger_log(self):
+        self.simulator.trigger_blocks = [bytes([i]) * 32 for i in range(5)]
+        conn = MEECU_Connection('loopback', 115200, timeout=0.1)
+        conn.handle = MEECU_LoopbackSerial(self.simulator)
+        path = os.path.join(self.dir.name, 'triggers.bin')
+
+        self.assertEqual(capture_trigger_log(conn, path), 5)
+        self.assertFalse(self.simulator.trigger_logging)
+        blocks = [block for _, block in read_trigger_log(path)]
+        self.assertEqual(blocks, self.simulator.trigger_blocks)
+
+        # Stops once blocks stop arriving, well before the duration is up
+        start = time.monotonic()
+        self.assertEqual(capture_trigger_log(conn, path, duration=5.0,
+                                             timeout=0.1), 5)
+        self.assertLess(time.monotonic() - start, 2.0)
+
+
+class FixedRateLoopbackSerial(MEECU_LoopbackSerial):
+    """
+    Loopback to an ECU whose UART stays at ecu_rate, whatever the host's
+    rate. At any other rate, bytes arrive garbled in both directions.
+    """
+
+    def __init__(self, simulator, ecu_rate, baudrate=115200):
+        super().__init__(simulator, baudrate=baudrate)
+        self.ecu_rate = ecu_rate
+
+    def _garble(self, data):
+        if self.baudrate == self.ecu_rate:
+            return data
+        return bytes(byte ^ 0x5A for byte in data)
+
+    def read(self, size=1):
+        return self._garble(super().read(size))
+
+    def write(self, data):
+        return super().write(self._garble(data))
+
+
+class TestLinkProbe(unittest.TestCase):
+
+    def connection(self, baud_rate, ecu_rate=230400):
+        simulator = MEECU_Simulator(entity_count=20, report_rate=500.0, seed=2)
+        conn = MEECU_Connection('loopback', baud_rate, timeout=0.2)
+        conn.handle = FixedRateLoopbackSerial(simulator, ecu_rate, baud_rate)
+        return conn, simulator
+
+    def probe(self, conn):
+        return MEECU_LinkProbe(conn, candidates=(115200, 230400, 460800),
+                               round_trips=10, burst=0.1, timeout=0.05)
+
+    def test_error_rate(self):
+        self.assertEqual(error_rate({'frames': 0, 'timeouts': 0,
+                                     'crc_failures': 0, 'resyncs': 0}), 0.0)
+        self.assertAlmostEqual(error_rate(
+            {'frames': 90, 'timeouts': 5, 'crc_failures': 5, 'resyncs': 5},
+            {'frames': 100, 'timeouts': 0, 'crc_failures': 0, 'resyncs': 0}),
+            0.05)
+
+    def test_error_rate_of_corrupt_frames(self):
+        conn = MEECU_Connection('loopback', 115200)
+        conn.enable_stats()
+
+        # One frame in four fails its CRC
+        corrupt = bytearray(VALID_REP_SEND_ACK_BYTES)
+        corrupt[-1] ^= 0x01
+        conn.framer.feed((VALID_REP_SEND_ACK_BYTES * 3 + bytes(corrupt)) * 5)
+        conn.stats.frames = len(list(conn.framer))
+
+        snapshot = conn.stats.snapshot()
+        self.assertEqual(snapshot['frames'], 15)
+        self.assertEqual(snapshot['crc_failures'], 5)
+        self.assertAlmostEqual(error_rate(snapshot), 0.25)
+
+    def test_select_finds_ecu_rate(self):
+        conn, _ = self.connection(115200)
+        conn.enable_stats()
+        probe = self.probe(conn)
+
+        with mock.patch('builtins.print'):
+            result = probe.select()
+        self.assertEqual(result.baud_rate, 230400)
+        self.assertEqual(conn.baud_rate, 230400)
+        self.assertEqual(conn.handle.baudrate, 230400)
+        self.assertEqual(result.round_trips, 10)
+        self.assertGreater(result.reports, 0)
+        self.assertGreater(result.bytes_per_s, 0)
+
+        # The faster rate was given up on after a few requests
+        self.assertEqual([r.baud_rate for r in probe.results],
+                         [460800, 230400])
+        self.assertEqual(probe.results[0].round_trips, 0)
+
+        # The caller's stats are left alone
+        self.assertEqual(conn.stats.frames, 0)
+
+    def test_monitor_restarts_at_same_rate(self):
+        conn, simulator = self.connection(230400)
+        session = MEECU_ReportingSession(conn)
+        self.assertTrue(session.start())
+        monitor = MEECU_LinkMonitor(conn, session, self.probe(conn),
+                                    min_frames=20)
+
+        # A burst of noise on the harness, which then clears
+        simulator.noise_rate = 0.5
+        time.sleep(0.2)
+        simulator.noise_rate = 0.0
+
+        with mock.patch('builtins.print'):
+            self.assertEqual(monitor.check(), 230400)
+        self.assertEqual(monitor.reconnects, 1)
+        self.assertEqual(conn.handle.baudrate, 230400)
+
+        # Reporting carries on at the same rate
+        self.assertIsNotNone(next(iter(session)))
+        session.stop()
+
+    def test_monitor_finds_ecu_again(self):
+        conn, _ = self.connection(230400)
+        session = MEECU_ReportingSession(conn)
+        self.assertTrue(session.start())
+        monitor = MEECU_LinkMonitor(conn, session, self.probe(conn),
+                                    min_frames=20)
+
+        # The ECU comes back from a reset at another rate
+        conn.handle.ecu_rate = 115200
+
+        with mock.patch('builtins.print'):
+            self.assertEqual(monitor.reconnect(), 115200)
+        self.assertEqual(monitor.reconnects, 1)
+        self.assertEqual(conn.handle.baudrate, 115200)
+        self.assertIsNotNone(next(iter(session)))
+        session.stop()
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run(self):
+        run = benchmark.run_benchmarks([10], count=20, loopback_count=20)
+        names = [r['name'] for r in run['results']]
+        self.assertEqual(names, ['from_data', 'to_bytes', 'calc_crc',
+                                 'parse_report', 'decode', 'framer',
+                                 'scanner', 'loopback'])
+        for r in run['results']:
+            self.assertGreater(r['frames_per_s'], 0)
+
+        with mock.patch('sys.stderr', io.StringIO()):
+            self.assertEqual(benchmark.compare(run, run, 10.0), 0)
+
+    def test_short_lived_allocations(self):
+        # Everything allocated is freed before returning, so only the peak
+        # shows the allocations
+        def churn():
+            for _ in range(20):
+                [object() for _ in range(10)]
+
+        blocks, size, peak, _ = benchmark.measure_allocations(churn, 100)
+        self.assertLess(blocks, 1)
+        self.assertGreater(peak, 10 * 16)
+
+
 if __name__ == '__main__':
     unittest.main()
 